@@ -1,12 +1,15 @@
-from matplotlib.collections import LineCollection
-import re,copy,math,json,sys
+from matplotlib.collections import LineCollection,PolyCollection
+import re,copy,math,json,sys,time
 import datetime as dt
 from functools import reduce
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+import numpy as np
 from matplotlib.collections import LineCollection
 
 __all__ = ['decimalDate', 'convertDate', 'calendarDate', 'reticulation', # make from baltic import * safe
-           'clade', 'leaf', 'node', 'tree',
-           'make_tree', 'make_treeJSON', 'loadJSON', 'loadNexus', 'loadNewick', 'untangle']
+           'clade', 'leaf', 'node', 'tree', 'intervalIndex', 'spatialIndex', 'traitTable', 'traitView', 'phaseTimer', 'cladeCounter', 'tipTable',
+           'make_tree', 'make_treeJSON', 'loadJSON', 'loadNexus', 'loadNewick', 'streamNexus', 'mccTree', 'tmrcaDistributions', 'transitionEvents', 'transitionMatrix', 'writeNexusTrees', 'untangle']
 
 sys.setrecursionlimit(9001)
 
@@ -268,6 +271,7 @@ class leaf: ## leaf class
     traits (dict): Dictionary containing traits associated with the leaf, assigned in `make_tree()`.
     x (float or None): The x-coordinate for plotting, default is None.
     y (float or None): The y-coordinate for plotting, default is None.
+    tipIndex (int or None): Position of the tip in a `tipTable`, assigned by `tipTable.assign()`. Default is None.
 
     Docstring generated with ChatGPT 4o.
     """
@@ -282,6 +286,7 @@ class leaf: ## leaf class
         self.traits={} ## trait dictionary
         self.x=None ## position of tip on x axis if the tip were to be plotted
         self.y=None ## position of tip on y axis if the tip were to be plotted
+        self.tipIndex=None ## position of tip in a tipTable
 
     def is_leaflike(self):
         return True
@@ -292,6 +297,918 @@ class leaf: ## leaf class
     def is_node(self):
         return False
 
+class intervalIndex: ## sorted-endpoint index of branch spans
+    """
+    Represents an index over the spans of branches (from the parent's position to the branch's own position) for fast time-slice queries.
+
+    A branch is considered to be present at time t if its parent is below and the branch itself is at or above t (same as `countLineages()`).
+    Branches are sorted by the start of their span, which together with the longest span in the tree limits every query to a contiguous block of candidates.
+
+    Attributes:
+    attr (str): The branch attribute used as the time axis, default is 'absoluteTime'.
+    branches (list): The branches that were given to the index, positions in this list are returned when indices are requested.
+    starts (numpy.ndarray): Sorted span starts (parent positions).
+    ends (numpy.ndarray): Span ends (branch positions) in the same order as `starts`.
+    order (numpy.ndarray): Positions in `branches` in the same order as `starts`.
+    sortedEnds (numpy.ndarray): Span ends sorted independently, used for counting.
+    maxSpan (float): The longest span in the index.
+    """
+    def __init__(self,branches,attr='absoluteTime'):
+        self.attr=attr
+        self.branches=list(branches)
+
+        positions=[]
+        starts=[]
+        ends=[]
+        for i,k in enumerate(self.branches):
+            end=getattr(k,attr,None)
+            start=getattr(k.parent,attr,None) if k.parent else None
+            if start is None or end is None or start>end: ## branches without a parent or going backwards in time can never be present
+                continue
+            positions.append(i)
+            starts.append(start)
+            ends.append(end)
+
+        starts=np.array(starts,dtype=float)
+        ends=np.array(ends,dtype=float)
+        sort=np.argsort(starts,kind='stable')
+
+        self.starts=starts[sort]
+        self.ends=ends[sort]
+        self.order=np.array(positions,dtype=int)[sort]
+        self.sortedEnds=np.sort(ends)
+        self.maxSpan=float(np.max(ends-starts)) if len(starts)>0 else 0.0
+
+    def __len__(self):
+        return len(self.order)
+
+    def _candidates(self,start,end):
+        """
+        Return the block of sorted spans that could cover the interval between start and end.
+        """
+        slack=self.maxSpan+1e-9*(abs(start)+self.maxSpan) ## guard against rounding at the lower bound, extra candidates are filtered out later
+        lo=np.searchsorted(self.starts,start-slack,side='left')
+        hi=np.searchsorted(self.starts,end,side='left') ## spans have to start strictly before the end of the query
+        return lo,hi
+
+    def _report(self,lo,hi,mask,index):
+        positions=self.order[lo:hi][mask]
+        if index:
+            return positions
+        return [self.branches[i] for i in positions]
+
+    def count(self,t):
+        """
+        Count the number of branches present at a time point.
+
+        Parameters:
+        t (float): The time point.
+
+        Returns:
+        int: The number of branches whose parent is below and who are themselves at or above t.
+
+        Example:
+        >>> idx.count(2020.5)
+        """
+        return int(np.searchsorted(self.starts,t,side='left')-np.searchsorted(self.sortedEnds,t,side='left'))
+
+    def stab(self,t,index=False):
+        """
+        Find branches present at a time point.
+
+        Parameters:
+        t (float): The time point.
+        index (bool): If True, returns positions of branches in the list given to the index (an array of integers) instead of the branches. Default is False.
+
+        Returns:
+        list or numpy.ndarray: Branches whose parent is below and who are themselves at or above t.
+
+        Example:
+        >>> alive = idx.stab(2020.5)
+        """
+        lo,hi=self._candidates(t,t)
+        mask=self.ends[lo:hi]>=t
+        return self._report(lo,hi,mask,index)
+
+    def window(self,start,end,index=False):
+        """
+        Find branches that are present at any point within a time window.
+
+        Parameters:
+        start (float): The beginning of the window.
+        end (float): The end of the window.
+        index (bool): If True, returns positions of branches in the list given to the index (an array of integers) instead of the branches. Default is False.
+
+        Returns:
+        list or numpy.ndarray: Branches that would be returned by `stab()` for at least one time point between start and end.
+
+        Example:
+        >>> crossing = idx.window(2019.0, 2020.0)
+        """
+        assert start<=end,'Window start (%s) is after window end (%s)'%(start,end)
+        lo,hi=self._candidates(start,end)
+        mask=(self.ends[lo:hi]>=start)&(self.ends[lo:hi]>self.starts[lo:hi])
+        return self._report(lo,hi,mask,index)
+
+_absent=object() ## marks missing entries in object columns of traitTable
+
+class spatialIndex: ## uniform grid over drawn branch segments
+    """
+    Represents a grid index over line segments of a drawn tree for finding branches near a point or within a box, e.g. to map mouse clicks to branches.
+
+    Every segment is registered in each grid cell its bounding box overlaps, cells are sized so that there is about one segment per cell.
+    Queries only visit cells around the query, so their cost depends on the number of nearby segments rather than the size of the tree.
+
+    Attributes:
+    layout (str): The layout the segments were taken from ('rectangular', 'circular' or 'unrooted').
+    branches (list): The branches that were given to the index, positions in this list are returned when indices are requested.
+    segments (numpy.ndarray): Segments as an array of shape (n,2,2) with start and end points.
+    owners (numpy.ndarray): Positions in `branches` of the branch each segment belongs to.
+    cell (float): Width and height of grid cells.
+    origin (tuple): Lower left corner of the grid.
+    shape (tuple): Number of grid cells along x and y.
+    """
+    def __init__(self,branches,segments,owners,layout=None):
+        self.layout=layout
+        self.branches=list(branches)
+
+        segments=np.asarray(segments,dtype=float).reshape(-1,2,2)
+        owners=np.asarray(owners,dtype=int)
+        keep=np.isfinite(segments).all(axis=(1,2)) ## segments with missing coordinates can't be found
+        self.segments=segments[keep]
+        self.owners=owners[keep]
+
+        n=len(self.segments)
+        if n==0:
+            self.origin=(0.0,0.0)
+            self.cell=1.0
+            self.shape=(1,1)
+            self.cellStarts=np.zeros(2,dtype=int)
+            self.cellSegments=np.zeros(0,dtype=int)
+            return
+
+        lows=self.segments.min(axis=1)
+        highs=self.segments.max(axis=1)
+        minX,minY=lows.min(axis=0)
+        maxX,maxY=highs.max(axis=0)
+        width,height=maxX-minX,maxY-minY
+        area=width*height
+        if area>0:
+            self.cell=math.sqrt(area/n)
+        else: ## all segments along a line
+            self.cell=max(width,height)/n or 1.0
+        self.origin=(minX,minY)
+        self.shape=(int(width//self.cell)+1,int(height//self.cell)+1)
+
+        cx0,cy0=self._cellOf(lows[:,0],lows[:,1])
+        cx1,cy1=self._cellOf(highs[:,0],highs[:,1])
+        wx,wy=cx1-cx0+1,cy1-cy0+1
+        counts=wx*wy ## number of cells each segment overlaps
+        segment=np.repeat(np.arange(n),counts)
+        offset=np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)
+        cells=(cy0[segment]+offset//wx[segment])*self.shape[0]+cx0[segment]+offset%wx[segment]
+
+        sort=np.argsort(cells,kind='stable')
+        self.cellSegments=segment[sort] ## segments grouped by cell
+        self.cellStarts=np.searchsorted(cells[sort],np.arange(self.shape[0]*self.shape[1]+1)) ## where each cell's group starts
+
+    def __len__(self):
+        return len(self.segments)
+
+    def _cellOf(self,x,y):
+        """
+        Return grid cell coordinates of points, clipped to the grid.
+        """
+        cx=np.clip(((np.asarray(x)-self.origin[0])//self.cell).astype(int),0,self.shape[0]-1)
+        cy=np.clip(((np.asarray(y)-self.origin[1])//self.cell).astype(int),0,self.shape[1]-1)
+        return cx,cy
+
+    def _segmentsIn(self,cx0,cx1,cy0,cy1):
+        """
+        Return segments registered in a block of grid cells.
+        """
+        found=[self.cellSegments[self.cellStarts[cy*self.shape[0]+cx0]:self.cellStarts[cy*self.shape[0]+cx1+1]] for cy in range(cy0,cy1+1)] ## rows of cells are contiguous
+        return np.unique(np.concatenate(found)) if found else np.zeros(0,dtype=int)
+
+    def _distances(self,candidates,x,y):
+        """
+        Return distances from a point to the given segments.
+        """
+        a=self.segments[candidates,0]
+        b=self.segments[candidates,1]
+        ab=b-a
+        length=(ab**2).sum(axis=1)
+        t=np.where(length>0,((x-a[:,0])*ab[:,0]+(y-a[:,1])*ab[:,1])/np.where(length>0,length,1.0),0.0)
+        t=np.clip(t,0.0,1.0)
+        return np.hypot(a[:,0]+t*ab[:,0]-x,a[:,1]+t*ab[:,1]-y)
+
+    def _report(self,positions,index):
+        if index:
+            return positions
+        return [self.branches[i] for i in positions]
+
+    def nearest(self,x,y,max_distance=None,index=False):
+        """
+        Find the branch with a segment closest to a point.
+
+        Parameters:
+        x (float): x coordinate of the point.
+        y (float): y coordinate of the point.
+        max_distance (float or None): Ignore branches further away than this. Default is None (no limit).
+        index (bool): If True, returns the position of the branch in `branches` instead of the branch. Default is False.
+
+        Returns:
+        tuple: The closest branch (or its position, None if nothing was found) and its distance to the point.
+        """
+        if len(self.segments)==0: return None,float('inf')
+        qx=int((x-self.origin[0])//self.cell) ## cell of the query, can be outside the grid
+        qy=int((y-self.origin[1])//self.cell)
+        best,best_distance=None,float('inf')
+        furthest=max(abs(qx),abs(qy),abs(qx-self.shape[0]+1),abs(qy-self.shape[1]+1)) ## ring beyond which there are no cells
+        seen=set()
+        outside=lambda q,size: -q if q<0 else max(0,q-size+1)
+        r=max(outside(qx,self.shape[0]),outside(qy,self.shape[1])) ## first ring touching the grid
+        while r<=furthest:
+            if best is not None and best_distance<=(r-1)*self.cell: break ## unvisited cells are at least this far away
+            if max_distance!=None and (r-1)*self.cell>max_distance: break
+            cx0,cx1=max(qx-r,0),min(qx+r,self.shape[0]-1)
+            cy0,cy1=max(qy-r,0),min(qy+r,self.shape[1]-1)
+            if cx0<=cx1 and cy0<=cy1:
+                candidates=self._segmentsIn(cx0,cx1,cy0,cy1)
+                candidates=np.array([c for c in candidates if c not in seen],dtype=int)
+                if len(candidates)>0:
+                    seen.update(candidates.tolist())
+                    distances=self._distances(candidates,x,y)
+                    i=int(np.argmin(distances))
+                    if distances[i]<best_distance:
+                        best,best_distance=int(candidates[i]),float(distances[i])
+            r+=1
+
+        if best is None or (max_distance!=None and best_distance>max_distance): return None,float('inf')
+        owner=int(self.owners[best])
+        return (owner if index else self.branches[owner]),best_distance
+
+    def select(self,x0,y0,x1,y1,index=False):
+        """
+        Find branches with at least one segment crossing a box.
+
+        Parameters:
+        x0, y0, x1, y1 (float): Corners of the box.
+        index (bool): If True, returns positions of branches in `branches` instead of branches. Default is False.
+
+        Returns:
+        list or numpy.ndarray: Branches (or their positions) in the order of `branches`.
+        """
+        x0,x1=min(x0,x1),max(x0,x1)
+        y0,y1=min(y0,y1),max(y0,y1)
+        if len(self.segments)==0 or x1<self.origin[0] or y1<self.origin[1]: return self._report(np.zeros(0,dtype=int),index)
+        cx0,cy0=self._cellOf(x0,y0)
+        cx1,cy1=self._cellOf(x1,y1)
+        candidates=self._segmentsIn(int(cx0),int(cx1),int(cy0),int(cy1))
+
+        a=self.segments[candidates,0]
+        d=self.segments[candidates,1]-a
+        lo=np.zeros(len(candidates))
+        hi=np.ones(len(candidates))
+        inside=np.ones(len(candidates),dtype=bool)
+        for p,q in [(-d[:,0],a[:,0]-x0),(d[:,0],x1-a[:,0]),(-d[:,1],a[:,1]-y0),(d[:,1],y1-a[:,1])]: ## clip segments to the box (Liang-Barsky)
+            parallel=p==0
+            inside&=~(parallel&(q<0))
+            with np.errstate(divide='ignore',invalid='ignore'):
+                t=np.where(parallel,0.0,q/np.where(parallel,1.0,p))
+            lo=np.where(~parallel&(p<0),np.maximum(lo,t),lo)
+            hi=np.where(~parallel&(p>0),np.minimum(hi,t),hi)
+        hits=candidates[inside&(lo<=hi)]
+        return self._report(np.unique(self.owners[hits]),index)
+
+def _isNumber(value):
+    return isinstance(value,(int,float)) and not isinstance(value,bool)
+
+def _traitKind(value):
+    """
+    Return the kind of traitTable column that can store a trait value.
+    """
+    if _isNumber(value):
+        return 'numeric'
+    elif isinstance(value,str):
+        return 'categorical'
+    elif isinstance(value,list) and all(_isNumber(v) for v in value):
+        return 'range'
+    return 'object'
+
+class traitTable: ## columnar storage of branch traits
+    """
+    Represents the traits of a set of branches stored as one typed numpy column per trait.
+
+    Column kinds:
+    - 'numeric': floats (or integers, if all values are integers) with a boolean mask of which rows have the trait.
+    - 'categorical': strings stored as integer codes into a list of unique values (-1 where the trait is missing).
+    - 'range': lists of numbers (e.g. HPDs and ranges) stored as a 2D array padded with NaN, with the number of entries per row (-1 where the trait is missing).
+    - 'object': anything else (e.g. sets of strings or complete histories), stored as Python objects.
+
+    Attributes:
+    size (int): The number of rows (branches) in the table.
+    kinds (dict): The kind of each trait's column.
+    values (dict): The numpy array of values (or codes) of each trait.
+    present (dict): Boolean arrays marking which rows have a trait, for numeric columns.
+    lengths (dict): Number of entries of each row, for range columns.
+    categories (dict): List of unique values of each categorical trait, indexed by code.
+    """
+    def __init__(self,rows):
+        rows=list(rows)
+        self.size=len(rows)
+        self.kinds={}
+        self.values={}
+        self.present={}
+        self.lengths={}
+        self.categories={}
+        self._codes={} ## value to code dictionaries for categorical traits
+
+        keys=dict.fromkeys(key for traits in rows for key in traits) ## all trait keys in order of appearance
+        for key in keys:
+            column=[traits.get(key,_absent) for traits in rows]
+            kinds=set(_traitKind(v) for v in column if v is not _absent)
+            kind=kinds.pop() if len(kinds)==1 else 'object'
+            self._addColumn(key,kind,column)
+
+    def _addColumn(self,key,kind,column):
+        """
+        Create a column of a given kind from a list of values (`_absent` where rows do not have the trait).
+        """
+        n=self.size
+        self.kinds[key]=kind
+        if kind=='numeric':
+            present=np.array([v is not _absent for v in column],dtype=bool)
+            integers=all(isinstance(v,int) for v in column if v is not _absent)
+            values=np.zeros(n,dtype=np.int64) if integers else np.full(n,np.nan)
+            rows=np.flatnonzero(present)
+            values[rows]=[column[i] for i in rows]
+            self.values[key]=values
+            self.present[key]=present
+        elif kind=='categorical':
+            self.categories[key]=[]
+            self._codes[key]={}
+            self.values[key]=np.array([self._code(key,v) if v is not _absent else -1 for v in column],dtype=np.int32)
+        elif kind=='range':
+            lengths=np.array([len(v) if v is not _absent else -1 for v in column],dtype=np.int32)
+            values=np.full((n,max(1,lengths.max() if n>0 else 1)),np.nan)
+            for i,v in enumerate(column):
+                if v is not _absent and len(v)>0:
+                    values[i,:len(v)]=v
+            self.values[key]=values
+            self.lengths[key]=lengths
+        else:
+            values=np.empty(n,dtype=object)
+            for i,v in enumerate(column):
+                values[i]=v
+            self.values[key]=values
+
+    def _code(self,key,value):
+        codes=self._codes[key]
+        if value not in codes:
+            codes[value]=len(codes)
+            self.categories[key].append(value)
+        return codes[value]
+
+    def has(self,row,key):
+        kind=self.kinds.get(key)
+        if kind=='numeric':
+            return bool(self.present[key][row])
+        elif kind=='categorical':
+            return self.values[key][row]>=0
+        elif kind=='range':
+            return self.lengths[key][row]>=0
+        elif kind=='object':
+            return self.values[key][row] is not _absent
+        return False
+
+    def get(self,row,key):
+        """
+        Return the value of a trait for a row as a Python object, raises KeyError if the row does not have the trait.
+        """
+        if not self.has(row,key):
+            raise KeyError(key)
+        kind=self.kinds[key]
+        value=self.values[key][row]
+        if kind=='numeric':
+            return value.item()
+        elif kind=='categorical':
+            return self.categories[key][value]
+        elif kind=='range':
+            return value[:self.lengths[key][row]].tolist()
+        return value
+
+    def set(self,row,key,value):
+        """
+        Set the value of a trait for a row, converting the column to a more general kind if the value does not fit.
+        """
+        kind=self.kinds.get(key)
+        if kind is None: ## new trait
+            column=[_absent]*self.size
+            column[row]=value
+            self._addColumn(key,_traitKind(value),column)
+            return
+
+        fits=_traitKind(value)==kind
+        if fits and kind=='numeric' and self.values[key].dtype.kind=='i' and not isinstance(value,int):
+            fits=False ## float going into an integer column
+        if not fits and kind!='object':
+            column=[self.get(i,key) if self.has(i,key) else _absent for i in range(self.size)]
+            column[row]=value
+            kinds=set(_traitKind(v) for v in column if v is not _absent)
+            self._addColumn(key,kinds.pop() if len(kinds)==1 else 'object',column)
+            return
+
+        if kind=='numeric':
+            self.values[key][row]=value
+            self.present[key][row]=True
+        elif kind=='categorical':
+            self.values[key][row]=self._code(key,value)
+        elif kind=='range':
+            values=self.values[key]
+            if len(value)>values.shape[1]: ## widen the column
+                values=np.hstack([values,np.full((self.size,len(value)-values.shape[1]),np.nan)])
+                self.values[key]=values
+            values[row]=np.nan
+            values[row,:len(value)]=value
+            self.lengths[key][row]=len(value)
+        else:
+            self.values[key][row]=value
+
+    def delete(self,row,key):
+        if not self.has(row,key):
+            raise KeyError(key)
+        kind=self.kinds[key]
+        if kind=='numeric':
+            self.present[key][row]=False
+        elif kind=='categorical':
+            self.values[key][row]=-1
+        elif kind=='range':
+            self.lengths[key][row]=-1
+        else:
+            self.values[key][row]=_absent
+
+    def keys(self,row):
+        return [key for key in self.kinds if self.has(row,key)]
+
+    def column(self,key):
+        """
+        Return a trait's column as a numpy array with one entry per row.
+
+        Parameters:
+        key (str): The name of the trait.
+
+        Returns:
+        numpy.ndarray: Floats with NaN where the trait is missing for numeric traits, integer codes into `categories[key]` with -1 where missing for categorical traits,
+                       a 2D array padded with NaN for range traits and an object array (None where missing) for everything else.
+
+        Example:
+        >>> posteriors = tree.traitTable.column('posterior')
+        """
+        kind=self.kinds[key]
+        values=self.values[key]
+        if kind=='numeric':
+            column=values.astype(float)
+            column[~self.present[key]]=np.nan
+            return column
+        elif kind=='range':
+            column=values.copy()
+            column[self.lengths[key]<0]=np.nan
+            return column
+        elif kind=='object':
+            return np.array([None if v is _absent else v for v in values],dtype=object)
+        return values.copy()
+
+class traitView(MutableMapping): ## dictionary-like access to a row of traitTable
+    """
+    Represents the traits of a single branch stored in a `traitTable`, behaves like the `traits` dictionary.
+
+    Note:
+    - Values are returned as new Python objects, modifying a returned list does not change the table, assign it back instead.
+
+    Attributes:
+    table (traitTable): The table holding the values.
+    row (int): The row of the table belonging to the branch.
+    """
+    __slots__=('table','row')
+
+    def __init__(self,table,row):
+        self.table=table
+        self.row=row
+
+    def __getitem__(self,key):
+        return self.table.get(self.row,key)
+
+    def __setitem__(self,key,value):
+        self.table.set(self.row,key,value)
+
+    def __delitem__(self,key):
+        self.table.delete(self.row,key)
+
+    def __contains__(self,key):
+        return self.table.has(self.row,key)
+
+    def __iter__(self):
+        return iter(self.table.keys(self.row))
+
+    def __len__(self):
+        return len(self.table.keys(self.row))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return dict(self)
+
+class phaseTimer: ## cumulative wall-clock time spent in phases of a computation
+    """
+    Accumulate time spent in named phases (e.g. parsing, traversal, calibration) and the number of items (e.g. trees) processed.
+    Reports include phase totals, throughput and peak resident memory, and can be passed to a callback and/or appended to a JSON-lines stats file.
+
+    Parameters:
+    callback (function or None): Called with every report (a dictionary). Default is None.
+    stats (str, file or None): Path or open text file to which every report is written as a line of JSON. Default is None.
+    total (int or None): Number of items expected, used to estimate time remaining. Default is None.
+
+    Example:
+    >>> timer=phaseTimer(stats='stats.jsonl')
+    >>> ll=loadNexus('tree.mcc.tree',timer=timer)
+    >>> timer.report()['phases']
+    {'parse': 0.21, 'traverse': 0.02, 'sort': 0.01, 'calibrate': 0.001}
+    """
+    def __init__(self,callback=None,stats=None,total=None):
+        self.phases={}
+        self.items=0
+        self.total=total
+        self.callback=callback
+        self.stats=stats
+        self.start=time.perf_counter()
+
+    @contextmanager
+    def phase(self,name):
+        """
+        Context manager that adds the time spent within it to phase `name`.
+        """
+        begin=time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.phases[name]=self.phases.get(name,0.0)+time.perf_counter()-begin
+
+    def count(self,n=1):
+        """
+        Record that `n` more items were processed.
+        """
+        self.items+=n
+
+    def report(self,**extra):
+        """
+        Return a dictionary with elapsed time, items processed, items per second, estimated seconds remaining (if the total is known), cumulative phase times in seconds and peak resident memory in bytes (None where unavailable).
+        Keyword arguments are added to the dictionary.
+        """
+        elapsed=time.perf_counter()-self.start
+        rate=self.items/elapsed if elapsed>0 else 0.0
+        remaining=(self.total-self.items)/rate if self.total is not None and rate>0 else None
+        out={'elapsed': elapsed,'items': self.items,'rate': rate,'remaining': remaining,'phases': dict(self.phases),'peak_rss': _peakMemory()}
+        out.update(extra)
+        return out
+
+    def emit(self,**extra):
+        """
+        Create a report and pass it to the callback and the stats file.
+
+        Returns:
+        dict: The report.
+        """
+        out=self.report(**extra)
+        if self.callback is not None:
+            self.callback(out)
+        if self.stats is not None:
+            if isinstance(self.stats,str):
+                with open(self.stats,'a') as f:
+                    f.write('%s\n'%(json.dumps(out)))
+            else:
+                self.stats.write('%s\n'%(json.dumps(out)))
+                self.stats.flush()
+        return out
+
+def _peakMemory():
+    """
+    Peak resident memory of this process in bytes, None where it can't be determined.
+    """
+    try:
+        import resource
+    except ImportError: ## not available on Windows
+        return None
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform=='darwin' else peak*1024 ## kilobytes on linux
+
+class cladeCounter: ## frequencies and ages of clades across a set of trees (e.g. a posterior sample)
+    """
+    Count how often clades appear across trees. Each clade is identified by a bitmask (a python int) of its descendant tips, with one bit per tip in the order of `tips`
+    (e.g. the Translate block of a BEAST tree file), so that the same clade has the same key in every tree. Counts, sums and sums of squares of node ages are kept per distinct clade.
+    Counters that use the same tips can be merged, e.g. after counting chunks of a tree file in separate processes.
+
+    Parameters:
+    tips (list or None): Tip names in the order of their bits. Default is None, which assigns bits to tips as they are encountered (counters can then only be merged if they encountered tips in the same order).
+
+    Attributes:
+    tips (list): Tip names, the i-th name corresponds to bit i.
+    clades (dict): Bitmask of a clade to a list of [count, sum of node ages, sum of squared node ages].
+    trees (int): Number of trees counted.
+
+    Example:
+    >>> counter=cladeCounter()
+    >>> for state,ll in streamNexus('posterior.trees',burnin=1000000):
+    ...     counter.add(ll)
+    >>> [(counter.tipNames(mask),counter.frequency(mask)) for mask in counter.clades]
+    """
+    def __init__(self,tips=None):
+        self.tips=[]
+        self.bits={}
+        self.clades={}
+        self.trees=0
+        for name in tips or []:
+            self._bit(name)
+
+    def _bit(self,name):
+        if name not in self.bits:
+            self.bits[name]=len(self.tips)
+            self.tips.append(name)
+        return self.bits[name]
+
+    def masks(self,ll,order=None):
+        """
+        Return a dictionary of every branch in a tree to the bitmask of its descendant tips. Branches are visited in `order` (children before parents), by default the reversed pre-order.
+        """
+        if order is None: order=reversed(ll._preorder())
+        mask={}
+        for k in order:
+            if k.is_node():
+                mask[k]=reduce(lambda a,b: a|b,(mask[child] for child in k.children))
+            else:
+                mask[k]=1<<self._bit(k.name)
+        return mask
+
+    def nodeMasks(self,ll):
+        """
+        Return a dictionary of bitmasks of the clades in a tree to their common ancestors. Nodes with a single child share a clade with the youngest of them.
+        """
+        order=ll._preorder()[::-1] ## children before parents, so that the youngest node of a single-child chain comes first
+        mask=self.masks(ll,order)
+        clades={}
+        for k in order:
+            if k.is_node() and mask[k] not in clades:
+                clades[mask[k]]=k
+        return clades
+
+    def add(self,ll,heights=True):
+        """
+        Count the clades of a traversed tree.
+
+        Parameters:
+        ll (tree): The tree.
+        heights (bool): If True node ages (time before the most recent tip) are added to the sums of ages. Default is True.
+
+        Returns:
+        dict: Bitmasks of clades in the tree to their common ancestors (see `nodeMasks()`).
+        """
+        clades=self.nodeMasks(ll)
+        for m,k in clades.items():
+            entry=self.clades.get(m)
+            if entry is None:
+                entry=self.clades[m]=[0,0.0,0.0]
+            entry[0]+=1
+            if heights:
+                age=ll.treeHeight-k.height
+                entry[1]+=age
+                entry[2]+=age*age
+        self.trees+=1
+        return clades
+
+    def merge(self,other):
+        """
+        Add the counts of another counter that uses the same tips.
+
+        Returns:
+        cladeCounter: This counter.
+        """
+        assert self.tips==other.tips,'Counters have to use the same tips in the same order to be merged'
+        for m,(n,total,squares) in other.clades.items():
+            entry=self.clades.get(m)
+            if entry is None:
+                self.clades[m]=[n,total,squares]
+            else:
+                entry[0]+=n
+                entry[1]+=total
+                entry[2]+=squares
+        self.trees+=other.trees
+        return self
+
+    def frequency(self,mask):
+        """
+        Proportion of trees in which a clade was found.
+        """
+        return self.clades[mask][0]/self.trees if mask in self.clades else 0.0
+
+    def ageMean(self,mask):
+        """
+        Mean age of the common ancestor of a clade, across trees that have the clade.
+        """
+        n,total,squares=self.clades[mask]
+        return total/n
+
+    def ageVariance(self,mask):
+        """
+        Variance of the age of the common ancestor of a clade, across trees that have the clade.
+        """
+        n,total,squares=self.clades[mask]
+        return max(squares/n-(total/n)**2,0.0)
+
+    def tipNames(self,mask):
+        """
+        Return the names of tips in a clade.
+        """
+        return [self.tips[i] for i in range(mask.bit_length()) if (mask>>i)&1]
+
+class tipTable: ## names, dates and other fields of tips, parsed once and shared by every tree with the same tips
+    """
+    Parse the names of tips once (e.g. from the Translate block of a BEAST tree file) and keep what is encoded in them as arrays, one entry per tip.
+    Tips of trees parsed against the table (e.g. every tree of a posterior sample, see `streamNexus()`) record their index in the table as `tipIndex`, so that their dates are read from arrays instead of searching tip names with regular expressions again.
+
+    Parameters:
+    tips (dict or list): Tip encodings (numbers to names, as in `tipMap`) or a list of tip names.
+    tip_regex (str or None): A regular expression capturing dates in tip names. Default is None (no dates).
+    date_fmt (str): The date format for the extracted dates. Default is '%Y-%m-%d'.
+    variableDate (bool): If True, allows for variable date formats. Default is True.
+    fields (dict or None): Names of additional fields to regular expressions capturing them from tip names. Default is None.
+
+    Attributes:
+    names (numpy.ndarray): Tip names, the i-th name belongs to tip i.
+    codes (list or None): Tip numbers of the Translate block, if tips were given as a dictionary.
+    dates (numpy.ndarray): Decimal dates of tips, nan where tip_regex did not match.
+    fields (dict): Name of each additional field to an array of captured values (None where the regular expression did not match).
+    mostRecent (float): Date of the most recent tip, nan if there are no dates.
+
+    Example:
+    >>> table=tipTable(ll.tipMap,tip_regex='_([0-9-]+)$',fields={'host':'^([A-Za-z]+)_'})
+    >>> for state,ll in streamNexus('posterior.trees',tip_table=table):
+    ...     print(state,ll.root.absoluteTime)
+    """
+    def __init__(self,tips,tip_regex=None,date_fmt='%Y-%m-%d',variableDate=True,fields=None):
+        if isinstance(tips,dict):
+            self.codes=list(tips.keys())
+            names=list(tips.values())
+        else:
+            self.codes=None
+            names=list(tips)
+        self.names=np.array(names,dtype=object)
+        self.index={name: i for i,name in enumerate(names)}
+        if self.codes is not None: ## trees whose tips have not been renamed are looked up by tip number
+            for i,code in enumerate(self.codes):
+                self.index.setdefault(code,i)
+
+        self.dates=np.full(len(names),np.nan)
+        if tip_regex is not None:
+            cerberus=re.compile(tip_regex)
+            for i,name in enumerate(names):
+                match=cerberus.search(name)
+                if match:
+                    self.dates[i]=decimalDate(match.group(1),fmt=date_fmt,variable=variableDate)
+        self.mostRecent=float(np.nanmax(self.dates)) if np.isfinite(self.dates).any() else np.nan
+
+        self.fields={}
+        for field,regex in (fields or {}).items():
+            cerberus=re.compile(regex)
+            matches=(cerberus.search(name) for name in names)
+            self.fields[field]=np.array([match.group(1) if match else None for match in matches],dtype=object)
+
+    def __len__(self):
+        return len(self.names)
+
+    def assign(self,ll):
+        """
+        Record the index of each tip of a tree in the table as its `tipIndex` attribute (-1 for tips missing from the table), e.g. right after the tree is parsed with tip numbers of the Translate block.
+
+        Returns:
+        numpy.ndarray: Tip indices of leaf-like branches of the tree, in the order of `getExternal()`.
+        """
+        tips=ll.getExternal()
+        for k in tips:
+            k.tipIndex=self.index.get(k.name,-1)
+        return np.fromiter((k.tipIndex for k in tips),dtype=int,count=len(tips))
+
+    def indices(self,names):
+        """
+        Return an array of tip indices for tip names or numbers, or for the leaf-like branches of a tree. Names missing from the table are -1.
+        For trees, the `tipIndex` of tips (see `assign()`) is used, and tips without one are looked up by name.
+        """
+        if isinstance(names,tree):
+            tips=names.getExternal()
+            return np.fromiter((k.tipIndex if getattr(k,'tipIndex',None) is not None else self.index.get(k.name,-1) for k in tips),dtype=int,count=len(tips))
+        return np.fromiter((self.index.get(name,-1) for name in names),dtype=int,count=len(names))
+
+    def date(self,names):
+        """
+        Return decimal dates of tips (an array for a list of names, a float for one name), nan where the tip has no date.
+        """
+        if isinstance(names,str):
+            i=self.index.get(names,-1)
+            return self.dates[i] if i>=0 else np.nan
+        idx=self.indices(names)
+        return np.where(idx>=0,self.dates[idx],np.nan)
+
+    def calibrate(self,ll):
+        """
+        Place a tree in absolute time using the date of its most recent tip (see `setAbsoluteTime()`).
+
+        Returns:
+        float: Date of the most recent tip of the tree.
+
+        Raises:
+        AssertionError: If none of the tips of the tree have dates.
+        """
+        idx=self.indices(ll)
+        dates=self.dates[idx[idx>=0]]
+        assert np.isfinite(dates).any(),'None of the tips of the tree have dates in the tip table.\nFirst tip name encountered: %s'%(ll.getExternal()[0].name)
+        most_recent=np.nanmax(dates)
+        ll.setAbsoluteTime(most_recent)
+        return most_recent
+
+def _bufferedWriter(handle,size=10000):
+    """
+    Return a function that collects strings and writes them to a file handle in chunks, and a function that writes what's left.
+    """
+    buffer=[]
+    def write(fragment):
+        buffer.append(fragment)
+        if len(buffer)>=size:
+            handle.write(''.join(buffer))
+            del buffer[:]
+    def flush():
+        handle.write(''.join(buffer))
+        del buffer[:]
+    return write,flush
+
+def _cullLabels(ax,xs,ys,labels,rotations,horizontal,vertical,fontsize,priority=None):
+    """
+    Select labels that don't overlap on the axes, visiting them by decreasing priority (in order given if priority is None).
+    Label boxes are estimated in display coordinates from the font size and text length and stored in a grid to find collisions.
+
+    Returns:
+    list: Indices of labels to keep, in their original order.
+    """
+    from matplotlib.font_manager import FontProperties
+
+    if len(labels)==0: return []
+    if ax.get_autoscalex_on() or ax.get_autoscaley_on(): ax.autoscale_view() ## make sure data limits are applied before transforming
+    points=FontProperties(size=fontsize).get_size_in_points()
+    pixels=points*ax.figure.dpi/72.0
+
+    anchors=ax.transData.transform(np.column_stack([xs,ys]))
+    w=np.array([len(str(label)) for label in labels],dtype=float)*pixels*0.6 ## approximate width of characters
+    h=np.full(len(labels),pixels)
+    left=np.array([{'left': 0.0,'center': -0.5,'right': -1.0}.get(a,0.0) for a in horizontal])*w
+    bottom=np.array([{'bottom': 0.0,'baseline': 0.0,'center': -0.5,'center_baseline': -0.5,'top': -1.0}.get(a,-0.5) for a in vertical])*h
+
+    theta=np.radians(np.asarray(rotations,dtype=float))
+    cos,sin=np.cos(theta),np.sin(theta)
+    corners_x=[]
+    corners_y=[]
+    for dx,dy in [(left,bottom),(left+w,bottom),(left,bottom+h),(left+w,bottom+h)]: ## rotate label box corners around anchor
+        corners_x.append(anchors[:,0]+dx*cos-dy*sin)
+        corners_y.append(anchors[:,1]+dx*sin+dy*cos)
+    x0,x1=np.min(corners_x,axis=0),np.max(corners_x,axis=0)
+    y0,y1=np.min(corners_y,axis=0),np.max(corners_y,axis=0)
+
+    cell=max(float(np.median(x1-x0)),float(np.median(y1-y0)),1.0) ## grid cells about the size of a typical label
+    order=range(len(labels)) if priority is None else sorted(range(len(labels)),key=lambda i: -priority[i])
+    grid={}
+    kept=[]
+    for i in order:
+        if not np.isfinite(x0[i]+y0[i]+x1[i]+y1[i]): continue
+        cells=[(cx,cy) for cx in range(int(x0[i]//cell),int(x1[i]//cell)+1) for cy in range(int(y0[i]//cell),int(y1[i]//cell)+1)]
+        if any(x0[i]<x1[j] and x0[j]<x1[i] and y0[i]<y1[j] and y0[j]<y1[i] for c in cells for j in grid.get(c,[])): continue ## overlaps with a label already kept
+        for c in cells: grid.setdefault(c,[]).append(i)
+        kept.append(i)
+    return sorted(kept)
+
+def _expandColumn(values,index,repeats=1):
+    """
+    Select (and repeat) per-branch plotting values for additional segments drawn for the same branches. Single values are returned as they are.
+    """
+    if isinstance(values,np.ndarray): return np.repeat(values[index],repeats,axis=0)
+    if isinstance(values,list): return [values[i] for i in index for r in range(repeats)]
+    return values
+
+def _joinColumns(values,extra):
+    """
+    Join per-branch plotting values of two groups of segments. Single values are returned as they are.
+    """
+    if isinstance(values,np.ndarray) and isinstance(extra,np.ndarray): return np.concatenate([values,extra])
+    if isinstance(values,(list,np.ndarray)): return list(values)+list(extra)
+    return values
+
 class tree: ## tree class
     """
     Represents a phylogenetic tree.
@@ -299,11 +1216,12 @@ class tree: ## tree class
     Attributes:
     cur_node (node): The current node in the tree, initialized as a new instance of the node class when building the tree in `make_tree()`.
     root (node): The root of the tree.
-    Objects (list): A flat list of all branches (nodes, leaves, reticulations) in the tree.
+    Objects (list): A flat list of all branches (nodes, leaves, reticulations) in the tree. Lists derived from it are cached; methods that change the tree drop the cache, while edits made directly to `Objects` or to branch `children`, `parent` or `index` should be followed by `traverse_tree()`.
     tipMap (dict or None): A mapping of tip numbers to names used when importing trees in NEXUS format, assigned by `loadNexus()`.
     treeHeight (float): The height of the tree, defined as the distance between the root and the most recent tip.
     mostRecent (node or None): The most recent node in the tree.
     ySpan (float): The vertical span of the tree for plotting.
+    traitTable (traitTable or None): Columnar storage of branch traits, assigned by `compactTraits()`.
     
     Docstring generated with ChatGPT 4o.
     """
@@ -324,6 +1242,41 @@ class tree: ## tree class
         self.treeHeight=0 ## tree height is the distance between the root and the most recent tip
         self.mostRecent=None
         self.ySpan=0.0
+        self.traitTable=None ## columnar trait storage, see compactTraits()
+        self._cache={} ## membership lists derived from Objects, see _branchCache()
+        self._cacheToken=None
+        self._dirty=[] ## branches whose subtrees were changed, see _markDirty()
+
+    def _branchCache(self):
+        """
+        Return the dictionary of cached lists derived from `Objects`, emptying it if `Objects` has been replaced or resized since it was filled. Other changes are dropped by `_invalidate()`.
+        """
+        token=(id(self.Objects),len(self.Objects))
+        if getattr(self,'_cacheToken',None)!=token:
+            self._cache={}
+            self._cacheToken=token
+        return self._cache
+
+    def _appendBranch(self,k):
+        """
+        Add a branch to `Objects`, keeping lists and lookup tables that have already been cached up to date.
+        """
+        cache=self._branchCache()
+        self.Objects.append(k)
+        self._cacheToken=(id(self.Objects),len(self.Objects))
+        position=len(self.Objects)-1
+        if 'external' in cache and k.is_leaflike(): cache['external'].append(k)
+        if 'internal' in cache and k.is_node(): cache['internal'].append(k)
+        if 'indices' in cache: cache['indices'].setdefault(k.index,position)
+        if 'names' in cache and k.is_leaflike(): cache['names'].setdefault(k.name,position)
+        cache.pop('traitRows',None)
+
+    def _invalidate(self):
+        """
+        Drop cached lists after the topology of the tree has been changed.
+        """
+        self._cache={}
+        self._cacheToken=None
 
     def add_reticulation(self,name):
         """
@@ -338,7 +1291,7 @@ class tree: ## tree class
         ret.index=name
         ret.parent=self.cur_node
         self.cur_node.children.append(ret)
-        self.Objects.append(ret)
+        self._appendBranch(ret)
         self.cur_node=ret
 
     def add_node(self,i):
@@ -363,7 +1316,7 @@ class tree: ## tree class
         assert self.cur_node.is_node(), 'Attempted to add a child to a non-node object. Check if tip names have illegal characters like parentheses or commas.'
         self.cur_node.children.append(new_node) ## new node is a child of current node
         self.cur_node=new_node ## current node is now new node
-        self.Objects.append(self.cur_node) ## add new node to list of objects in the tree
+        self._appendBranch(self.cur_node) ## add new node to list of objects in the tree
 
     def add_leaf(self,i,name):
         """
@@ -384,7 +1337,7 @@ class tree: ## tree class
         self.cur_node.children.append(new_leaf) ## assign leaf to parent's children
         new_leaf.name=name
         self.cur_node=new_leaf ## current node is now new leaf
-        self.Objects.append(self.cur_node) ## add leaf to all objects in the tree
+        self._appendBranch(self.cur_node) ## add leaf to all objects in the tree
 
     def subtree(self,starting_node=None,traverse_condition=None,stem=True):
         """
@@ -424,7 +1377,8 @@ class tree: ## tree class
                 if child.index!=starting_node.index: ## not at focal branch (unwanted sibling)
                     unwanted_branches+=self.traverse_tree(child,include_condition=lambda w: True) ## add all branches resulting from traversals of unwanted siblings
 
-            remove=[k for k in subtree_branches if k.index in [ub.index for ub in unwanted_branches]] ## iterate over subtree branches, remember those that belong to unwanted subtrees 
+            unwanted_indices=set(ub.index for ub in unwanted_branches)
+            remove=[k for k in subtree_branches if k.index in unwanted_indices] ## iterate over subtree branches, remember those that belong to unwanted subtrees 
             for r in remove: ## iterate over branches belong to unwanted subtrees
                 subtree_branches.remove(r) ## remove from list
 
@@ -445,7 +1399,8 @@ class tree: ## tree class
             local_tree.fixHangingNodes()
 
         if self.tipMap: ## if original tree has a tipMap dictionary
-            local_tree.tipMap={tipNum: self.tipMap[tipNum] for tipNum in self.tipMap if self.tipMap[tipNum] in [w.name for w in local_tree.getExternal()]} ## copy over the relevant tip translations
+            subtree_names=set(w.name for w in local_tree.getExternal())
+            local_tree.tipMap={tipNum: self.tipMap[tipNum] for tipNum in self.tipMap if self.tipMap[tipNum] in subtree_names} ## copy over the relevant tip translations
 
         return local_tree
 
@@ -488,6 +1443,7 @@ class tree: ## tree class
                 child.length+=k.length ## adjust child length
 
                 self.Objects.remove(k) ## remove old parent from all objects
+            self._invalidate()
         self.sortBranches()
 
     def setAbsoluteTime(self,date):
@@ -529,7 +1485,7 @@ class tree: ## tree class
         """
         self.traverse_tree() ## traverse the tree
         obs=self.Objects ## convenient list of all objects in the tree
-        print('\nTree height: %.6f\nTree length: %.6f'%(self.treeHeight,sum([x.length for x in obs]))) ## report the height and length of tree
+        print('\nTree height: %.6f\nTree length: %.6f'%(self.treeHeight,np.nansum(self.getParameter('length',as_array=True)))) ## report the height and length of tree
 
         nodes=self.getInternal() ## get all nodes
         strictlyBifurcating=all(len(x.children) == 2 for x in nodes) ## assume tree is not strictly bifurcating
@@ -573,6 +1529,7 @@ class tree: ## tree class
             cur_node=self.root
 
             if traverse_condition==None and include_condition==None: ## reset heights if traversing from scratch
+                self._invalidate() ## branches may have been edited directly, cached lists are rebuilt on demand
                 for k in self.Objects: ## reset various parameters
                     if k.is_node():
                         k.leaves=set()
@@ -612,6 +1569,91 @@ class tree: ## tree class
         return collect
 
 
+    def _preorder(self,include_condition=None,cur_node=None):
+        """
+        Return branches in pre-order (same order as `traverse_tree()`) without recursion and without modifying them.
+        """
+        if cur_node==None: cur_node=self.root
+        collect=[]
+        stack=[cur_node]
+        while stack:
+            k=stack.pop()
+            if include_condition==None or include_condition(k):
+                collect.append(k)
+            if k.is_node():
+                stack.extend(reversed(k.children))
+        return collect
+
+    def _markDirty(self,k):
+        """
+        Remember that the subtree starting at a branch was changed and its structure (heights, descendant tips, child heights) has to be updated.
+        """
+        if not hasattr(self,'_dirty'): self._dirty=[]
+        self._dirty.append(k)
+
+    def _refreshNode(self,k):
+        """
+        Recompute the descendant tips and height of the youngest descendant of a node from its children.
+        """
+        assert len(k.children)>0, 'Tried traversing through hanging node without children. Index: %s'%(k.index)
+        leaves=set()
+        for child in k.children:
+            if child.is_leaf():
+                leaves.add(child.name)
+            elif child.is_node():
+                leaves.update(child.leaves)
+        k.leaves=leaves
+        k.childHeight=max([child.childHeight if child.is_node() else child.height for child in k.children])
+
+    def _refreshStructure(self):
+        """
+        Update heights, descendant tips and child heights after the branches marked with `_markDirty()` have changed.
+
+        Only the subtrees of changed branches and the paths from them to the root are visited, the resulting state is the same as after a full `traverse_tree()`.
+        """
+        dirty=list(dict.fromkeys(getattr(self,'_dirty',[])))
+        self._dirty=[]
+
+        if self.root in dirty:
+            starts=[self.root]
+        else:
+            dirty_set=set(dirty)
+            starts=[]
+            for k in dirty:
+                cur_node=k.parent
+                while cur_node!=None and cur_node!=self.root and cur_node not in dirty_set:
+                    cur_node=cur_node.parent
+                if cur_node==self.root: ## branch is still in the tree and not within another changed subtree
+                    starts.append(k)
+
+        for start in starts: ## update subtrees of changed branches
+            subtree=self._preorder(cur_node=start)
+            for k in subtree:
+                if k==start:
+                    k.height=k.parent.height+k.length if k.parent else 0.0
+                else:
+                    k.height=k.parent.height+k.length
+            for k in reversed(subtree):
+                if k.is_node():
+                    self._refreshNode(k)
+
+        depths={} ## nodes on the paths from changed branches to the root and their distance from the root
+        for start in starts:
+            path=[]
+            cur_node=start.parent if start!=self.root else None
+            while cur_node!=None and cur_node not in depths:
+                path.append(cur_node)
+                if cur_node==self.root: break
+                cur_node=cur_node.parent
+            base=depths[cur_node] if cur_node in depths else -1
+            for i,k in enumerate(reversed(path)):
+                depths[k]=base+1+i
+        for k in sorted(depths,key=lambda w: -depths[w]): ## update nodes after their children
+            self._refreshNode(k)
+
+        if self.root.is_node():
+            self.treeHeight=self.root.childHeight
+
     def renameTips(self,d=None):
         """
         Rename each tip using a dictionary.
@@ -635,6 +1677,7 @@ class tree: ## tree class
         for k in self.getExternal(): ## iterate through leaf objects in tree
             # k.name=d[k.numName] ## change its name
             k.name=d[k.name] ## change its name
+        self._branchCache().pop('names',None) ## name lookup table has to be rebuilt
 
     def sortBranches(self,descending=True,sort_function=None,sortByHeight=True):
         """
@@ -691,7 +1734,8 @@ class tree: ## tree class
         Docstring generated with ChatGPT 4o.
         """
         if order==None:
-            order=self.traverse_tree(include_condition=lambda k: k.is_leaflike()) ## order is a list of tips recovered from a tree traversal to make sure they're plotted in the correct order along the vertical tree dimension
+            if self.root.height==None: self.traverse_tree() ## tree has not been traversed yet, heights are needed for x coordinates
+            order=self._preorder(lambda k: k.is_leaflike()) ## order is a list of tips recovered from a tree traversal to make sure they're plotted in the correct order along the vertical tree dimension
             if verbose==True: print('Drawing tree in pre-order')
         else:
             if verbose==True: print('Drawing tree with provided order')
@@ -705,15 +1749,22 @@ class tree: ## tree class
         else:
             skips=list(map(width_function,order))
 
+        self._dropSpatialIndex() ## coordinates are about to change
         for k in self.Objects: ## reset coordinates for all objects
             k.x=None
             k.y=None
 
         drawn={} ## drawn keeps track of what's been drawn
+        cumulative_skips=[0]*len(skips) ## sum of skips from each tip to the last one
+        total=0
+        for y_idx in range(len(skips)-1,-1,-1):
+            total+=skips[y_idx]
+            cumulative_skips[y_idx]=total
+
         for k in order: ## iterate over tips
             x=k.height ## x position is height
             y_idx=name_order[k.name] ## assign y index
-            y=sum(skips[y_idx:])-skips[y_idx]/2.0 ## sum across skips to find y position
+            y=cumulative_skips[y_idx]-skips[y_idx]/2.0 ## sum across skips to find y position
 
             k.x=x ## set x and y coordinates
             k.y=y
@@ -736,23 +1787,19 @@ class tree: ## tree class
                 k.y-=minY-0.5
 
         assert len([k for k in self.Objects if k.is_leaflike()])==len(order),'Number of tips in tree does not match number of unique tips, check if two or more collapsed clades were assigned the same name.'
+
+        internal=set(self.getInternal())
+        for k in reversed(self._preorder(lambda k: k.is_node())): ## visit nodes after all of their descendants
+            if k not in internal or k.index in drawn or any(q.y==None for q in k.children): continue
+            self._drawNode(k,drawn,verbose)
+
         storePlotted=0
 
         while len(drawn)!=len(self.Objects): # keep drawing the tree until everything is drawn
             if verbose==True: print('Drawing iteration %d'%(len(drawn)))
             for k in filter(lambda w:w.index not in drawn,self.getInternal()): ## iterate through internal nodes that have not been drawn
                 if len([q.y for q in k.children if q.y!=None])==len(k.children): ## all y coordinates of children known
-                    if verbose==True: print('Setting node %s coordinates to'%(k.index)),
-                    x=k.height ## x position is height
-                    children_y_coords=[q.y for q in k.children if q.y!=None] ## get all existing y coordinates of the node
-                    y=sum(children_y_coords)/float(len(children_y_coords)) ## internal branch is in the middle of the vertical bar
-                    k.x=x
-                    k.y=y
-                    drawn[k.index]=None ## remember that this objects has been drawn
-                    if verbose==True: print('%s (%s branches drawn)'%(k.y,len(drawn)))
-                    minYrange=min([min(child.yRange) if child.is_node() else child.y for child in k.children]) ## get lowest y coordinate across children
-                    maxYrange=max([max(child.yRange) if child.is_node() else child.y for child in k.children]) ## get highest y coordinate across children
-                    setattr(k,'yRange',[minYrange,maxYrange]) ## assign the maximum extent of children's y coordinates
+                    self._drawNode(k,drawn,verbose)
 
             if len(self.Objects)>len(drawn):
                 assert len(drawn)>storePlotted,'Got stuck trying to find y positions of objects (%d branches drawn this iteration, %d branches during previous iteration out of %d total)'%(len(drawn),storePlotted,len(self.Objects))
@@ -768,16 +1815,33 @@ class tree: ## tree class
         else:
             self.root.x=self.root.length
 
+    def _drawNode(self,k,drawn,verbose=False):
+        """
+        Set x and y coordinates of a node whose children have been drawn.
+        """
+        if verbose==True: print('Setting node %s coordinates to'%(k.index)),
+        x=k.height ## x position is height
+        children_y_coords=[q.y for q in k.children if q.y!=None] ## get all existing y coordinates of the node
+        y=sum(children_y_coords)/float(len(children_y_coords)) ## internal branch is in the middle of the vertical bar
+        k.x=x
+        k.y=y
+        drawn[k.index]=None ## remember that this objects has been drawn
+        if verbose==True: print('%s (%s branches drawn)'%(k.y,len(drawn)))
+        minYrange=min([min(child.yRange) if child.is_node() else child.y for child in k.children]) ## get lowest y coordinate across children
+        maxYrange=max([max(child.yRange) if child.is_node() else child.y for child in k.children]) ## get highest y coordinate across children
+        setattr(k,'yRange',[minYrange,maxYrange]) ## assign the maximum extent of children's y coordinates
+
     def drawUnrooted(self,rotate=0.0,n=None,total=None):
         """
         Calculate x and y coordinates of each branch in an unrooted arrangement.
         
-        This method arranges the branches of the tree in an unrooted, circular layout.
-        The coordinates are calculated recursively for each node.
+        This method arranges the branches of the tree in an unrooted, circular layout (equal-angle).
+        Every branch gets a wedge of angles proportional to the number of tips it subtends. Branches are listed once in pre-order, after which wedges, angles and coordinates are computed for all branches with cumulative sums over the subtrees in that order.
+        The angle at which each branch's wedge starts is stored in the branch's `tau` attribute.
         
         Parameters:
         rotate (float): The initial rotation angle in radians. Default is 0.0.
-        n (node or None): The current node being processed. If None, starts from the root. Default is None.
+        n (node or None): The node from which to start (using its `tau`). If None, starts from the root. Default is None.
         total (int or None): The total number of tips or the sum of widths for clades. Default is None.
         
         Code translated from https://github.com/nextstrain/auspice/commit/fc50bbf5e1d09908be2209450c6c3264f298e98c, written by Richard Neher.
@@ -789,30 +1853,64 @@ class tree: ## tree class
         """
 
         if n==None:
+            self._dropSpatialIndex() ## coordinates are about to change
             total=sum([1 if x.is_leaf() else x.width+1 for x in self.getExternal()])
             n=self.root#.children[0]
-            for k in self.Objects:
-                k.traits['tau']=2*math.pi*rotate
-                k.x=0.0
-                k.y=0.0
-
-        w=2*math.pi*1.0/float(total) if n.is_leaf() else 2*math.pi*len(n.leaves)/float(total)
+            n.tau=2*math.pi*rotate
 
-        if n.parent.x==None:
+        if n.parent!=None and n.parent.x==None:
             n.parent.x=0.0
             n.parent.y=0.0
-
-        n.x = n.parent.x + n.length * math.cos(n.traits['tau'] + w*0.5)
-        n.y = n.parent.y + n.length * math.sin(n.traits['tau'] + w*0.5)
-        eta=n.traits['tau']
-
-        if n.is_node():
-            for ch in n.children:
-                w=2*math.pi*1.0/float(total) if ch.is_leaf() else 2*math.pi*len(ch.leaves)/float(total)
-
-                ch.traits['tau'] = eta
-                eta += w
-                self.drawUnrooted(rotate,ch,total)
+        origin=(n.parent.x,n.parent.y) if n.parent!=None else (0.0,0.0)
+
+        order=[] ## branches in pre-order, with the position of their parent in it
+        parents=[]
+        lengths=[]
+        widths=[] ## tips subtended by leaf-like branches
+        stack=[(n,-1)]
+        while stack:
+            k,p=stack.pop()
+            parents.append(p)
+            lengths.append(k.length)
+            if k.is_node():
+                i=len(order)
+                stack.extend([(ch,i) for ch in reversed(k.children)])
+                widths.append(0.0)
+            else:
+                widths.append(1.0 if k.is_leaf() else len(k.leaves))
+            order.append(k)
+        N=len(order)
+
+        ends=list(range(1,N+1)) ## position after the last descendant of each branch
+        for i in range(N-1,0,-1): ## descendants come after their ancestors
+            p=parents[i]
+            if ends[i]>ends[p]: ends[p]=ends[i]
+        ends=np.array(ends)
+        parents=np.array(parents)
+
+        def pathSums(values): ## sum of values along the path from n to each branch, added at the start and removed after the end of each subtree
+            delta=np.bincount(np.arange(N),weights=values,minlength=N+1)-np.bincount(ends,weights=values,minlength=N+1)
+            return np.cumsum(delta)[:N]
+
+        tips=np.r_[0.0,np.cumsum(widths)]
+        wedges=(tips[ends]-tips[:N])*2*math.pi/float(total) ## angle taken up by each branch, proportional to the tips in its subtree
+        children=np.flatnonzero(parents>=0)
+        grouped=children[np.argsort(parents[children],kind='stable')] ## siblings together, in the order of their parent's children
+        preceding=np.cumsum(wedges[grouped])-wedges[grouped] ## wedges before each child across all groups
+        first=np.r_[True,parents[grouped][1:]!=parents[grouped][:-1]]
+        offsets=np.zeros(N)
+        offsets[grouped]=preceding-preceding[first][np.cumsum(first)-1] ## children split their parent's wedge in order
+        taus=n.tau+pathSums(offsets)
+
+        angles=taus+wedges*0.5
+        lengths=np.array(lengths,dtype=float)
+        xs=origin[0]+pathSums(lengths*np.cos(angles))
+        ys=origin[1]+pathSums(lengths*np.sin(angles))
+
+        for k,tau,x,y in zip(order,taus.tolist(),xs.tolist(),ys.tolist()):
+            k.tau=tau
+            k.x=x
+            k.y=y
 
     def commonAncestor(self,descendants):
         """
@@ -822,7 +1920,7 @@ class tree: ## tree class
         descendants (list): A list of descendant branches (as `node`, `leaf`, `clade` and/or `reticulation` classes) for which to find the most recent common ancestor.
         
         Returns:
-        node: The most recent common ancestor node.
+        node: The most recent common ancestor node. Paths to the root stop at the root, so the placeholder parent of the root (which has the same height) is never returned.
         
         Raises:
         AssertionError: If the number of descendants is less than 2.
@@ -838,6 +1936,7 @@ class tree: ## tree class
             cur_node=k ## start descent from descendant
             while cur_node: ## while not at root
                 paths_to_root[k.index].add(cur_node) ## remember every node visited along the way
+                if cur_node==self.root: break ## the placeholder parent of root has the same height as root
                 cur_node=cur_node.parent ## descend
 
         return sorted(reduce(set.intersection,paths_to_root.values()),key=lambda k: k.height)[-1] ## return the most recent branch that is shared across all paths to root
@@ -845,6 +1944,7 @@ class tree: ## tree class
     def collapseSubtree(self,cl,givenName,verbose=False,widthFunction=lambda k:len(k.leaves)):
         """
         Collapse an entire subtree into a clade object.
+        Heights, descendant tips and child heights are only updated along the path from the clade to the root, but branches are then sorted and drawn again across the whole tree (see `sortBranches()`), since y positions of all tips can change.
         
         Parameters:
         cl (node): The node representing the root of the subtree to collapse.
@@ -893,7 +1993,9 @@ class tree: ## tree class
         collapsedClade.parent=parent
         if self.tipMap!=None: self.tipMap[givenName]=givenName
 
-        self.traverse_tree()
+        self._invalidate()
+        self._markDirty(collapsedClade)
+        self._refreshStructure() ## only the path from the collapsed clade to the root changes
         self.sortBranches()
         return collapsedClade
 
@@ -904,6 +2006,7 @@ class tree: ## tree class
         This method restores all previously collapsed clades back to their original subtree structures.
         It iterates through all objects in the tree, identifies clades, and replaces each clade with its
         corresponding subtree that was stored in the `clade` class.
+        Only the restored subtrees and their paths to the root are traversed again. The tree is not sorted or drawn, call `sortBranches()` or `drawTree()` afterwards to update x and y positions.
         
         Example:
         >>> tree.uncollapseSubtree()
@@ -919,9 +2022,11 @@ class tree: ## tree class
                 parent.children.append(subtree[0])
                 self.Objects+=subtree
                 self.Objects.remove(cl)
+                self._markDirty(subtree[0])
                 if self.tipMap!=None:
                     self.tipMap.pop(cl.name,None)
-        self.traverse_tree()
+        self._invalidate()
+        self._refreshStructure() ## only restored subtrees and their paths to the root change
 
     def collapseBranches(self,collapseIf=lambda x:x.traits['posterior']<=0.5,designated_nodes=[],verbose=False):
         """
@@ -984,19 +2089,21 @@ class tree: ## tree class
                     nodes_to_delete=[w for w in newTree.Objects if w.index in [q.index for q in designated_nodes]]
 
                 if verbose==True: print('Removing references to node %s'%(k.index))
+        newTree._invalidate()
         newTree.sortBranches() ## sort the tree to traverse, draw and sort tree to adjust y coordinates
         return newTree ## return collapsed tree
 
     def toString(self,cur_node=None,traits=None,verbose=False,nexus=False,string_fragment=None,traverse_condition=None,rename=None,quotechar="'",json=False):
         """
         Output the topology of the tree with branch lengths and comments to a string.
+        Use writeNewick() or writeNexus() to write large trees straight to a file.
         
         Parameters:
         cur_node (node or None): The starting point for traversal. Default is None, which starts at the root.
         traits (list or None): A list of keys to output entries in the traits dictionary of each branch. Default is all available traits.
         verbose (bool): If True, prints verbose output during the process. Default is False.
         nexus (bool): If True, outputs in NEXUS format. Default is False, which outputs in Newick format.
-        string_fragment (list or None): A list of characters that comprise the tree string. Default is None.
+        string_fragment (list or None): A list to which fragments of the tree string are appended. Default is None.
         traverse_condition (function or None): A function that determines whether a child branch should be traversed. Default is None which traverses all children.
         rename (dict or None): A dictionary to rename tip names. Default is None.
         quotechar (str): The character to use for quoting tip names. Default is "'".
@@ -1010,78 +2117,208 @@ class tree: ## tree class
         
         Docstring generated with ChatGPT 4o.
         """
-        if cur_node==None: cur_node=self.root#.children[-1]
-        if traits==None: traits=set(sum([list(k.traits.keys()) for k in self.Objects],[])) ## fetch all trait keys
         if string_fragment==None:
             string_fragment=[]
             if nexus:
                 assert not json,'Nexus format not a valid option for JSON output'
                 if verbose==True: print('Exporting to NEXUS format')
                 string_fragment.append('#NEXUS\nBegin trees;\ntree TREE1 = [&R] ')
-        if traverse_condition==None: traverse_condition=lambda k: True
+        self._streamNewick(string_fragment.append,cur_node=cur_node,traits=traits,traverse_condition=traverse_condition,rename=rename,quotechar=quotechar)
+        if nexus==True:
+            string_fragment.append('\nEnd;')
+        if verbose==True: print('finished')
+        return ''.join(string_fragment)
+
+    def _traitKeys(self,branches=None):
+        """
+        Return the union of trait keys across branches in the order they are first encountered.
+        """
+        keys={}
+        for k in (self.Objects if branches==None else branches):
+            keys.update(dict.fromkeys(k.traits))
+        return list(keys)
 
-        comment=[] ## will hold comment
-        if len(traits)>0: ## non-empty list of traits to output
-            for tr in traits: ## iterate through keys
-                if tr in cur_node.traits: ## if key is available
-                    if verbose==True: print('trait %s available for %s (%s) type: %s'%(tr,cur_node.index,cur_node.branchType,type(cur_node.traits[tr])))
-                    if isinstance(cur_node.traits[tr],str): ## string value
-                        comment.append('%s="%s"'%(tr,cur_node.traits[tr]))
-                        if verbose==True: print('adding string comment %s'%(comment[-1]))
-                    elif isinstance(cur_node.traits[tr],float) or isinstance(cur_node.traits[tr],int): ## float or integer
-                        comment.append('%s=%s'%(tr,cur_node.traits[tr]))
-                        if verbose==True: print('adding numeric comment %s'%(comment[-1]))
-                    elif isinstance(cur_node.traits[tr],list): ## lists
-                        rangeComment=[]
-                        for val in cur_node.traits[tr]:
-                            if isinstance(val,str): ## string
-                                rangeComment.append('"%s"'%(val))
-                            elif isinstance(val,float) or isinstance(val,int): ## float or integer
-                                rangeComment.append('%s'%(val))
-                            elif isinstance(val, list): ## list of lists, example complete history annotated on tree
-                                rangeComment.append("{{{}}}".format(",".join(val)))
-                        comment.append('%s={%s}'%(tr,','.join(rangeComment)))
-                        if verbose==True: print('adding range comment %s'%(comment[-1]))
-                elif verbose==True: print('trait %s unavailable for %s (%s)'%(tr,cur_node.index,cur_node.branchType))
-
-        if cur_node.is_node():
-            if verbose==True: print('node: %s'%(cur_node.index))
-            string_fragment.append('(')
-            traverseChildren=list(filter(traverse_condition,cur_node.children))
-            assert len(traverseChildren)>0,'Node %s does not have traversable children'%(cur_node.index)
-            for c,child in enumerate(traverseChildren): ## iterate through children of node if they satisfy traverse condition
-                if verbose==True: print('moving to child %s of node %s'%(child.index,cur_node.index))
-                self.toString(cur_node=child,traits=traits,verbose=verbose,nexus=nexus,string_fragment=string_fragment,traverse_condition=traverse_condition,rename=rename,quotechar=quotechar)
-                if (c+1)<len(traverseChildren): ## not done with children, add comma for next iteration
-                    string_fragment.append(',')
-            string_fragment.append(')') ## last child, node terminates
-
-        elif cur_node.is_leaf():
-            if rename==None:
-                treeName=cur_node.name ## designated numName
+    def _streamNewick(self,write,cur_node=None,traits=None,traverse_condition=None,rename=None,quotechar="'"):
+        """
+        Pass fragments of a newick string (with annotations in comments) for the tree below a branch to a write function, without recursion.
+        """
+        if cur_node==None: cur_node=self.root
+        if traits==None: traits=self._traitKeys() ## fetch all trait keys
+        if traverse_condition==None: traverse_condition=lambda k: True
+        if rename!=None: assert isinstance(rename,dict), 'Variable "rename" is not a dictionary'
+
+        formatters={} ## remember how each type of value is formatted
+        def formatter(value):
+            kind=type(value)
+            if kind not in formatters:
+                if isinstance(value,str): ## string value
+                    formatters[kind]=lambda tr,v: '%s="%s"'%(tr,v)
+                elif isinstance(value,(float,int)): ## float or integer
+                    formatters[kind]=lambda tr,v: '%s=%s'%(tr,v)
+                elif isinstance(value,list): ## lists
+                    formatters[kind]=lambda tr,v: '%s={%s}'%(tr,','.join(formatRange(val) for val in v if isinstance(val,(str,float,int,list))))
+                else: ## other types are not exported
+                    formatters[kind]=None
+            return formatters[kind]
+
+        def formatRange(val):
+            if isinstance(val,str): return '"%s"'%(val) ## string
+            if isinstance(val,list): return "{{{}}}".format(",".join(val)) ## list of lists, example complete history annotated on tree
+            return '%s'%(val) ## float or integer
+
+        def annotation(k): ## comment and branch length that follow a branch
+            comment=[]
+            for tr in traits:
+                if tr in k.traits:
+                    value=k.traits[tr]
+                    f=formatter(value)
+                    if f!=None: comment.append(f(tr,value))
+            if len(comment)>0:
+                return '[&%s]:%8f'%(','.join(comment),k.length)
+            return ':%8f'%(k.length)
+
+        stack=[cur_node]
+        while stack:
+            k=stack.pop()
+            if isinstance(k,str): ## separator between children
+                write(k)
+            elif isinstance(k,tuple): ## all children of node written
+                write(')')
+                write(annotation(k[0]))
+            elif k.is_node():
+                traverseChildren=list(filter(traverse_condition,k.children))
+                assert len(traverseChildren)>0,'Node %s does not have traversable children'%(k.index)
+                write('(')
+                stack.append((k,)) ## close node after its children
+                for c in range(len(traverseChildren)-1,-1,-1):
+                    stack.append(traverseChildren[c])
+                    if c>0: stack.append(',')
             else:
-                assert isinstance(rename,dict), 'Variable "rename" is not a dictionary'
-                assert cur_node.name in rename, 'Tip name %s not in rename dictionary'%(cur_node.name)
-                treeName=rename[cur_node.name]
+                if k.is_leaf():
+                    if rename==None:
+                        treeName=k.name ## designated numName
+                    else:
+                        assert k.name in rename, 'Tip name %s not in rename dictionary'%(k.name)
+                        treeName=rename[k.name]
+                    write("%s%s%s"%(quotechar,treeName,quotechar))
+                write(annotation(k))
+        write(';')
+
+    def writeNewick(self,fh,cur_node=None,traits=None,traverse_condition=None,rename=None,quotechar="'"):
+        """
+        Write the tree in newick format, with traits as comments, to a file without building the tree string in memory.
 
-            if verbose==True: print('leaf: %s (%s)'%(cur_node.index,treeName))
-            string_fragment.append("%s%s%s"%(quotechar,treeName,quotechar))
+        Parameters:
+        fh (str or file): Path of the output file or an open text file handle.
+        cur_node (node or None): The starting point for traversal. Default is None, which starts at the root.
+        traits (list or None): A list of keys to output entries in the traits dictionary of each branch. Default is all available traits.
+        traverse_condition (function or None): A function that determines whether a child branch should be traversed. Default is None which traverses all children.
+        rename (dict or None): A dictionary to rename tip names. Default is None.
+        quotechar (str): The character to use for quoting tip names. Default is "'".
+
+        Returns:
+        None
+
+        Example:
+        >>> with open('tree.nwk','w') as fh: tree.writeNewick(fh, traits=['posterior'])
+        """
+        handle=open(fh,'w') if isinstance(fh,str) else fh
+        write,flush=_bufferedWriter(handle)
+        self._streamNewick(write,cur_node=cur_node,traits=traits,traverse_condition=traverse_condition,rename=rename,quotechar=quotechar)
+        write('\n')
+        flush()
+        if isinstance(fh,str): handle.close()
+
+    def writeNexus(self,fh,cur_node=None,traits=None,traverse_condition=None,rename=None,quotechar="'",tree_name='TREE1'):
+        """
+        Write the tree in NEXUS format, with traits as comments, to a file without building the tree string in memory.
+
+        Parameters:
+        fh (str or file): Path of the output file or an open text file handle.
+        cur_node (node or None): The starting point for traversal. Default is None, which starts at the root.
+        traits (list or None): A list of keys to output entries in the traits dictionary of each branch. Default is all available traits.
+        traverse_condition (function or None): A function that determines whether a child branch should be traversed. Default is None which traverses all children.
+        rename (dict or None): A dictionary to rename tip names. Default is None.
+        quotechar (str): The character to use for quoting tip names. Default is "'".
+        tree_name (str): Name of the tree in the trees block. Default is 'TREE1'.
+
+        Returns:
+        None
+
+        Example:
+        >>> tree.writeNexus('tree.nex')
+        """
+        handle=open(fh,'w') if isinstance(fh,str) else fh
+        write,flush=_bufferedWriter(handle)
+        write('#NEXUS\nBegin trees;\ntree %s = [&R] '%(tree_name))
+        self._streamNewick(write,cur_node=cur_node,traits=traits,traverse_condition=traverse_condition,rename=rename,quotechar=quotechar)
+        write('\nEnd;\n')
+        flush()
+        if isinstance(fh,str): handle.close()
+
+    def writeAuspiceJSON(self,fh,meta=None,node_attrs=None,cur_node=None):
+        """
+        Write the tree as an auspice v2 JSON without building the nested dictionary in memory.
+        Branch heights are written as divergence (`div`) and absolute times as `num_date`, so that the output can be read back with `loadJSON()`.
 
-        if len(comment)>0:
-            if verbose==True: print('adding comment to %s'%(cur_node.index))
-            comment=','.join(comment)
-            comment='[&'+comment+']'
-            string_fragment.append('%s'%(comment)) ## end of node, add annotations
+        Parameters:
+        fh (str or file): Path of the output file or an open text file handle.
+        meta (dict or None): The `meta` section of the JSON. Default is None, which writes colorings for categorical colour maps in `tree.cmap` (if any, e.g. from `loadJSON()`).
+        node_attrs (list or None): Trait keys to write as node attributes (`{"value": ...}`, with confidence taken from `<key>_confidence` traits). Default is None, which writes all traits with string, number or boolean values.
+        cur_node (node or None): The starting point for traversal. Default is None, which starts at the root.
 
-        if verbose==True: print('adding branch length to %s'%(cur_node.index))
-        string_fragment.append(':%8f'%(cur_node.length)) ## end of node, add branch length
+        Returns:
+        None
 
-        if cur_node==self.root:#.children[-1]:
-            string_fragment.append(';')
-            if nexus==True:
-                string_fragment.append('\nEnd;')
-            if verbose==True: print('finished')
-            return ''.join(string_fragment)
+        Example:
+        >>> tree.writeAuspiceJSON('tree.json', node_attrs=['country','clade'])
+        >>> ll,meta = loadJSON('tree.json')
+        """
+        if cur_node==None: cur_node=self.root
+        if meta==None:
+            meta={'colorings': [{'key': key,'type': 'categorical','scale': [[value,colour] for value,colour in scale.items()]} for key,scale in getattr(self,'cmap',{}).items()],
+                  'panels': ['tree']}
+        reserved=['name','node_attrs','branch_attrs','div','num_date','divergence']
+        if node_attrs!=None: node_attrs=[key for key in node_attrs if key not in reserved]
+
+        def attributes(k): ## node_attrs of a branch
+            entries=[]
+            if k.height!=None: entries.append('"div": %s'%(json.dumps(k.height)))
+            if k.absoluteTime!=None:
+                value={'value': k.absoluteTime}
+                if 'num_date_confidence' in k.traits: value['confidence']=k.traits['num_date_confidence']
+                entries.append('"num_date": %s'%(json.dumps(value)))
+            keys=node_attrs if node_attrs!=None else [key for key in k.traits if key not in reserved and not key.endswith('_confidence') and isinstance(k.traits[key],(str,int,float,bool))]
+            for key in keys:
+                if key in k.traits:
+                    value={'value': k.traits[key]}
+                    if '%s_confidence'%(key) in k.traits: value['confidence']=k.traits['%s_confidence'%(key)]
+                    entries.append('%s: %s'%(json.dumps(key),json.dumps(value)))
+            return '{%s}'%(', '.join(entries))
+
+        handle=open(fh,'w') if isinstance(fh,str) else fh
+        write,flush=_bufferedWriter(handle)
+        write('{"version": "v2", "meta": %s, "tree": '%(json.dumps(meta)))
+
+        stack=[cur_node]
+        while stack:
+            k=stack.pop()
+            if isinstance(k,str): ## separators and closing brackets
+                write(k)
+                continue
+            name=k.name if k.is_leaflike() and k.name!=None else k.traits.get('name','NODE_%s'%(k.index))
+            write('{"name": %s, "node_attrs": %s'%(json.dumps(name),attributes(k)))
+            if k.is_node():
+                write(', "children": [')
+                stack.append(']}')
+                for c in range(len(k.children)-1,-1,-1):
+                    stack.append(k.children[c])
+                    if c>0: stack.append(', ')
+            else:
+                write('}')
+        write('}\n')
+        flush()
+        if isinstance(fh,str): handle.close()
 
     def allTMRCAs(self):
         """
@@ -1152,6 +2389,7 @@ class tree: ## tree class
         embedding=set(embedding) ## prune down to only unique branches
 
         reduced_tree.Objects=sorted(list(embedding),key=lambda x:x.height) ## assign branches that are kept to new tree's Objects
+        reduced_tree._invalidate()
         if verbose==True: print("Pruning untraversed lineages")
         for k in reduced_tree.getInternal(): ## iterate through reduced tree
             k.children = [c for c in k.children if c in embedding] ## only keep children that are present in lineage traceback
@@ -1160,7 +2398,8 @@ class tree: ## tree class
         reduced_tree.fixHangingNodes()
 
         if verbose==True: print("Last traversal and branch sorting")
-        reduced_tree.traverse_tree() ## traverse
+        reduced_tree._markDirty(reduced_tree.root) ## every remaining node may have lost descendants
+        reduced_tree._refreshStructure() ## traverse
         reduced_tree.sortBranches() ## sort
 
         return reduced_tree ## return new tree
@@ -1184,6 +2423,103 @@ class tree: ## tree class
         """
         return len([k for k in self.Objects if getattr(k.parent,attr)!=None and getattr(k.parent,attr)<t<=getattr(k,attr) and condition(k)])
 
+    def buildIntervalIndex(self,attr='absoluteTime',condition=None):
+        """
+        Build an index over branch spans (parent position to branch position) for repeated time-slice queries.
+
+        Parameters:
+        attr (str): The attribute used to determine the time of branches. Default is `absoluteTime`.
+        condition (function or None): A function that determines whether a branch should be indexed. Default is None, which indexes all branches.
+
+        Returns:
+        intervalIndex: An index answering which branches are present at a time point (`stab()`), within a window (`window()`) or how many there are (`count()`).
+                       Indices returned by the index refer to positions in the list of branches it was built from (`self.Objects` when no condition is given).
+
+        Note:
+        - The index is a snapshot, it has to be rebuilt if the tree is modified or placed in time again.
+
+        Example:
+        >>> idx = tree.buildIntervalIndex()
+        >>> alive = idx.stab(2020.5)
+        >>> states = [k.traits['location'] for k in idx.stab(2020.5)]
+        """
+        branches=self.Objects if condition is None else list(filter(condition,self.Objects))
+        return intervalIndex(branches,attr=attr)
+
+    def _layoutSegments(self,layout,circStart=0.0,circFrac=1.0,inwardSpace=0.0,normaliseHeight=None,precision=15):
+        """
+        Return line segments of a drawn tree (as an array of shape (n,2,2)) and positions in `Objects` of the branches they belong to.
+        Rectangular and circular layouts match plotTree() and plotCircularTree(), the unrooted layout connects branches to their parents.
+        """
+        positions=np.arange(len(self.Objects))
+        parents=self._plotParents(positions)
+        position={k: i for i,k in enumerate(self.Objects)}
+        nodes=np.array([i for i,k in enumerate(self.Objects) if k.is_node()],dtype=int)
+        first=np.array([position[self.Objects[i].children[0]] for i in nodes],dtype=int)
+        last=np.array([position[self.Objects[i].children[-1]] for i in nodes],dtype=int)
+
+        if layout=='circular':
+            radii,angles=self._circularCoordinates(None,None,circStart,circFrac,inwardSpace,normaliseHeight)
+            rp=np.where(parents>=0,radii[parents],radii)
+            X,Y=np.sin(angles),np.cos(angles)
+            stems=np.stack([np.stack([X*rp,Y*rp],axis=-1),np.stack([X*radii,Y*radii],axis=-1)],axis=1)
+            arc=angles[first][:,None]+(angles[last]-angles[first])[:,None]*np.linspace(0.0,1.0,precision)[None,:]
+            points=np.stack([np.sin(arc)*radii[nodes][:,None],np.cos(arc)*radii[nodes][:,None]],axis=-1)
+            arcs=np.stack([points[:,:-1],points[:,1:]],axis=2).reshape(-1,2,2)
+            return np.concatenate([stems,arcs]),np.concatenate([positions,np.repeat(nodes,precision-1)])
+
+        xs=self._plotCoordinates(None,'x')
+        ys=self._plotCoordinates(None,'y')
+        xp=np.where(parents>=0,xs[parents],np.nan)
+        if layout=='unrooted':
+            yp=np.where(parents>=0,ys[parents],np.nan)
+            return np.stack([np.stack([xp,yp],axis=-1),np.stack([xs,ys],axis=-1)],axis=1),positions
+
+        stems=np.stack([np.stack([xp,ys],axis=-1),np.stack([xs,ys],axis=-1)],axis=1)
+        bars=np.stack([np.stack([xs[nodes],ys[first]],axis=-1),np.stack([xs[nodes],ys[last]],axis=-1)],axis=1)
+        return np.concatenate([stems,bars]),np.concatenate([positions,nodes])
+
+    def buildSpatialIndex(self,layout='rectangular',**kwargs):
+        """
+        Build (or reuse) a grid index over the segments of the drawn tree for nearest-branch and box-selection queries.
+
+        Parameters:
+        layout (str): 'rectangular' (coordinates from drawTree(), as plotted by plotTree()), 'circular' (as plotted by plotCircularTree()) or 'unrooted' (coordinates from drawUnrooted()). Default is 'rectangular'.
+        **kwargs: circStart, circFrac, inwardSpace, normaliseHeight and precision for the circular layout, see plotCircularTree().
+
+        Returns:
+        spatialIndex: An index with `nearest()` and `select()` queries. Indices returned by the index refer to positions in `self.Objects`.
+
+        Note:
+        - The index is kept until the tree is drawn again (drawTree() or drawUnrooted()) or modified, repeated calls return the same index.
+
+        Example:
+        >>> idx = tree.buildSpatialIndex()
+        >>> branch,distance = idx.nearest(2015.3, 120.0)
+        >>> selected = idx.select(2014.0, 50.0, 2015.0, 80.0)
+        """
+        assert layout in ['rectangular','circular','unrooted'],'Unrecognised layout "%s"'%(layout)
+        cache=self._branchCache()
+        try:
+            key=('spatial',layout,tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError: ## arguments can't be remembered, always build a new index
+            key=None
+        if key is None or key not in cache:
+            segments,owners=self._layoutSegments(layout,**kwargs)
+            index=spatialIndex(self.Objects,segments,owners,layout=layout)
+            if key is None: return index
+            cache[key]=index
+        return cache[key]
+
+    def _dropSpatialIndex(self):
+        """
+        Forget spatial indices after branch coordinates have changed.
+        """
+        cache=self._branchCache()
+        for key in [key for key in cache if isinstance(key,tuple) and key[0]=='spatial']:
+            del cache[key]
+
     def getExternal(self,secondFilter=None):
         """
         Get all leaf-like branches (`leaf`, `clade`, and `reticulation` classes).
@@ -1194,13 +2530,19 @@ class tree: ## tree class
         Returns:
         list: A list of leaf branches that optionally satisfy the secondFilter condition.
         
+        Note:
+        - The unfiltered list is cached and rebuilt after `Objects` or the topology of the tree change.
+        
         Example:
         >>> leaves = tree.getExternal()
         >>> filtered_leaves = tree.getExternal(lambda x: x.absoluteTime >= 2023.0)
         
         Docstring generated with ChatGPT 4o.
         """
-        externals=list(filter(secondFilter,filter(lambda k: k.is_leaflike(),self.Objects)))
+        cache=self._branchCache()
+        if 'external' not in cache:
+            cache['external']=[k for k in self.Objects if k.is_leaflike()]
+        externals=list(filter(secondFilter,cache['external'])) if secondFilter else list(cache['external'])
         return externals
 
     def getInternal(self,secondFilter=None):
@@ -1213,13 +2555,19 @@ class tree: ## tree class
         Returns:
         list: A list of node branches that optionally satisfy the secondFilter condition.
         
+        Note:
+        - The unfiltered list is cached and rebuilt after `Objects` or the topology of the tree change.
+        
         Example:
         >>> nodes = tree.getInternal()
         >>> filtered_nodes = tree.getInternal(lambda x: x.absoluteTime >= 2023.0)
         
         Docstring generated with ChatGPT 4o.
         """
-        internals=list(filter(secondFilter,filter(lambda k: k.is_node(),self.Objects)))
+        cache=self._branchCache()
+        if 'internal' not in cache:
+            cache['internal']=[k for k in self.Objects if k.is_node()]
+        internals=list(filter(secondFilter,cache['internal'])) if secondFilter else list(cache['internal'])
         return internals
 
     def getBranches(self,attrs=lambda x:True,warn=True):
@@ -1253,7 +2601,119 @@ class tree: ## tree class
         else:
             return select
 
-    def getParameter(self,statistic,use_trait=False,which=None):
+    def _lookup(self,key):
+        """
+        Return a cached dictionary mapping leaf-like branch names ('names') or branch indices ('indices') to positions in `Objects`.
+        """
+        cache=self._branchCache()
+        if key not in cache:
+            table={}
+            for position,k in enumerate(self.Objects):
+                if key=='indices':
+                    table.setdefault(k.index,position)
+                elif k.is_leaflike():
+                    table.setdefault(k.name,position)
+            cache[key]=table
+        return cache[key]
+
+    def _namePosition(self,name,rebuild=True):
+        """
+        Return the position in `Objects` of a leaf-like branch by name, trying translations in `tipMap` if the name is not found directly.
+        Branches can be renamed without the tree knowing, so hits are checked against the name of the branch and the lookup table is rebuilt once if a name is missing or stale.
+        """
+        names=self._lookup('names')
+        candidates=[name]
+        if self.tipMap:
+            if name in self.tipMap: ## tip number given, tree renamed
+                candidates.append(self.tipMap[name])
+            cache=self._branchCache()
+            if cache.get('tipCodes',(None,))[0]!=id(self.tipMap):
+                cache['tipCodes']=(id(self.tipMap),{v:c for c,v in self.tipMap.items()})
+            if name in cache['tipCodes'][1]: ## tip name given, tree not renamed
+                candidates.append(cache['tipCodes'][1][name])
+        for candidate in candidates:
+            position=names.get(candidate)
+            if position!=None and self.Objects[position].name==candidate:
+                return position
+        if rebuild: ## branch renamed since the table was built
+            self._branchCache().pop('names',None)
+            return self._namePosition(name,rebuild=False)
+        return None
+
+    def getByName(self,name,warn=True):
+        """
+        Get a leaf-like branch (`leaf`, `clade` or `reticulation` classes) by name.
+
+        Parameters:
+        name (str): The name of the branch. Tip numbers and names from `tipMap` are accepted whether or not the tips have been renamed.
+        warn (bool): If True, raises a KeyError if no branch has the name, otherwise returns None. Default is True.
+
+        Returns:
+        leaf or clade or reticulation or None: The branch with the given name.
+
+        Note:
+        - Lookups use a dictionary that is rebuilt after the tree is changed or its tips are renamed. Names that are not found (e.g. after setting `name` of a branch directly) rebuild it, which takes as long as searching `Objects`.
+
+        Example:
+        >>> tip = tree.getByName('A/Perth/16/2009')
+        """
+        position=self._namePosition(name)
+        if position==None:
+            if warn: raise KeyError('No branch named %s found in tree'%(name))
+            return None
+        return self.Objects[position]
+
+    def getByIndex(self,i,warn=True):
+        """
+        Get a branch by its `index` attribute.
+
+        Parameters:
+        i (int or str): The index of the branch (position in the tree string for branches parsed from strings).
+        warn (bool): If True, raises a KeyError if no branch has the index, otherwise returns None. Default is True.
+
+        Returns:
+        node or leaf or clade or reticulation or None: The branch with the given index.
+
+        Example:
+        >>> k = tree.getByIndex(1042)
+        """
+        for attempt in range(2): ## rebuild the lookup table once if the branch was re-indexed since it was built
+            position=self._lookup('indices').get(i)
+            if position!=None and self.Objects[position].index==i:
+                return self.Objects[position]
+            self._branchCache().pop('indices',None)
+        if warn: raise KeyError('No branch with index %s found in tree'%(i))
+        return None
+
+    def getMany(self,names,index=False,warn=True):
+        """
+        Get leaf-like branches for a list of names.
+
+        Parameters:
+        names (iterable): Names of branches, see `getByName()`.
+        index (bool): If True, returns a numpy array of positions in `Objects` instead of branches. Default is False.
+        warn (bool): If True, raises a KeyError if any name is not found, otherwise missing branches are returned as None (or -1 positions). Default is True.
+
+        Returns:
+        list or numpy.ndarray: Branches (or their positions in `Objects`) in the same order as the names given.
+
+        Example:
+        >>> tips = tree.getMany(['A/Perth/16/2009', 'A/Brisbane/10/2007'])
+        >>> heights = tree.getParameter('height', as_array=True)[tree.getMany(names, index=True)]
+        """
+        names=list(names)
+        positions=[self._namePosition(name,rebuild=False) for name in names]
+        if None in positions: ## rebuild the lookup table once for all names that were not found
+            self._branchCache().pop('names',None)
+            positions=[self._namePosition(name,rebuild=False) if position==None else position for name,position in zip(names,positions)]
+        if warn and None in positions:
+            missing=[name for name,position in zip(names,positions) if position==None]
+            raise KeyError('%d names not found in tree, e.g. %s'%(len(missing),', '.join(map(str,missing[:5]))))
+        if index:
+            return np.array([-1 if position==None else position for position in positions],dtype=int)
+        return [None if position==None else self.Objects[position] for position in positions]
+
+    def getParameter(self,statistic,use_trait=False,which=None,as_array=False,dtype=float):
         """
         Return a list of either branch trait or attribute states across branches.
         
@@ -1261,17 +2721,20 @@ class tree: ## tree class
         statistic (str): The name of the trait or attribute to retrieve.
         use_trait (bool): If True, retrieves the trait from the branch's traits dictionary. If False, retrieves the attribute directly from branch attributes. Default is False (retrieves attributes).
         which (function or None): A function that determines which branches to include. Default is None, which includes all branches in the tree.
+        as_array (bool): If True, returns a numpy array with one entry per selected branch. Default is False.
+        dtype (type): The type of the returned array when `as_array` is True. Values that cannot be converted to it (e.g. categorical traits with the default float) are returned in an array of dtype object instead. Default is float.
         
         Returns:
-        list: A list of values for the specified trait or attribute across the selected branches.
+        list or numpy.ndarray: A list of values for the specified trait or attribute across the selected branches.
         
         Note:
-        - Branches that do not have the specified trait or attribute are skipped.
+        - The list and the array can differ in length: the list skips branches that do not have the specified trait or attribute, while the array has one entry per selected branch, with missing values as NaN (None for non-float types and object arrays) so that it lines up with the selected branches.
         
         Example:
         >>> branch_lengths = tree.getParameter('length')
         >>> posteriors = tree.getParameter('posterior', use_trait=True)
         >>> node_heights = tree.getParameter('height', which=lambda x: x.is_node())
+        >>> tree_length = tree.getParameter('length', as_array=True).sum()
         
         Docstring generated with ChatGPT 4o.
         """
@@ -1280,12 +2743,85 @@ class tree: ## tree class
         else:
             branches=filter(which,self.Objects)
 
+        if as_array==True:
+            missing=np.nan if np.dtype(dtype).kind in 'fc' else None
+            if use_trait==True and which==None and self.traitTable!=None and self.traitTable.kinds.get(statistic)=='numeric' and np.dtype(dtype).kind in 'fc':
+                rows=self._traitRows()
+                if rows is not None: ## every branch is stored in the table - read the column directly
+                    return self.traitTable.column(statistic)[rows].astype(dtype)
+            if use_trait==False:
+                params=[getattr(k,statistic,None) for k in branches]
+            else:
+                params=[k.traits.get(statistic) for k in branches]
+            try:
+                return np.array([missing if v is None else v for v in params],dtype=dtype)
+            except (ValueError,TypeError): ## values not convertible to dtype, e.g. categorical traits
+                values=np.empty(len(params),dtype=object)
+                values[:]=params
+                return values
+
         if use_trait==False:
             params=[getattr(k,statistic) for k in branches if hasattr(k,statistic)]
         elif use_trait==True:
             params=[k.traits[statistic] for k in branches if statistic in k.traits]
         return params
 
+    def _traitRows(self):
+        """
+        Return the rows of `traitTable` belonging to each branch in `Objects`, or None if some branches do not keep their traits in the table.
+        """
+        cache=self._branchCache()
+        if 'traitRows' not in cache:
+            rows=[k.traits.row if isinstance(k.traits,traitView) and k.traits.table is self.traitTable else -1 for k in self.Objects]
+            cache['traitRows']=np.array(rows,dtype=int) if -1 not in rows else None
+        return cache['traitRows']
+
+    def compactTraits(self):
+        """
+        Move the traits of all branches into a columnar `traitTable`.
+
+        Each trait becomes a single typed numpy column (strings are stored as integer codes into a list of unique values and numeric ranges as fixed-width arrays),
+        which reduces memory use for trees with many annotations and allows traits to be aggregated with numpy.
+        The `traits` attribute of each branch is replaced with a `traitView` that behaves like a dictionary.
+
+        Returns:
+        traitTable: The table holding the traits, also assigned to the `traitTable` attribute of the tree.
+
+        Example:
+        >>> table = tree.compactTraits()
+        >>> posteriors = table.column('posterior') ## one value per row, rows of branches are in k.traits.row
+        >>> locations = [table.categories['location'][code] for code in table.column('location') if code>=0]
+
+        """
+        branches=[k for k in self.Objects if not isinstance(k.traits,traitView)]
+        if self.traitTable!=None: ## add branches not stored in the table yet by rebuilding the whole table
+            branches=self.Objects
+        rows=[dict(k.traits) for k in branches]
+        table=traitTable(rows)
+        shared={} ## branches can share trait dictionaries (e.g. collapsed clades and the nodes they replace)
+        for i,k in enumerate(branches):
+            key=id(k.traits)
+            if key not in shared:
+                shared[key]=traitView(table,i)
+            k.traits=shared[key]
+        self.traitTable=table
+        self._branchCache().pop('traitRows',None)
+        return table
+
+    def expandTraits(self):
+        """
+        Move traits stored in `traitTable` back into a dictionary for each branch.
+
+        Example:
+        >>> tree.expandTraits()
+
+        """
+        for k in self.Objects:
+            if isinstance(k.traits,traitView):
+                k.traits=dict(k.traits)
+        self.traitTable=None
+        self._branchCache().pop('traitRows',None)
+
     def fixHangingNodes(self):
         """
         Remove internal nodes without any children. Used in `reduceTree()` and `subtree()` functions internally.
@@ -1306,8 +2842,9 @@ class tree: ## tree class
             for node in hanging_nodes:
                 node.parent.children.remove(node)
                 self.Objects.remove(node)
+            self._invalidate()
 
-    def addText(self,ax,target=None,x_attr=None,y_attr=None,text=None,zorder=None,**kwargs):
+    def addText(self,ax,target=None,x_attr=None,y_attr=None,text=None,zorder=None,cull=False,priority=None,**kwargs):
         """
         Add text annotations to the tree plot.
         
@@ -1318,6 +2855,8 @@ class tree: ## tree class
         y_attr (function or None): A function to determine the y-coordinate for the text. Default is None, which uses the branch's y attribute.
         text (function or None): A function to determine the text content. Default is None, which uses the `leaf` name attribute.
         zorder (int or None): The z-order for the text. Default is None, which sets the z-order to 4.
+        cull (bool): If True, only labels that don't overlap with labels already placed are added, set axes limits before calling. Default is False.
+        priority (function or None): A function giving the priority of a branch's label when culling, higher values are placed first. Default is None (order in tree.Objects).
         **kwargs: Additional keyword arguments to pass to the `ax.text` method.
         
         Returns:
@@ -1336,13 +2875,20 @@ class tree: ## tree class
         local_kwargs=dict(kwargs)
         if 'verticalalignment' not in local_kwargs: local_kwargs['verticalalignment']='center'
 
-        for k in filter(target,self.Objects):
-            x,y=x_attr(k),y_attr(k)
+        labels=[(k,x_attr(k),y_attr(k),text(k)) for k in filter(target,self.Objects)]
+        if cull: ## keep labels that can be read
+            N=len(labels)
+            keep=_cullLabels(ax,[w[1] for w in labels],[w[2] for w in labels],[w[3] for w in labels],[0.0]*N,
+                             [local_kwargs.get('horizontalalignment',local_kwargs.get('ha','left'))]*N,[local_kwargs.get('va',local_kwargs['verticalalignment'])]*N,
+                             local_kwargs.get('fontsize',local_kwargs.get('size')),None if priority==None else [priority(w[0]) for w in labels])
+            labels=[labels[i] for i in keep]
+
+        for k,x,y,label in labels:
             z=zorder
-            ax.text(x,y,text(k),zorder=z,**local_kwargs)
+            ax.text(x,y,label,zorder=z,**local_kwargs)
         return ax
 
-    def addTextUnrooted(self,ax,target=None,x_attr=None,y_attr=None,text=None,zorder=None,**kwargs):
+    def addTextUnrooted(self,ax,target=None,x_attr=None,y_attr=None,text=None,zorder=None,cull=False,priority=None,**kwargs):
         """
         Add text annotations to an unrooted tree plot.
         
@@ -1353,6 +2899,8 @@ class tree: ## tree class
         y_attr (function or None): A function to determine the y-coordinate for the text. Default is None, which uses the branch's y attribute.
         text (function or None): A function to determine the text content. Default is None, which uses the branch's name attribute.
         zorder (int or None): The z-order for the text. Default is None, which sets the z-order to 4.
+        cull (bool): If True, only labels that don't overlap with labels already placed are added, set axes limits before calling. Default is False.
+        priority (function or None): A function giving the priority of a branch's label when culling, higher values are placed first. Default is None (order in tree.Objects).
         **kwargs: Additional keyword arguments to pass to the `ax.text` method.
         
         Returns:
@@ -1369,26 +2917,34 @@ class tree: ## tree class
         if text==None: text=lambda k: k.name
         if zorder==None: zorder=4
         
+        labels=[]
         for k in filter(target,self.Objects):
             local_kwargs=dict(kwargs)
             
             x,y=x_attr(k),y_attr(k)
-            z=zorder
             
-            assert 'tau' in k.traits, 'Branch does not have angle tau computed by drawUnrooted().'
+            assert getattr(k,'tau',None)!=None, 'Branch does not have angle tau computed by drawUnrooted().'
             
-            rot=math.degrees(k.traits['tau'])%360
+            rot=math.degrees(k.tau)%360
             
             if 'horizontalalignment' not in local_kwargs: local_kwargs['horizontalalignment']='right' if 90<rot<270 else 'left'
             if 'verticalalignment' not in local_kwargs: local_kwargs['verticalalignment']='center'
             
             rot=rot+180 if 90<rot<270 else rot
-            
-            ax.text(x,y,text(k),rotation=rot,rotation_mode='anchor',zorder=z,**local_kwargs)
+            labels.append((k,x,y,text(k),rot,local_kwargs))
+
+        if cull: ## keep labels that can be read
+            keep=_cullLabels(ax,[w[1] for w in labels],[w[2] for w in labels],[w[3] for w in labels],[w[4] for w in labels],
+                             [w[5]['horizontalalignment'] for w in labels],[w[5]['verticalalignment'] for w in labels],
+                             kwargs.get('fontsize',kwargs.get('size')),None if priority==None else [priority(w[0]) for w in labels])
+            labels=[labels[i] for i in keep]
+
+        for k,x,y,label,rot,local_kwargs in labels:
+            ax.text(x,y,label,rotation=rot,rotation_mode='anchor',zorder=zorder,**local_kwargs)
             
         return ax
 
-    def addTextCircular(self,ax,target=None,text=None,x_attr=None,y_attr=None,circStart=0.0,circFrac=1.0,inwardSpace=0.0,normaliseHeight=None,zorder=None,**kwargs):
+    def addTextCircular(self,ax,target=None,text=None,x_attr=None,y_attr=None,circStart=0.0,circFrac=1.0,inwardSpace=0.0,normaliseHeight=None,zorder=None,cull=False,priority=None,**kwargs):
         """
         Add text annotations to a circular tree plot.
 
@@ -1403,6 +2959,8 @@ class tree: ## tree class
         inwardSpace (float): Amount of space to leave in the middle of the tree (can be negative for inward-facing trees). Default is 0.0.
         normaliseHeight (function or None): A function to normalize the x-coordinates. Default is None, creates a normalisation that returns 0.0 at root and 1.0 at the most diverged tip.
         zorder (int or None): The z-order for the text. Default is None, which sets the z-order to 4.
+        cull (bool): If True, only labels that don't overlap with labels already placed are added, set axes limits before calling. Default is False.
+        priority (function or None): A function giving the priority of a branch's label when culling, higher values are placed first. Default is None (order in tree.Objects).
         **kwargs: Additional keyword arguments to pass to the `ax.text` method.
         
         Returns:
@@ -1426,6 +2984,7 @@ class tree: ## tree class
         allXs=list(map(x_attr,self.Objects))
         if normaliseHeight==None: normaliseHeight=lambda value: (value-min(allXs))/(max(allXs)-min(allXs))
             
+        labels=[]
         for k in filter(target,self.Objects): ## iterate over branches
             local_kwargs=dict(kwargs) ## copy global kwargs into a local version
             
@@ -1441,27 +3000,166 @@ class tree: ## tree class
             if 'horizontalalignment' not in local_kwargs: local_kwargs['horizontalalignment']='right' if 180<rot<360 else 'left' ## rotate labels to aid readability
             if 'verticalalignment' not in local_kwargs: local_kwargs['verticalalignment']='center'
             rot=360-rot-90 if 180<rot<360 else 360-rot+90
-            
-            ax.text(X*x,Y*x,text(k),rotation=rot,rotation_mode='anchor',zorder=zorder,**local_kwargs)
+            labels.append((k,X*x,Y*x,text(k),rot,local_kwargs))
+
+        if cull: ## keep labels that can be read
+            keep=_cullLabels(ax,[w[1] for w in labels],[w[2] for w in labels],[w[3] for w in labels],[w[4] for w in labels],
+                             [w[5]['horizontalalignment'] for w in labels],[w[5]['verticalalignment'] for w in labels],
+                             kwargs.get('fontsize',kwargs.get('size')),None if priority==None else [priority(w[0]) for w in labels])
+            labels=[labels[i] for i in keep]
+
+        for k,x,y,label,rot,local_kwargs in labels:
+            ax.text(x,y,label,rotation=rot,rotation_mode='anchor',zorder=zorder,**local_kwargs)
         
         return ax
 
+    def _plotSelection(self,target):
+        """
+        Return positions in `Objects` of branches selected for plotting by a function, a boolean mask or a list of positions.
+        """
+        if target is None:
+            return np.arange(len(self.Objects))
+        if callable(target):
+            return np.array([i for i,k in enumerate(self.Objects) if target(k)],dtype=int)
+        target=np.asarray(target)
+        if target.dtype==bool:
+            return np.flatnonzero(target)
+        return target.astype(int)
+
+    def _plotColumn(self,values,positions,fallback=None):
+        """
+        Resolve a plotting argument (function, single value, or list/array aligned with `Objects`) into values for branches at given positions.
+        Single values are returned as they are, since matplotlib applies them to every element.
+        """
+        if callable(values):
+            column=[]
+            for i in positions:
+                try:
+                    column.append(values(self.Objects[i]))
+                except KeyError:
+                    if fallback==None: raise
+                    column.append(fallback) ## in case no value is available for branch
+            return column
+        if isinstance(values,(list,np.ndarray)) and len(values)==len(self.Objects):
+            return values[positions] if isinstance(values,np.ndarray) else [values[i] for i in positions]
+        return values
+
+    def _plotCoordinates(self,attr,name,positions=None):
+        """
+        Return a float array of coordinates for branches at given positions (all branches by default), taken from a function,
+        an array aligned with `Objects` or, if attr is None, from the branch attribute called `name`. Missing values become NaN.
+        """
+        if positions is None: positions=range(len(self.Objects))
+        if attr is None:
+            values=[getattr(self.Objects[i],name) for i in positions]
+        else:
+            values=self._plotColumn(attr,positions)
+        return np.array([np.nan if v==None else v for v in values] if isinstance(values,list) else values,dtype=float)
+
+    def _plotParents(self,positions):
+        """
+        Return positions in `Objects` of parents of branches at given positions, -1 for parents that are not in `Objects` (e.g. above the root).
+        """
+        position={k: i for i,k in enumerate(self.Objects)}
+        return np.array([position.get(self.Objects[i].parent,-1) for i in positions],dtype=int)
+
+    def _plotParentCoordinates(self,values,own,attr,name,positions,parents):
+        """
+        Look up coordinates of parents from coordinates of all branches. Parents outside of `Objects` are evaluated directly,
+        branches without parents are connected to themselves.
+        """
+        parent_values=values[parents]
+        for j in np.flatnonzero(parents<0):
+            k=self.Objects[positions[j]]
+            if k.parent==None:
+                parent_values[j]=own[j]
+            elif attr is None or callable(attr):
+                v=getattr(k.parent,name) if attr is None else attr(k.parent)
+                parent_values[j]=np.nan if v==None else v
+            else:
+                parent_values[j]=np.nan
+        return parent_values
+
+    def _circularCoordinates(self,x_attr,y_attr,circStart,circFrac,inwardSpace,normaliseHeight):
+        """
+        Return normalised radii and angles of all branches in `Objects` for circular layouts.
+        """
+        if inwardSpace<0: inwardSpace-=self.treeHeight
+
+        xs=self._plotCoordinates(x_attr,'x')
+        if normaliseHeight==None:
+            minX,maxX=np.nanmin(xs),np.nanmax(xs)
+            normaliseHeight=lambda value: (value-minX)/(maxX-minX)
+        try:
+            radii=np.asarray(normaliseHeight(xs+inwardSpace),dtype=float) ## normalise all radii at once
+        except (TypeError,ValueError):
+            radii=None
+        if radii is None or radii.shape!=xs.shape: ## normalisation only works on single values
+            radii=np.array([normaliseHeight(v) for v in xs+inwardSpace],dtype=float)
+
+        angles=circStart*math.pi*2+circFrac*math.pi*2*self._plotCoordinates(y_attr,'y')/self.ySpan
+        return radii,angles
+
+    def _levelOfDetail(self,ax,xs,ys,threshold):
+        """
+        Find the largest clades whose vertical extent on the axes is smaller than `threshold` pixels.
+
+        Returns:
+        tuple: Positions in `Objects` of aggregated nodes, a boolean mask of branches hidden under them and arrays with the lowest y, highest y and highest x within each branch's subtree.
+        """
+        position={k: i for i,k in enumerate(self.Objects)}
+        order=[position[k] for k in self._preorder()]
+
+        low,high,far=ys.copy(),ys.copy(),xs.copy()
+        for i in reversed(order): ## post-order to get extents of every subtree
+            k=self.Objects[i]
+            if k.is_node():
+                children=[position[child] for child in k.children]
+                low[i]=min(np.nanmin(low[children]),low[i])
+                high[i]=max(np.nanmax(high[children]),high[i])
+                far[i]=max(np.nanmax(far[children]),far[i])
+
+        if ax.get_autoscaley_on(): ## limits not set yet, assume tree will fill the axes
+            span=np.nanmax(ys)-np.nanmin(ys)+1.0
+        else:
+            bottom,top=ax.get_ylim()
+            span=abs(top-bottom)
+        pixels=ax.get_window_extent().height/span ## pixels per unit of y, depends on figure size and dpi
+
+        aggregated=[]
+        hidden=np.zeros(len(self.Objects),dtype=bool)
+        stack=[self.root]
+        while stack:
+            k=stack.pop()
+            if not k.is_node(): continue
+            i=position[k]
+            if (high[i]-low[i])*pixels<threshold:
+                aggregated.append(i)
+                for d in self._preorder(cur_node=k)[1:]: ## everything below the clade is drawn as one shape
+                    hidden[position[d]]=True
+            else:
+                stack.extend(k.children)
+
+        return np.array(aggregated,dtype=int),hidden,low,high,far
+
     def plotPoints(self,ax,x_attr=None,y_attr=None,target=None,size=None,colour=None,
                zorder=None,outline=None,outline_size=None,outline_colour=None,**kwargs):
         """
         Plot points on the tree plot.
+
+        Functions are called once per selected branch, lists or arrays aligned with `tree.Objects` are used directly.
         
         Parameters:
         ax (matplotlib.axes.Axes): The matplotlib axes to add the points to.
-        x_attr (function or None): A function to determine the x-coordinate for the points. Default is None, which uses the branch's x attribute.
-        y_attr (function or None): A function to determine the y-coordinate for the points. Default is None, which uses the branch's y attribute.
-        target (function or None): A function to select which branches to annotate. Default is None, which selects all `leaf` objects.
-        size (int or function or None): The size of the points. Default is None, which sets the size to 40.
-        colour (str or function or None): The color of the points. Default is None, which sets the color to 'k' (black).
+        x_attr (function or array or None): A function or array of x-coordinates for the points. Default is None, which uses the branch's x attribute.
+        y_attr (function or array or None): A function or array of y-coordinates for the points. Default is None, which uses the branch's y attribute.
+        target (function or array or None): A function, boolean mask or array of positions in tree.Objects to select which branches to annotate. Default is None, which selects all `leaf` objects.
+        size (int or function or array or None): The size of the points. Default is None, which sets the size to 40.
+        colour (str or function or array or None): The color of the points. Default is None, which sets the color to 'k' (black).
         zorder (int or None): The z-order for the points. Default is None, which sets the z-order to 3.
         outline (bool or None): If True, adds an outline to the points. Default is None, which sets the outline to True.
-        outline_size (int or function or None): The size of the outline. Default is None, which sets the outline size to twice the size of the points.
-        outline_colour (str or function or None): The color of the outline. Default is None, which sets the outline color to 'k' (black).
+        outline_size (int or function or array or None): The size of the outline. Default is None, which sets the outline size to twice the size of the points.
+        outline_colour (str or function or array or None): The color of the outline. Default is None, which sets the outline color to 'k' (black).
         **kwargs: Additional keyword arguments to pass to the `ax.scatter` method.
         
         Returns:
@@ -1472,58 +3170,45 @@ class tree: ## tree class
         
         Docstring generated with ChatGPT 4o.
         """
-        if target==None: target=lambda k: k.is_leaf()
-        if x_attr==None: x_attr=lambda k:k.x
-        if y_attr==None: y_attr=lambda k:k.y
-        if size==None: size=40
-        if colour==None: colour=lambda f:'k'
+        if target is None: target=lambda k: k.is_leaf()
+        if size is None: size=40
+        if colour is None: colour='k'
         if zorder==None: zorder=3
 
         if outline==None: outline=True
-        if outline_size==None: outline_size=lambda k: size(k)*2 if callable(size) else size*2
-        if outline_colour==None: outline_colour='k'
-
-        xs=[]
-        ys=[]
-        colours=[]
-        sizes=[]
-
-        outline_xs=[]
-        outline_ys=[]
-        outline_colours=[]
-        outline_sizes=[]
-        for k in filter(target,self.Objects):
-            xs.append(x_attr(k))
-            ys.append(y_attr(k))
-            colours.append(colour(k)) if callable(colour) else colours.append(colour)
-            sizes.append(size(k)) if callable(size) else sizes.append(size)
+        if outline_colour is None: outline_colour='k'
 
-            if outline:
-                outline_xs.append(xs[-1])
-                outline_ys.append(ys[-1])
-                outline_colours.append(outline_colour(k)) if callable(outline_colour) else outline_colours.append(outline_colour)
-                outline_sizes.append(outline_size(k)) if callable(outline_size) else outline_sizes.append(outline_size)
+        selected=self._plotSelection(target)
+        xs=self._plotCoordinates(x_attr,'x',selected)
+        ys=self._plotCoordinates(y_attr,'y',selected)
+        colours=self._plotColumn(colour,selected)
+        sizes=self._plotColumn(size,selected)
 
         ax.scatter(xs,ys,s=sizes,facecolor=colours,edgecolor='none',zorder=zorder,**kwargs) ## put a circle at each tip
         if outline:
-            ax.scatter(outline_xs,outline_ys,s=outline_sizes,facecolor=outline_colours,edgecolor='none',zorder=zorder-1,**kwargs) ## put a circle at each tip
+            outline_sizes=np.asarray(sizes,dtype=float)*2 if outline_size is None else self._plotColumn(outline_size,selected)
+            outline_colours=self._plotColumn(outline_colour,selected)
+            ax.scatter(xs,ys,s=outline_sizes,facecolor=outline_colours,edgecolor='none',zorder=zorder-1,**kwargs) ## put a circle at each tip
 
         return ax
 
     def plotTree(self,ax,connection_type=None,target=None,
              x_attr=None,y_attr=None,width=None,
-             colour=None,**kwargs):
+             colour=None,lod_threshold=None,**kwargs):
         """
         Plot the tree on a given matplotlib axes.
+
+        Functions are called once per selected branch, lists or arrays aligned with `tree.Objects` are used directly.
         
         Parameters:
         ax (matplotlib.axes.Axes): The matplotlib axes to plot the tree on.
         connection_type (str or None): The type of connection between nodes. Options are 'baltic' (parental branches are plotted as two straight lines - one horizontal, one vertical), 'direct' (diagonal line that directly connects parent and child branches), or 'elbow' (each child has its own angled branch connecting it to the parent). Default is 'baltic'.
-        target (function or None): A function to select which branches to plot. Default is None, which selects all branches.
-        x_attr (function or None): A function to determine the x-coordinate for the nodes. Default is None, which uses the branch's x attribute.
-        y_attr (function or None): A function to determine the y-coordinate for the nodes. Default is None, which uses the branch's y attribute.
-        width (int or function or None): The width of the lines. Default is None, which sets the width to 2.
-        colour (str or function or None): The color of the lines. Default is None, which sets the color to 'k' (black).
+        target (function or array or None): A function, boolean mask or array of positions in tree.Objects to select which branches to plot. Default is None, which selects all branches.
+        x_attr (function or array or None): A function or array of x-coordinates for the nodes. Default is None, which uses the branch's x attribute.
+        y_attr (function or array or None): A function or array of y-coordinates for the nodes. Default is None, which uses the branch's y attribute.
+        width (int or function or array or None): The width of the lines. Default is None, which sets the width to 2.
+        colour (str or function or array or None): The color of the lines. Default is None, which sets the color to 'k' (black).
+        lod_threshold (float or None): Level of detail in pixels. Clades whose vertical extent on the axes is smaller than this are drawn as a single triangle in the colour of the clade's stem. Default is None (every branch is drawn).
         **kwargs: Additional keyword arguments to pass to the LineCollection.
         
         Returns:
@@ -1534,43 +3219,50 @@ class tree: ## tree class
         
         Docstring generated with ChatGPT 4o.
         """
-        if target==None: target=lambda k: True
-        if x_attr==None: x_attr=lambda k: k.x
-        if y_attr==None: y_attr=lambda k: k.y
-        if width==None: width=2
-        if colour==None: colour='k'
+        if width is None: width=2
+        if colour is None: colour='k'
         if connection_type==None: connection_type='baltic'
-        assert connection_type in ['baltic','direct','elbow'],'Unrecognised drawing type "%s"'%(tree_type)
-
-        branches=[]
-        colours=[]
-        linewidths=[]
-        for k in filter(target,self.Objects): ## iterate over branches
-            x=x_attr(k) ## get branch x position
-            xp=x_attr(k.parent) if k.parent else x ## get parent x position
-            y=y_attr(k) ## get y position
-
-            try:
-                colours.append(colour(k)) if callable(colour) else colours.append(colour)
-            except KeyError:
-                colours.append((0.7,0.7,0.7)) ## in case no colour available for branch set it to grey
-            linewidths.append(width(k)) if callable(width) else linewidths.append(width)
-
-            if connection_type=='baltic': ## each node has a single vertical line to which descendant branches are connected
-                branches.append(((xp,y),(x,y)))
-                if k.is_node():
-                    yl,yr=y_attr(k.children[0]),y_attr(k.children[-1]) ## y positions of first and last child
-                    branches.append(((x,yl),(x,yr)))
-                    linewidths.append(linewidths[-1])
-                    colours.append(colours[-1])
-            elif connection_type=='elbow': ## more standard connection where each branch connects to its parent via a right-angled line
-                yp=y_attr(k.parent) if k.parent else y ## get parent x position
-                branches.append(((xp,yp),(xp,y),(x,y)))
-            elif connection_type=='direct': ## this gives triangular looking trees where descendants connect directly to their parents
-                yp=y_attr(k.parent) ## get y position
-                branches.append(((xp,yp),(x,y)))
-            else:
-                pass ## for now
+        assert connection_type in ['baltic','direct','elbow'],'Unrecognised drawing type "%s"'%(connection_type)
+
+        selected=self._plotSelection(target)
+        xs=self._plotCoordinates(x_attr,'x') ## coordinates of all branches, parents are looked up from these
+        ys=self._plotCoordinates(y_attr,'y')
+        if lod_threshold!=None: ## don't draw branches that can't be told apart
+            aggregated,hidden,low,high,far=self._levelOfDetail(ax,xs,ys,lod_threshold)
+            selected=selected[~hidden[selected]]
+            is_aggregated=np.zeros(len(self.Objects),dtype=bool)
+            is_aggregated[aggregated]=True
+        parents=self._plotParents(selected)
+        colours=self._plotColumn(colour,selected,fallback=(0.7,0.7,0.7)) ## in case no colour available for branch set it to grey
+        linewidths=self._plotColumn(width,selected)
+
+        x,y=xs[selected],ys[selected]
+        xp=self._plotParentCoordinates(xs,x,x_attr,'x',selected,parents) ## parent x positions
+
+        if connection_type=='baltic': ## each node has a single vertical line to which descendant branches are connected
+            stems=np.stack([np.stack([xp,y],axis=-1),np.stack([x,y],axis=-1)],axis=1)
+            nodes=np.array([j for j,i in enumerate(selected) if self.Objects[i].is_node() and (lod_threshold==None or is_aggregated[i]==False)],dtype=int)
+            position={k: i for i,k in enumerate(self.Objects)}
+            first=np.array([position[self.Objects[selected[j]].children[0]] for j in nodes],dtype=int) ## positions of first and last child
+            last=np.array([position[self.Objects[selected[j]].children[-1]] for j in nodes],dtype=int)
+            bars=np.stack([np.stack([x[nodes],ys[first]],axis=-1),np.stack([x[nodes],ys[last]],axis=-1)],axis=1)
+            branches=np.concatenate([stems,bars.reshape(-1,2,2)])
+            colours=_joinColumns(colours,_expandColumn(colours,nodes))
+            linewidths=_joinColumns(linewidths,_expandColumn(linewidths,nodes))
+        elif connection_type=='elbow': ## more standard connection where each branch connects to its parent via a right-angled line
+            yp=self._plotParentCoordinates(ys,y,y_attr,'y',selected,parents)
+            branches=np.stack([np.stack([xp,yp],axis=-1),np.stack([xp,y],axis=-1),np.stack([x,y],axis=-1)],axis=1)
+        elif connection_type=='direct': ## this gives triangular looking trees where descendants connect directly to their parents
+            yp=self._plotParentCoordinates(ys,y,y_attr,'y',selected,parents)
+            branches=np.stack([np.stack([xp,yp],axis=-1),np.stack([x,y],axis=-1)],axis=1)
+
+        if lod_threshold!=None and len(aggregated)>0:
+            shown=np.flatnonzero(is_aggregated[selected]) ## aggregated clades whose stems are plotted
+            clades=selected[shown]
+            triangles=np.stack([np.stack([xs[clades],ys[clades]],axis=-1),np.stack([far[clades],high[clades]],axis=-1),np.stack([far[clades],low[clades]],axis=-1)],axis=1)
+            clade_colours=_expandColumn(colours,shown)
+            clade_kwargs={key: kwargs[key] for key in ['zorder','alpha'] if key in kwargs}
+            ax.add_collection(PolyCollection(triangles,facecolor=clade_colours,edgecolor=clade_colours,lw=_expandColumn(linewidths,shown),**clade_kwargs))
 
         if 'capstyle' not in kwargs: kwargs['capstyle']='projecting'
         line_segments = LineCollection(branches,lw=linewidths,color=colours,**kwargs)
@@ -1581,14 +3273,17 @@ class tree: ## tree class
                          circStart=0.0,circFrac=1.0,inwardSpace=0.0,normaliseHeight=None,precision=15,**kwargs):
         """
         Plot the tree in a circular layout on a given matplotlib axes.
+
+        Functions are called once per selected branch, lists or arrays aligned with `tree.Objects` are used directly.
+        The polar transform and the arcs of all nodes are computed at once.
         
         Parameters:
         ax (matplotlib.axes.Axes): The matplotlib axes to plot the tree on.
-        target (function or None): A function to select which branches to plot. Default is None, which selects all branches.
-        x_attr (function or None): A function to determine the x-coordinate for the nodes. Default is None, which uses the branch's x attribute.
-        y_attr (function or None): A function to determine the y-coordinate for the nodes. Default is None, which uses the branch's y attribute.
-        width (int or function or None): The width of the lines. Default is None, which sets the width to 2.
-        colour (str or function or None): The color of the lines. Default is None, which sets the color to 'k' (black).
+        target (function or array or None): A function, boolean mask or array of positions in tree.Objects to select which branches to plot. Default is None, which selects all branches.
+        x_attr (function or array or None): A function or array of x-coordinates for the nodes. Default is None, which uses the branch's x attribute.
+        y_attr (function or array or None): A function or array of y-coordinates for the nodes. Default is None, which uses the branch's y attribute.
+        width (int or function or array or None): The width of the lines. Default is None, which sets the width to 2.
+        colour (str or function or array or None): The color of the lines. Default is None, which sets the color to 'k' (black).
         circStart (float): The starting angle (in fractions of 2*pi, i.e. radians) for the circular layout. Default is 0.0.
         circFrac (float): The fraction of the full circle to use for the layout. Default is 1.0.
         inwardSpace (float): Amount of space to leave in the middle of the tree (can be negative for inward-facing trees). Default is 0.0.
@@ -1604,57 +3299,36 @@ class tree: ## tree class
         
         Docstring generated with ChatGPT 4o.
         """
-
-        if target==None: target=lambda k: True
-        if x_attr==None: x_attr=lambda k:k.x
-        if y_attr==None: y_attr=lambda k:k.y
-        if colour==None: colour='k'
-        if width==None: width=2
-
-        if inwardSpace<0: inwardSpace-=self.treeHeight
-
-        branches=[]
-        colours=[]
-        linewidths=[]
-
-        circ_s=circStart*math.pi*2
-        circ=circFrac*math.pi*2
-
-        allXs=list(map(x_attr,self.Objects))
-        if normaliseHeight==None: normaliseHeight=lambda value: (value-min(allXs))/(max(allXs)-min(allXs))
-        linspace=lambda start,stop,n: list(start+((stop-start)/(n-1))*i for i in range(n)) if n>1 else stop
-
-        for k in filter(target,self.Objects): ## iterate over branches
-            x=normaliseHeight(x_attr(k)+inwardSpace) ## get branch x position
-            xp=normaliseHeight(x_attr(k.parent)+inwardSpace) if k.parent.parent else x ## get parent x position
-            y=y_attr(k) ## get y position
-
-            try:
-                colours.append(colour(k)) if callable(colour) else colours.append(colour)
-            except KeyError:
-                colours.append((0.7,0.7,0.7))
-            linewidths.append(width(k)) if callable (width) else linewidths.append(width)
-
-            y=circ_s+circ*y/self.ySpan
-            X=math.sin(y)
-            Y=math.cos(y)
-            branches.append(((X*xp,Y*xp),(X*x,Y*x)))
-
-            if k.is_node():
-                yl,yr=y_attr(k.children[0]),y_attr(k.children[-1]) ## get leftmost and rightmost children's y coordinates
-                yl=circ_s+circ*yl/self.ySpan ## transform y into a fraction of total y
-                yr=circ_s+circ*yr/self.ySpan
-                ybar=linspace(yl,yr,precision) ## what used to be vertical node bar is now a curved line
-
-                xs=[yx*x for yx in map(math.sin,ybar)] ## convert to polar coordinates
-                ys=[yy*x for yy in map(math.cos,ybar)]
-
-                branches+=tuple(zip(zip(xs,ys),zip(xs[1:],ys[1:]))) ## add curved segment
-
-                linewidths+=[linewidths[-1] for q in zip(ys,ys[1:])] ## repeat linewidths
-                colours+=[colours[-1] for q in zip(ys,ys[1:])] ## repeat colours
-
-        line_segments = LineCollection(branches,lw=linewidths,ls='-',color=colours,capstyle='projecting',zorder=1) ## create line segments
+        if colour is None: colour='k'
+        if width is None: width=2
+        assert precision>1,'At least two points are needed to plot curved segments'
+
+        selected=self._plotSelection(target)
+        radii,angles=self._circularCoordinates(x_attr,y_attr,circStart,circFrac,inwardSpace,normaliseHeight)
+        parents=self._plotParents(selected)
+        colours=self._plotColumn(colour,selected,fallback=(0.7,0.7,0.7))
+        linewidths=self._plotColumn(width,selected)
+
+        r,a=radii[selected],angles[selected]
+        rp=np.where(parents>=0,radii[parents],r) ## parent radii, root is connected to itself
+        X,Y=np.sin(a),np.cos(a)
+        stems=np.stack([np.stack([X*rp,Y*rp],axis=-1),np.stack([X*r,Y*r],axis=-1)],axis=1)
+
+        nodes=np.array([j for j,i in enumerate(selected) if self.Objects[i].is_node()],dtype=int)
+        position={k: i for i,k in enumerate(self.Objects)}
+        al=angles[np.array([position[self.Objects[selected[j]].children[0]] for j in nodes],dtype=int)] ## angles of leftmost and rightmost children
+        ar=angles[np.array([position[self.Objects[selected[j]].children[-1]] for j in nodes],dtype=int)]
+        arc=al[:,None]+(ar-al)[:,None]*np.linspace(0.0,1.0,precision)[None,:] ## what used to be vertical node bar is now a curved line
+        points=np.stack([np.sin(arc)*r[nodes][:,None],np.cos(arc)*r[nodes][:,None]],axis=-1) ## convert to polar coordinates
+        arcs=np.stack([points[:,:-1],points[:,1:]],axis=2).reshape(-1,2,2) ## consecutive points become segments
+
+        branches=np.concatenate([stems,arcs])
+        colours=_joinColumns(colours,_expandColumn(colours,nodes,precision-1)) ## repeat colours and widths for every arc segment
+        linewidths=_joinColumns(linewidths,_expandColumn(linewidths,nodes,precision-1))
+
+        for key,value in [('ls','-'),('capstyle','projecting'),('zorder',1)]:
+            if key not in kwargs: kwargs[key]=value
+        line_segments = LineCollection(branches,lw=linewidths,color=colours,**kwargs) ## create line segments
         ax.add_collection(line_segments) ## add collection to axes
         return ax
 
@@ -1662,22 +3336,24 @@ class tree: ## tree class
                zorder=None,outline=None,outline_size=None,outline_colour=None,**kwargs):
         """
         Plot points on a circular tree plot.
+
+        Functions are called once per selected branch, lists or arrays aligned with `tree.Objects` are used directly.
         
         Parameters:
         ax (matplotlib.axes.Axes): The matplotlib axes to add the points to.
-        x_attr (function or None): A function to determine the x-coordinate for the points. Default is None, which uses the branch's x attribute.
-        y_attr (function or None): A function to determine the y-coordinate for the points. Default is None, which uses the branch's y attribute.
-        target (function or None): A function to select which branches to annotate. Default is None, which selects all `leaf` nodes.
-        size (int or function or None): The size of the points. Default is None, which sets the size to 40.
-        colour (str or function or None): The color of the points. Default is None, which sets the color to 'k' (black).
+        x_attr (function or array or None): A function or array of x-coordinates for the points. Default is None, which uses the branch's x attribute.
+        y_attr (function or array or None): A function or array of y-coordinates for the points. Default is None, which uses the branch's y attribute.
+        target (function or array or None): A function, boolean mask or array of positions in tree.Objects to select which branches to annotate. Default is None, which selects all `leaf` nodes.
+        size (int or function or array or None): The size of the points. Default is None, which sets the size to 40.
+        colour (str or function or array or None): The color of the points. Default is None, which sets the color to 'k' (black).
         circStart (float): The starting angle (in fractions of 2*pi, i.e. radians) for the circular layout. Default is 0.0.
         circFrac (float): The fraction of the full circle to use for the layout. Default is 1.0.
         inwardSpace (float): Amount of space to leave in the middle of the tree (can be negative for inward-facing trees). Default is 0.0.
         normaliseHeight (function or None): A function to normalize the x-coordinates. Default is None, creates a normalisation that returns 0.0 at root and 1.0 at the most diverged tip.
         zorder (int or None): The z-order for the points. Default is None, which sets the z-order to 3.
         outline (bool or None): If True, adds an outline to the points. Default is None, which sets the outline to True.
-        outline_size (int or function or None): The size of the outline. Default is None, which sets the outline size to twice the size of the points.
-        outline_colour (str or function or None): The color of the outline. Default is None, which sets the outline color to 'k' (black).
+        outline_size (int or function or array or None): The size of the outline. Default is None, which sets the outline size to twice the size of the points.
+        outline_colour (str or function or array or None): The color of the outline. Default is None, which sets the outline color to 'k' (black).
         **kwargs: Additional keyword arguments to pass to the `ax.scatter` method.
         
         Returns:
@@ -1688,113 +3364,328 @@ class tree: ## tree class
         
         Docstring generated with ChatGPT 4o.
         """
-
-        if target==None: target=lambda k: k.is_leaf()
-        if x_attr==None: x_attr=lambda k:k.x
-        if y_attr==None: y_attr=lambda k:k.y
-        if size==None: size=40
-        if colour==None: colour='k'
+        if target is None: target=lambda k: k.is_leaf()
+        if size is None: size=40
+        if colour is None: colour='k'
         if zorder==None: zorder=3
 
         if outline==None: outline=True
-        if outline_size==None: outline_size=lambda k: size(k)*2 if callable(size) else size*2
-        if outline_colour==None: outline_colour=lambda k: 'k'
+        if outline_colour is None: outline_colour='k'
 
-        if inwardSpace<0: inwardSpace-=self.treeHeight
+        selected=self._plotSelection(target)
+        radii,angles=self._circularCoordinates(x_attr,y_attr,circStart,circFrac,inwardSpace,normaliseHeight)
+        xs=np.sin(angles[selected])*radii[selected] ## transform
+        ys=np.cos(angles[selected])*radii[selected]
+        colours=self._plotColumn(colour,selected)
+        sizes=self._plotColumn(size,selected)
 
-        circ_s=circStart*math.pi*2
-        circ=circFrac*math.pi*2
+        ax.scatter(xs,ys,s=sizes,facecolor=colours,edgecolor='none',zorder=zorder,**kwargs) ## put a circle at each tip
+        if outline:
+            outline_sizes=np.asarray(sizes,dtype=float)*2 if outline_size is None else self._plotColumn(outline_size,selected)
+            outline_colours=self._plotColumn(outline_colour,selected)
+            ax.scatter(xs,ys,s=outline_sizes,facecolor=outline_colours,edgecolor='none',zorder=zorder-1,**kwargs) ## put a circle at each tip
 
-        allXs=list(map(x_attr,self.Objects))
-        if normaliseHeight==None: normaliseHeight=lambda value: (value-min(allXs))/(max(allXs)-min(allXs))
-        linspace=lambda start,stop,n: list(start+((stop-start)/(n-1))*i for i in range(n)) if n>1 else stop
+        return ax
 
-        xs=[]
-        ys=[]
-        colours=[]
-        sizes=[]
+    def writeSVG(self,path,target=None,x_attr=None,y_attr=None,colour=None,width=None,
+                 circular=False,circStart=0.0,circFrac=1.0,inwardSpace=0.0,normaliseHeight=None,
+                 points=None,point_size=None,point_colour=None,text=None,font_size=None,
+                 canvas=None,margin=None,background=None):
+        """
+        Write the tree as an SVG file directly from branch coordinates, without creating matplotlib artists.
+        Elements are written to the file one branch at a time in buffered chunks.
 
-        outline_xs=[]
-        outline_ys=[]
-        outline_colours=[]
-        outline_sizes=[]
-        for k in filter(target,self.Objects):
-            x=normaliseHeight(x_attr(k)+inwardSpace) ## find normalised x position along circle's radius
-            y=circ_s+circ*y_attr(k)/self.ySpan ## get y position along circle's perimeter
-            X=math.sin(y)*x ## transform
-            Y=math.cos(y)*x ## transform
-
-            xs.append(X)
-            ys.append(Y)
-            colours.append(colour(k)) if callable(colour) else colours.append(colour)
-            sizes.append(size(k)) if callable(size) else sizes.append(size)
-
-            if outline:
-                outline_xs.append(xs[-1])
-                outline_ys.append(ys[-1])
-                outline_colours.append(outline_colour(k)) if callable(outline_colour) else outline_colours.append(outline_colour)
-                outline_sizes.append(outline_size(k)) if callable(outline_size) else outline_sizes.append(outline_size)
+        Parameters:
+        path (str or file): Path of the SVG file or an open text file handle.
+        target (function or array or None): A function, boolean mask or array of positions in tree.Objects to select which branches to plot. Default is None, which selects all branches.
+        x_attr (function or array or None): A function or array of x-coordinates. Default is None, which uses the branch's x attribute.
+        y_attr (function or array or None): A function or array of y-coordinates. Default is None, which uses the branch's y attribute.
+        colour (str or function or array or None): The colour of branches (any matplotlib colour). Default is None, which sets the colour to 'k' (black).
+        width (float or function or array or None): The width of branches in pixels. Default is None, which sets the width to 1.
+        circular (bool): If True, plots the tree in a circular layout as in plotCircularTree. Default is False.
+        circStart (float): The starting angle (in fractions of 2*pi) for the circular layout. Default is 0.0.
+        circFrac (float): The fraction of the full circle to use for the circular layout. Default is 1.0.
+        inwardSpace (float): Amount of space to leave in the middle of a circular tree. Default is 0.0.
+        normaliseHeight (function or None): A function to normalize the x-coordinates in the circular layout. Default is None (0.0 at root, 1.0 at the most diverged tip).
+        points (function or array or None): A function, boolean mask or array of positions selecting branches to mark with circles. Default is None (no circles).
+        point_size (float or function or array or None): Radius of circles in pixels. Default is None, which sets the radius to 3.
+        point_colour (str or function or array or None): The colour of circles. Default is None, which sets the colour to 'k' (black).
+        text (function or array or None): Labels of leaf-like branches, branches with a label of None are not labelled. Default is None (no labels).
+        font_size (float or None): Font size of labels in pixels. Default is None, which sets the size to 8.
+        canvas (tuple or None): Width and height of the image in pixels. Default is None, which sets the size to (800,800).
+        margin (float or None): Space in pixels around the tree. Default is None, which sets the margin to 20 (plus space for labels).
+        background (str or None): Colour of the background. Default is None (transparent).
 
-        ax.scatter(xs,ys,s=sizes,facecolor=colours,edgecolor='none',zorder=zorder,**kwargs) ## put a circle at each tip
-        if outline:
-            ax.scatter(outline_xs,outline_ys,s=outline_sizes,facecolor=outline_colours,edgecolor='none',zorder=zorder-1,**kwargs) ## put a circle at each tip
+        Returns:
+        None
 
-        return ax
+        Example:
+        >>> tree.writeSVG('tree.svg', colour=lambda k: 'indianred' if k.traits['host']=='camel' else 'steelblue', text=lambda k: k.name)
+        """
+        from matplotlib.colors import to_hex
+        from xml.sax.saxutils import escape
+
+        if colour is None: colour='k'
+        if width is None: width=1
+        if point_size is None: point_size=3
+        if point_colour is None: point_colour='k'
+        if font_size==None: font_size=8
+        if canvas==None: canvas=(800,800)
+        if margin==None: margin=20+(font_size*8 if text is not None else 0) ## leave space for labels
+
+        selected=self._plotSelection(target)
+        if circular:
+            radii,angles=self._circularCoordinates(x_attr,y_attr,circStart,circFrac,inwardSpace,normaliseHeight)
+            xs,ys=np.sin(angles)*radii,np.cos(angles)*radii
+        else:
+            xs,ys=self._plotCoordinates(x_attr,'x'),self._plotCoordinates(y_attr,'y')
+
+        W,H=canvas
+        minX,maxX,minY,maxY=np.nanmin(xs[selected]),np.nanmax(xs[selected]),np.nanmin(ys[selected]),np.nanmax(ys[selected])
+        scaleX=(W-2*margin)/((maxX-minX) or 1.0)
+        scaleY=(H-2*margin)/((maxY-minY) or 1.0)
+        if circular: scaleX=scaleY=min(scaleX,scaleY) ## circles stay circles
+        px=margin+(xs-minX)*scaleX ## pixel coordinates, y axis points down in SVG
+        py=H-margin-(ys-minY)*scaleY
+
+        hex_colours={}
+        def hexColour(c): ## convert matplotlib colours once
+            key=tuple(c) if isinstance(c,(list,np.ndarray)) else c
+            if key not in hex_colours: hex_colours[key]=to_hex(c)
+            return hex_colours[key]
+
+        colours=self._plotColumn(colour,selected,fallback=(0.7,0.7,0.7))
+        widths=self._plotColumn(width,selected)
+        single_colour=not isinstance(colours,(list,np.ndarray))
+        single_width=not isinstance(widths,(list,np.ndarray))
+
+        position={k: i for i,k in enumerate(self.Objects)}
+        handle=open(path,'w') if isinstance(path,str) else path
+        write,flush=_bufferedWriter(handle) ## write lines in chunks
+        try:
+            write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            write('<svg xmlns="http://www.w3.org/2000/svg" width="%g" height="%g" viewBox="0 0 %g %g">\n'%(W,H,W,H))
+            if background!=None: write('<rect width="100%%" height="100%%" fill="%s"/>\n'%(hexColour(background)))
+            write('<g fill="none" stroke-linecap="square"%s%s>\n'%(' stroke="%s"'%(hexColour(colours)) if single_colour else '',' stroke-width="%g"'%(widths) if single_width else ''))
+
+            cx,cy=margin+(0-minX)*scaleX,H-margin-(0-minY)*scaleY ## centre of circular layouts
+            for j,i in enumerate(selected):
+                k=self.Objects[i]
+                p=position.get(k.parent,-1)
+                x,y=px[i],py[i]
+                d=[]
+                if p>=0 and not np.isnan(xs[p]): ## branch
+                    if circular:
+                        rp=radii[p]*scaleX ## parent's radius along the branch's angle
+                        d.append('M%.2f %.2fL%.2f %.2f'%(cx+math.sin(angles[i])*rp,cy-math.cos(angles[i])*rp,x,y))
+                    else:
+                        d.append('M%.2f %.2fH%.2f'%(px[p],y,x))
+                if k.is_node():
+                    first,last=position[k.children[0]],position[k.children[-1]]
+                    if circular: ## arc through children at the node's radius
+                        r=radii[i]*scaleX
+                        a1,a2=angles[first],angles[last]
+                        x1,y1=cx+math.sin(a1)*r,cy-math.cos(a1)*r
+                        x2,y2=cx+math.sin(a2)*r,cy-math.cos(a2)*r
+                        d.append('M%.2f %.2fA%.2f %.2f 0 %d %d %.2f %.2f'%(x1,y1,r,r,abs(a2-a1)>math.pi,a2>a1,x2,y2))
+                    else: ## vertical line through children
+                        d.append('M%.2f %.2fV%.2f'%(x,py[first],py[last]))
+                if len(d)==0: continue
+                attributes=''
+                if not single_colour: attributes+=' stroke="%s"'%(hexColour(colours[j]))
+                if not single_width: attributes+=' stroke-width="%g"'%(widths[j])
+                write('<path d="%s"%s/>\n'%(''.join(d),attributes))
+            write('</g>\n')
+
+            if points is not None:
+                marked=self._plotSelection(points)
+                sizes=self._plotColumn(point_size,marked)
+                point_colours=self._plotColumn(point_colour,marked)
+                for j,i in enumerate(marked):
+                    r=sizes[j] if isinstance(sizes,(list,np.ndarray)) else sizes
+                    c=point_colours[j] if isinstance(point_colours,(list,np.ndarray)) else point_colours
+                    write('<circle cx="%.2f" cy="%.2f" r="%g" fill="%s"/>\n'%(px[i],py[i],r,hexColour(c)))
+
+            if text is not None:
+                labelled=self._plotSelection(lambda k: k.is_leaflike())
+                labels=self._plotColumn(text,labelled)
+                write('<g font-family="sans-serif" font-size="%g" dominant-baseline="central">\n'%(font_size))
+                for j,i in enumerate(labelled):
+                    label=labels[j] if isinstance(labels,(list,np.ndarray)) else labels
+                    if label is None: continue
+                    if circular: ## labels point away from the centre and are flipped on the left side
+                        rotation=math.degrees(math.atan2(py[i]-cy,px[i]-cx))
+                        flip=abs(rotation)>90
+                        write('<text x="%.2f" y="%.2f" text-anchor="%s" transform="rotate(%.2f %.2f %.2f)">%s</text>\n'%(px[i]+(-font_size/2 if flip else font_size/2),py[i],'end' if flip else 'start',rotation+180 if flip else rotation,px[i],py[i],escape(str(label))))
+                    else:
+                        write('<text x="%.2f" y="%.2f">%s</text>\n'%(px[i]+font_size/2,py[i],escape(str(label))))
+                write('</g>\n')
+
+            write('</svg>\n')
+            flush()
+        finally:
+            if isinstance(path,str): handle.close()
+
+def _squaredDifference(pair):
+    """
+    Default untangling cost: squared difference between the y positions of a tip in two trees.
+    """
+    return math.pow(pair[0]-pair[1],2)
+
+def _untangleTask(reference,target,cost_function,exact_limit):
+    """
+    Summarise a drawn tree as plain lists so that the ordering of its children can be optimised in a separate process.
 
-def untangle(trees,cost_function=None,iterations=None,verbose=False):
+    Tips are ranked by their y position (slots); every clade occupies a contiguous block of slots given by its start and size.
+    """
+    tips=sorted(target.getExternal(),key=lambda k: k.y)
+    slot_y=[k.y for k in tips] ## y positions available in the target tree
+    reference_y=[reference.get(k.name,float('nan')) for k in tips] ## y positions of the same tips in the reference tree
+    position={k: i for i,k in enumerate(target.Objects)}
+
+    start={}
+    size={}
+    for i,k in enumerate(tips):
+        start[position[k]]=i
+        size[position[k]]=1
+
+    nodes=target._preorder(lambda k: k.is_node())
+    for k in reversed(nodes): ## post-order to get sizes and starts of clades
+        children=[position[child] for child in k.children]
+        start[position[k]]=min(start[c] for c in children)
+        size[position[k]]=sum(size[c] for c in children)
+
+    structure=[(position[k],sorted([position[child] for child in k.children],key=lambda c: start[c])) for k in nodes] ## children in order of increasing y
+    return (structure,start,size,slot_y,reference_y,cost_function,exact_limit)
+
+def _untangleOrders(task):
+    """
+    Find child orders for the nodes of one tree that minimise the cost of tip y position discrepancies against a reference tree.
+
+    Nodes are visited from the root down. At each node the cost of placing each child at each possible offset within the node's
+    block of slots is computed once and cached, an exact dynamic programme over subsets of children is used for nodes with up to
+    `exact_limit` children and children are sorted by their mean reference y position otherwise.
+
+    Returns:
+    dict: Positions of nodes in tree.Objects mapped to lists of their children's positions, in order of increasing y.
+    """
+    structure,start,size,slot_y,reference_y,cost_function,exact_limit=task
+    new_start=dict(start) ## start of every clade's block after reordering its ancestors
+    orders={}
+
+    for node,children in structure:
+        offset=new_start[node]
+        costs={}
+        def cost(c,o): ## cost of placing child c at offset o within the node's block
+            if (c,o) not in costs:
+                total=0.0
+                for j in range(size[c]):
+                    ref=reference_y[start[c]+j]
+                    if ref==ref: ## tip present in reference tree (not NaN)
+                        total+=cost_function((ref,slot_y[offset+o+j]))
+                costs[(c,o)]=total
+            return costs[(c,o)]
+
+        m=len(children)
+        if m<=exact_limit:
+            sizes=[size[c] for c in children]
+            best={0: (0.0,None)}
+            mask_size={0: 0}
+            for mask in range(1,1<<m): ## masks in increasing order, all subsets of a mask have been seen before it
+                mask_size[mask]=mask_size[mask&(mask-1)]+sizes[(mask&-mask).bit_length()-1]
+                candidate=None
+                for i in range(m-1,-1,-1): ## on ties prefer keeping the current order
+                    if mask&(1<<i):
+                        rest=mask^(1<<i)
+                        score=best[rest][0]+cost(children[i],mask_size[rest])
+                        if candidate==None or score<candidate[0]:
+                            candidate=(score,i)
+                best[mask]=candidate
+
+            order=[]
+            mask=(1<<m)-1
+            while mask:
+                i=best[mask][1]
+                order.append(children[i])
+                mask^=1<<i
+            order=order[::-1]
+        else:
+            def key(c):
+                ys=[reference_y[start[c]+j] for j in range(size[c]) if reference_y[start[c]+j]==reference_y[start[c]+j]]
+                if len(ys)==0: ys=[slot_y[offset+start[c]-start[node]+j] for j in range(size[c])] ## clade not in reference tree - keep it where it is
+                return sum(ys)/len(ys)
+            order=sorted(children,key=key)
+
+        o=0
+        for c in order:
+            new_start[c]=offset+o
+            o+=size[c]
+        if order!=children:
+            orders[node]=order
+
+    return orders
+
+def untangle(trees,cost_function=None,iterations=None,verbose=False,exact_limit=8,pool=None):
     """
     Minimise y-axis discrepancies between tips of trees in a list.
     Only the tangling of adjacent trees in the list is minimised, so the order of trees matters.
     Trees do not need to have the same number of tips but tip names should match.
     
+    Child orders are chosen from the root down. Nodes with up to `exact_limit` children are ordered exactly with dynamic programming
+    over subsets of children, larger polytomies are ordered by the mean y position of their descendant tips in the adjacent tree.
+    
     Parameters:
     trees (list): A list of tree objects to untangle.
     cost_function (function or None): A function to calculate the cost of y-axis discrepancies between tips.
                                       Default is None, which uses the squared difference between y axis positions.
     iterations (int or None): The number of iterations to perform. Default is None, which sets the iterations to 3.
     verbose (bool): If True, prints verbose output during the process. Default is False.
+    exact_limit (int): Largest number of children of a node for which the exact ordering is computed. Default is 8.
+    pool (object or None): Pool with a `map` method (e.g. multiprocessing.Pool). When provided trees that are not neighbours of
+                           each other are reordered in parallel, alternating between even and odd positions in the list.
+                           The cost function needs to be picklable for process pools. Default is None (trees processed in turn).
     
     Returns:
     list: The list of untangled tree objects.
     
     Example:
     >>> untangled_trees = untangle(list_of_trees, iterations=5, verbose=True)
+    >>> with multiprocessing.Pool(4) as p: untangled_trees = untangle(list_of_trees, pool=p)
     
     Docstring generated with ChatGPT 4o.
     """
-    from itertools import permutations
-
     if iterations==None: iterations=3
-    if cost_function==None: cost_function=lambda pair: math.pow(abs(pair[0]-pair[1]),2)
+    if cost_function==None: cost_function=_squaredDifference
 
     y_positions={T: {k.name: k.y for k in T.getExternal()} for T in trees} ## get y positions of all the tips in every tree
 
+    def apply(tree,orders): ## reorder children and redraw tree
+        for node,order in orders.items():
+            k=tree.Objects[node]
+            k.children=[tree.Objects[c] for c in reversed(order)] ## first child is drawn at the top
+        tree.drawTree() ## compute new y coordinates for nodes
+        y_positions[tree]={k.name: k.y for k in tree.getExternal()} ## remember new coordinates
+
     for iteration in range(iterations):
         if verbose: print('Untangling iteration %d'%(iteration+1))
         first_trees=list(range(len(trees)-1))+[-1] ## trees up to next-to-last + last
         next_trees=list(range(1,len(trees)))+[0] ## trees from second + first
-        for cur,nex in zip(first_trees,next_trees): ## adjacent pairs
-            tree1=trees[cur] ## fetch current tree
-            tree2=trees[nex] ## fetch next tree
-            if verbose: print('%d vs %d'%(cur,nex))
-            for k in sorted(tree2.getInternal(),key=lambda branch: branch.height): ## iterate through nodes of next tree by height (start from root)
-                clade_y_positions=sorted([y_positions[tree2][tip] for tip in k.leaves]) ## sorted list of available y coordinates for node
-                costs={} ## will store cost of all children permutations
-                if len(k.children)>=10: raise RuntimeWarning('Node is too polytomic and untangling will take an astronomically long time')
-                if verbose==True: print(len(k.children))
-                for permutation in permutations(k.children): ## iterate over permutations of node's children
-                    clade_order=sum([[child.name] if child.is_leaf() else list(child.leaves) for child in permutation],[]) ## flat list of tip names as they would appear in permutation order
-                    new_y_positions={clade_order[i]: clade_y_positions[i] for i in range(len(clade_y_positions))} ## assign available y positions in order
-
-                    tip_costs=list(map(cost_function,[(y_positions[tree1][tip],new_y_positions[tip]) for tip in clade_order if tip in y_positions[tree1]]))
-                    costs[permutation]=sum(tip_costs)/len(tip_costs) ## compute cost of this permutation in relation to next tree
-
-                best=sorted(costs.keys(),key=lambda w: -costs[w])[0] ## get tree with smallest cost
-                k.children=list(best) ## reorder children according to minimised cost
-
-            tree2.drawTree() ## compute new y coordinates for nodes
-            for k in tree2.getExternal(): ## iterate over tips
-                y_positions[tree2][k.name]=k.y ## remember new coordinates
+        pairs=list(zip(first_trees,next_trees)) ## adjacent pairs
+
+        if pool==None:
+            for cur,nex in pairs:
+                if verbose: print('%d vs %d'%(cur,nex))
+                tree1=trees[cur] ## fetch current tree
+                tree2=trees[nex] ## fetch next tree
+                apply(tree2,_untangleOrders(_untangleTask(y_positions[tree1],tree2,cost_function,exact_limit)))
+        else:
+            phase=lambda nex: 2 if len(trees)%2==1 and nex==0 else nex%2 ## trees in a phase are never each other's neighbours
+            for p in range(3):
+                batch=[(cur,nex) for cur,nex in pairs if phase(nex)==p]
+                tasks=[_untangleTask(y_positions[trees[cur]],trees[nex],cost_function,exact_limit) for cur,nex in batch]
+                for (cur,nex),orders in zip(batch,pool.map(_untangleOrders,tasks)):
+                    if verbose: print('%d vs %d'%(cur,nex))
+                    apply(trees[nex],orders)
 
     return trees
 
@@ -1906,7 +3797,7 @@ def make_tree(data,ll=None,verbose=False):
             comment=match.group(2)
             numerics=re.findall('[,&][A-Za-z\_\.0-9]+=[0-9\-Ee\.]+',comment) ## find all entries that have values as floats
             strings=re.findall('[,&][A-Za-z\_\.0-9]+=["|\']*[A-Za-z\_0-9\.\+ :\/\(\)\&\-]+[\"|\']*',comment) ## strings
-            treelist=re.findall('[,&][A-Za-z\_\.0-9]+={[A-Za-z\_,{}0-9\. :\/\(\)\&]+}',comment) ## complete history logged robust counting (MCMC trees)
+            treelist=re.findall(r'[,&][A-Za-z\_\.0-9]+={[A-Za-z\_,{}0-9\.\- :\/\(\)\&]+}',comment) ## complete history logged robust counting (MCMC trees)
             sets=re.findall('[,&][A-Za-z\_\.0-9\%]+={[A-Za-z\.\-0-9eE,\"\_ :\/\(\)\&]+}',comment) ## sets and ranges
             figtree=re.findall('\![A-Za-z]+=[A-Za-z0-9# :\/\(\)\&]+',comment)
 
@@ -1926,15 +3817,11 @@ def make_tree(data,ll=None,verbose=False):
             for val in treelist:
                 tr,val=val.split('=')
                 tr=tr[1:]
-                micromatch = []
-                if val.count(",") == 2:
-                    micromatch=re.findall(r'{([0-9\.\-e]+,[a-z_A-Z]+,[a-z_A-Z]+)}',val)
-                elif val.count(",") == 3:
-                    micromatch=re.findall(r'{([0-9]+,[0-9\.\-e]+,[A-Z]+,[A-Z]+)}',val)
                 ll.cur_node.traits[tr]=[]
-                for val in micromatch:
-                    val_split = val.split(',')
-                    ll.cur_node.traits[tr].append(val.split(","))
+                for val in re.findall(r'{([^{}]+)}',val): ## each change is {time,from,to} or {site,time,from,to}
+                    val_split=val.split(',')
+                    if len(val_split) in (3,4):
+                        ll.cur_node.traits[tr].append(val_split)
 
             for vals in sets:
                 tr,val=vals.split('=')
@@ -1980,48 +3867,55 @@ def make_tree(data,ll=None,verbose=False):
             return ll
             break ## end loop
 
-def make_treeJSON(JSONnode,json_translation,ll=None,verbose=False):
+def make_treeJSON(JSONnode,json_translation,ll=None,verbose=False,process=None):
     """
     Parse an auspice JSON tree and create a baltic tree object.
+
+    The JSON is walked in pre-order without recursion and is not modified, attributes of auspice v1 JSONs (`attr`) are merged into traits.
     
     Parameters:
     JSONnode (dict): The JSON node to be parsed.
     json_translation (dict): A dictionary for translating JSON keys to tree attributes.
     ll (tree or None): An instance of a tree object. If None, a new tree object is created. Default is None.
     verbose (bool): If True, prints verbose output during the process. Default is False.
+    process (function or None): A function called with every new branch and its JSON node, after its parent has been processed. Default is None.
     
     Returns:
     tree: The tree object created from the parsed JSON.
     
     Docstring generated with ChatGPT 4o.
     """
-    if 'children' in JSONnode: ## only nodes have children
-        new_node=node()
-    else:
-        new_node=leaf()
-        new_node.name=JSONnode[json_translation['name']] ## set leaf name to be the same
-
-    if ll is None:
-        ll=tree()
-        ll.root=new_node
-    if 'attr' in JSONnode:
-        attr = JSONnode.pop('attr')
-        JSONnode.update(attr)
-
-    new_node.parent=ll.cur_node ## set parent-child relationships
-    ll.cur_node.children.append(new_node)
-    new_node.index=JSONnode[json_translation['name']] ## indexing is based on name
-    new_node.traits={n:JSONnode[n] for n in list(JSONnode.keys()) if n!='children'} ## set traits to non-children attributes
-    ll.Objects.append(new_node)
-    ll.cur_node=new_node
-
-    if 'children' in JSONnode:
-        for child in JSONnode['children']:
-            make_treeJSON(child,json_translation,ll)
-            ll.cur_node=ll.cur_node.parent
+    stack=[(JSONnode,None)]
+    while stack:
+        JSONnode,parent=stack.pop()
+        if 'children' in JSONnode: ## only nodes have children
+            new_node=node()
+        else:
+            new_node=leaf()
+            new_node.name=JSONnode[json_translation['name']] ## set leaf name to be the same
+
+        if ll is None:
+            ll=tree()
+            ll.root=new_node
+        if parent is None: parent=ll.cur_node
+
+        traits={n:JSONnode[n] for n in JSONnode if n!='children' and n!='attr'} ## set traits to non-children attributes
+        if 'attr' in JSONnode:
+            traits.update(JSONnode['attr'])
+
+        new_node.parent=parent ## set parent-child relationships
+        parent.children.append(new_node)
+        new_node.index=traits[json_translation['name']] ## indexing is based on name
+        new_node.traits=traits
+        ll.Objects.append(new_node)
+        if process!=None: process(new_node,JSONnode)
+
+        if 'children' in JSONnode:
+            for child in reversed(JSONnode['children']):
+                stack.append((child,new_node))
     return ll
 
-def loadNewick(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',variableDate=True,absoluteTime=False,verbose=False, sortBranches = True):
+def loadNewick(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',variableDate=True,absoluteTime=False,verbose=False, sortBranches = True, timer=None, tip_table=None):
     """
     Load a tree from a Newick file and process it.
     
@@ -2033,6 +3927,8 @@ def loadNewick(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-
     absoluteTime (bool): If True, converts the tree to absolute time using the tip dates encoded in tip names. Default is False.
     verbose (bool): If True, prints verbose output during the process. Default is False.
     sortBranches (bool): If True, sorts the branches of the tree after loading. Default is True.
+    timer (phaseTimer or None): Accumulates time spent parsing, traversing, sorting and calibrating the tree. Default is None.
+    tip_table (tipTable or None): Tip dates parsed beforehand (e.g. when loading many trees with the same tips), used instead of searching tip names with tip_regex. Default is None.
     
     Returns:
     tree: The tree object created from the Newick file.
@@ -2046,37 +3942,40 @@ def loadNewick(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-
     Docstring generated with ChatGPT 4o.
     """
     ll=None
+    if timer is None: timer=phaseTimer()
 
     handle = open(tree_path, 'r') if isinstance(tree_path, str) else tree_path
 
-    for line in handle:
-        l=line.strip('\n')
-        if '(' in l:
-            treeString_start=l.index('(')
-            ll=make_tree(l[treeString_start:],verbose=verbose) ## send tree string to make_tree function
-            if verbose==True: print('Identified tree string')
+    with timer.phase('parse'):
+        for line in handle:
+            l=line.strip('\n')
+            if '(' in l:
+                treeString_start=l.index('(')
+                ll=make_tree(l[treeString_start:],verbose=verbose) ## send tree string to make_tree function
+                if verbose==True: print('Identified tree string')
 
     assert ll,'Regular expression failed to find tree string'
-    ll.traverse_tree(verbose=verbose) ## traverse tree
+    with timer.phase('traverse'):
+        ll.traverse_tree(verbose=verbose) ## traverse tree
     
-    if sortBranches: ll.sortBranches() ## traverses tree, sorts branches, draws tree
+    if sortBranches:
+        with timer.phase('sort'):
+            ll.sortBranches() ## traverses tree, sorts branches, draws tree
 
     if absoluteTime==True:
-        tip_dates=[]
-        tip_names=[]
-        for k in ll.getExternal():
-            tip_names.append(k.name)
-            match=re.search(tip_regex,k.name)
-            if match:
-                tip_dates.append(decimalDate(match.group(1),fmt=date_fmt,variable=variableDate))
-        assert len(tip_dates)>0,'Regular expression failed to find tip dates in tip names, review regex pattern or set absoluteTime option to False.\nFirst tip name encountered: %s\nDate regex set to: %s\nExpected date format: %s'%(tip_names[0],tip_regex,date_fmt)
-        ll.setAbsoluteTime(max(tip_dates))
+        with timer.phase('calibrate'):
+            if tip_table is None: ## tip names are searched for dates once
+                tip_table=tipTable([k.name for k in ll.getExternal()],tip_regex=tip_regex,date_fmt=date_fmt,variableDate=variableDate)
+                assert np.isfinite(tip_table.dates).any(),'Regular expression failed to find tip dates in tip names, review regex pattern or set absoluteTime option to False.\nFirst tip name encountered: %s\nDate regex set to: %s\nExpected date format: %s'%(tip_table.names[0],tip_regex,date_fmt)
+            tip_table.assign(ll)
+            tip_table.calibrate(ll)
 
     if isinstance(tree_path,str):
         handle.close()
+    timer.count()
     return ll
 
-def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',treestring_regex='tree [A-Za-z\_]+([0-9]+)',variableDate=True,absoluteTime=True,verbose=False, sortBranches=True):
+def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',treestring_regex='tree [A-Za-z\_]+([0-9]+)',variableDate=True,absoluteTime=True,verbose=False, sortBranches=True, timer=None, tip_table=None):
     """
     Load a tree from a Nexus file and process it.
     
@@ -2089,6 +3988,8 @@ def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%
     absoluteTime (bool): If True, converts the tree to absolute time using the tip dates extracted from tip names. Default is True.
     verbose (bool): If True, prints verbose output during the process. Default is False.
     sortBranches (bool): If True, sorts the branches of the tree after loading. Default is True.
+    timer (phaseTimer or None): Accumulates time spent parsing, traversing, sorting and calibrating the tree. Default is None.
+    tip_table (tipTable or None): Tip dates parsed beforehand (e.g. when loading many trees with the same tips), used instead of searching tip names with tip_regex. Default is None.
     
     Returns:
     tree: The tree object created from the NEXUS file.
@@ -2105,60 +4006,421 @@ def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%
     tips={}
     tip_num=0
     ll=None
+    if timer is None: timer=phaseTimer()
 
     handle = open(tree_path, 'r') if isinstance(tree_path, str) else tree_path
 
-    for line in handle:
-        l=line.strip('\n')
-
-        match=re.search('Dimensions ntax=([0-9]+);',l)
-        if match:
-            tip_num=int(match.group(1))
-            if verbose==True: print('File should contain %d taxa'%(tip_num))
-
-        match=re.search(treestring_regex,l)
-        if match:
-            treeString_start=l.index('(')
-            ll=make_tree(l[treeString_start:],verbose=verbose) ## send tree string to make_tree function
-            if verbose==True: print('Identified tree string')
+    with timer.phase('parse'):
+        for line in handle:
+            l=line.strip('\n')
 
-        if tip_flag:
-            match=re.search('([0-9]+) ([A-Za-z\-\_\/\.\'0-9 \|?]+)',l)
+            match=re.search('Dimensions ntax=([0-9]+);',l)
             if match:
-                tips[match.group(1)]=match.group(2).strip('"').strip("'")
-                if verbose==True: print('Identified tip translation %s: %s'%(match.group(1),tips[match.group(1)]))
-            elif ';' not in l:
-                print('tip not captured by regex:',l.replace('\t',''))
+                tip_num=int(match.group(1))
+                if verbose==True: print('File should contain %d taxa'%(tip_num))
 
-        if 'Translate' in l:
-            tip_flag=True
-        if ';' in l:
-            tip_flag=False
+            match=re.search(treestring_regex,l)
+            if match:
+                treeString_start=l.index('(')
+                ll=make_tree(l[treeString_start:],verbose=verbose) ## send tree string to make_tree function
+                if verbose==True: print('Identified tree string')
+
+            if tip_flag:
+                match=re.search('([0-9]+) ([A-Za-z\-\_\/\.\'0-9 \|?]+)',l)
+                if match:
+                    tips[match.group(1)]=match.group(2).strip('"').strip("'")
+                    if verbose==True: print('Identified tip translation %s: %s'%(match.group(1),tips[match.group(1)]))
+                elif ';' not in l:
+                    print('tip not captured by regex:',l.replace('\t',''))
+
+            if 'Translate' in l:
+                tip_flag=True
+            if ';' in l:
+                tip_flag=False
 
     assert ll,'Failed to find tree string using regular expression'
-    ll.traverse_tree() ## traverse tree
+    with timer.phase('traverse'):
+        ll.traverse_tree() ## traverse tree
     if sortBranches:
-        ll.sortBranches() ## traverses tree, sorts branches, draws tree
+        with timer.phase('sort'):
+            ll.sortBranches() ## traverses tree, sorts branches, draws tree
     if len(tips)>0:
-        ll.renameTips(tips) ## renames tips from numbers to actual names
-        ll.tipMap=tips
+        with timer.phase('parse'):
+            ll.renameTips(tips) ## renames tips from numbers to actual names
+            ll.tipMap=tips
     if absoluteTime==True:
-        tip_dates=[]
-        tip_names=[]
-        for k in ll.getExternal():
-            tip_names.append(k.name)
-            match=re.search(tip_regex,k.name)
-            if match:
-                tip_dates.append(decimalDate(match.group(1),fmt=date_fmt,variable=variableDate))
-
-        assert len(tip_dates)>0,'Regular expression failed to find tip dates in tip names, review regex pattern or set absoluteTime option to False.\nFirst tip name encountered: %s\nDate regex set to: %s\nExpected date format: %s'%(tip_names[0],tip_regex,date_fmt)
-        ll.setAbsoluteTime(max(tip_dates))
+        with timer.phase('calibrate'):
+            if tip_table is None: ## tip names are searched for dates once
+                tip_table=tipTable(tips if len(tips)>0 else [k.name for k in ll.getExternal()],tip_regex=tip_regex,date_fmt=date_fmt,variableDate=variableDate)
+                assert np.isfinite(tip_table.dates).any(),'Regular expression failed to find tip dates in tip names, review regex pattern or set absoluteTime option to False.\nFirst tip name encountered: %s\nDate regex set to: %s\nExpected date format: %s'%(tip_table.names[0],tip_regex,date_fmt)
+            tip_table.assign(ll)
+            tip_table.calibrate(ll)
 
     if isinstance(tree_path,str):
         handle.close()
+    timer.count()
     return ll
 
-def loadJSON(json_object,json_translation={'name':'name','absoluteTime':'num_date'},verbose=False,sort=True,stats=True):
+def streamNexus(tree_path,burnin=0,states=None,treestring_regex=r'tree [A-Za-z\_]+([0-9]+)',timer=None,tip_table=None):
+    r"""
+    Iterate over the trees of a NEXUS file with many trees (e.g. a posterior sample from BEAST) one at a time, so that only one tree is held in memory.
+    Tip encodings of the Translate block are read once and tips of every tree are renamed with them. Trees are traversed, but not sorted or drawn.
+
+    Parameters:
+    tree_path (str or file-like object): The path to the NEXUS file or a file-like object.
+    burnin (int): Trees with a state (number in the tree name) lower than this are skipped. Default is 0.
+    states (tuple or None): Range of states (lower inclusive, upper exclusive) to read, e.g. a chunk of the file for one process. Default is None (all states).
+    treestring_regex (str): A regular expression identifying tree lines, which captures the state. Default is 'tree [A-Za-z\_]+([0-9]+)'.
+    timer (phaseTimer or None): Accumulates time spent parsing, traversing and calibrating trees. Default is None.
+    tip_table (tipTable or None): If given, every tree is placed in absolute time with the tip dates of the table (see `tipTable.calibrate()`). Default is None.
+
+    Returns:
+    generator: Yields tuples of state (int) and tree. The Translate block is available as `tipMap` of each tree.
+
+    Example:
+    >>> for state,ll in streamNexus('posterior.trees',burnin=1000000):
+    ...     print(state,ll.treeHeight)
+    """
+    lower,upper=states if states is not None else (0,float('inf'))
+    if timer is None: timer=phaseTimer()
+    tip_flag=False
+    tips={}
+    handle = open(tree_path, 'r') if isinstance(tree_path, str) else tree_path
+    try:
+        for line in handle:
+            l=line.strip('\n')
+            match=re.search(treestring_regex,l)
+            if match:
+                state=int(match.group(1))
+                if state>=upper: ## past the range of states
+                    break
+                elif state<burnin or state<lower:
+                    continue
+                with timer.phase('parse'):
+                    ll=make_tree(l[l.index('('):]) ## send tree string to make_tree function
+                    if tip_table is not None:
+                        tip_table.assign(ll) ## tip numbers of the Translate block are looked up once
+                    if len(tips)>0:
+                        ll.renameTips(tips) ## rename tips before traversal so that descendant tips of nodes are recorded by name
+                        ll.tipMap=tips
+                with timer.phase('traverse'):
+                    ll.traverse_tree()
+                if tip_table is not None:
+                    with timer.phase('calibrate'):
+                        tip_table.calibrate(ll)
+                timer.count()
+                yield state,ll
+            elif tip_flag:
+                match=re.search(r'([0-9]+) ([A-Za-z\-\_\/\.\'0-9 \|?]+)',l)
+                if match:
+                    tips[match.group(1)]=match.group(2).strip('"').strip("'")
+            if 'Translate' in l:
+                tip_flag=True
+            if ';' in l:
+                tip_flag=False
+    finally:
+        if isinstance(tree_path,str):
+            handle.close()
+
+def _hpd(values,mass=0.95):
+    """
+    Shortest interval that contains a proportion of sorted values.
+    """
+    n=len(values)
+    m=min(max(int(math.ceil(mass*n)),1),n)
+    widths=values[m-1:]-values[:n-m+1]
+    i=int(np.argmin(widths))
+    return [float(values[i]),float(values[i+m-1])]
+
+def mccTree(tree_path,burnin=0,states=None,heights='keep',hpd=0.95,counter=None,timer=None,samples=1000):
+    """
+    Find the maximum clade credibility (MCC) tree in a posterior sample of trees and annotate it, like TreeAnnotator does.
+    The file is streamed, so only one tree is in memory at a time: the first pass counts clades (skipped if a counter is given), the second finds the tree with the highest product of clade credibilities
+    (sum of log clade frequencies) and a third pass collects node ages of the chosen tree's clades only, since they are not known before the second pass ends.
+    Memory does not grow with the number of trees: besides the clade counts, each clade of the chosen tree keeps the sum, minimum and maximum of its ages and a uniform random sample of at most `samples` ages,
+    from which medians and HPD intervals are computed (exactly, if the clade is found in no more than `samples` trees).
+
+    Nodes of the chosen tree are annotated with the trait names `make_tree` gives to TreeAnnotator output: `posterior` (clade frequency), `height` (mean age), `height_median`, `height_95%_HPD` and `height_range`.
+
+    Parameters:
+    tree_path (str or file-like object): The path to the NEXUS file with trees (or a seekable file-like object).
+    burnin (int): Trees with a state lower than this are skipped. Default is 0.
+    states (tuple or None): Range of states (lower inclusive, upper exclusive) to use. Default is None (all states).
+    heights (str): 'keep' keeps the node heights of the chosen tree, 'mean' or 'median' sets node ages to the mean or median age of their clades. Default is 'keep'.
+    hpd (float): Mass of the highest posterior density interval. Default is 0.95 (the trait name stays `height_95%_HPD`).
+    counter (cladeCounter or None): Clade counts of the same trees (same burnin and states), e.g. merged from counters of chunks counted in parallel. Default is None, which counts clades in a first pass.
+    timer (phaseTimer or None): Accumulates time spent parsing and traversing trees across passes. Default is None.
+    samples (int): Largest number of ages kept per clade of the chosen tree for medians and HPD intervals (reservoir sampling with a fixed seed). Default is 1000.
+
+    Returns:
+    tuple: The annotated MCC tree (sorted and drawn), its state and its log clade credibility.
+
+    Raises:
+    AssertionError: If no trees are found or if a given counter did not count the streamed trees.
+
+    Example:
+    >>> mcc,state,score=mccTree('posterior.trees',burnin=1000000,heights='median')
+    >>> mcc.root.traits['height_95%_HPD']
+    """
+    assert heights in ('keep','mean','median'),'Unknown heights option %s'%(heights)
+    def trees(): ## one streaming pass over the file
+        if not isinstance(tree_path,str): tree_path.seek(0)
+        return streamNexus(tree_path,burnin=burnin,states=states,timer=timer)
+
+    if counter is None:
+        counter=cladeCounter()
+        for state,ll in trees():
+            counter.add(ll,heights=False)
+    assert counter.trees>0,'No trees found'
+
+    best=None
+    streamed=0
+    for state,ll in trees():
+        frequencies=[counter.frequency(m) for m in counter.nodeMasks(ll)]
+        assert all(frequencies),'Tree at state %d has clades that were not counted, the counter has to count the same trees (burnin and states) as the ones streamed'%(state)
+        score=sum(math.log(f) for f in frequencies)
+        if best is None or score>best[0]:
+            best=(score,state,ll) ## only the best tree so far is kept
+        streamed+=1
+    assert streamed==counter.trees,'The counter counted %d trees, but %d trees were streamed with burnin %s and states %s'%(counter.trees,streamed,burnin,states)
+    score,state,mcc=best
+
+    target=counter.nodeMasks(mcc)
+    rows={m: i for i,m in enumerate(target)}
+    seen=np.zeros(len(rows),dtype=int) ## trees with each clade
+    sums=np.zeros(len(rows))
+    lows=np.full(len(rows),np.inf)
+    highs=np.full(len(rows),-np.inf)
+    reservoir=np.zeros((len(rows),samples)) ## uniform sample of ages of each clade
+    random=np.random.RandomState(0)
+    for s,ll in trees():
+        found=[(rows[m],ll.treeHeight-k.height) for m,k in counter.nodeMasks(ll).items() if m in rows]
+        if len(found)==0: continue
+        idx=np.array([i for i,age in found])
+        ages=np.array([age for i,age in found])
+        seen[idx]+=1
+        sums[idx]+=ages
+        lows[idx]=np.minimum(lows[idx],ages)
+        highs[idx]=np.maximum(highs[idx],ages)
+        slots=np.where(seen[idx]<=samples,seen[idx]-1,(random.random_sample(len(idx))*seen[idx]).astype(int)) ## later ages replace kept ones with decreasing probability
+        keep=slots<samples
+        reservoir[idx[keep],slots[keep]]=ages[keep]
+
+    for m,k in target.items():
+        i=rows[m]
+        values=np.sort(reservoir[i,:min(seen[i],samples)])
+        k.traits['posterior']=counter.frequency(m)
+        k.traits['height']=float(sums[i]/seen[i])
+        k.traits['height_median']=float(np.median(values))
+        k.traits['height_95%_HPD']=_hpd(values,hpd)
+        k.traits['height_range']=[float(lows[i]),float(highs[i])]
+
+    if heights!='keep': ## move nodes to summarised ages, tips keep theirs
+        key='height' if heights=='mean' else 'height_median'
+        nodes=set(target.values())
+        age={k: k.traits[key] if k in nodes else mcc.treeHeight-k.height for k in mcc.Objects}
+        for k in mcc.Objects:
+            if k.parent in age:
+                k.length=age[k.parent]-age[k]
+        mcc.traverse_tree()
+    mcc.sortBranches()
+    return mcc,state,score
+
+def tmrcaDistributions(trees,tipsets,tips=None,monophyly=False,most_recent=None,chunk=10000):
+    """
+    Find the most recent common ancestors of named sets of tips across a stream of trees (e.g. from `streamNexus`) and collect their ages.
+    Each set is turned into a bitmask of tips once. In every tree, descendant tips of branches are combined as bitmasks from the tips up and the first node whose bitmask contains a set is its common ancestor.
+
+    Parameters:
+    trees (iterable): Traversed trees, or tuples of state and tree as yielded by `streamNexus`.
+    tipsets (dict): Names of sets to lists of tip names.
+    tips (list or None): Names of all tips, used to assign bits. Default is None, which takes them from the first tree.
+    monophyly (bool): If True, also record whether each set is monophyletic (its common ancestor has no other descendant tips). Default is False.
+    most_recent (float or None): Decimal date of the most recent tip. If given, dates of common ancestors are returned instead of ages. Default is None.
+    chunk (int): Number of trees collected before rows are converted to an array. Default is 10000.
+
+    Returns:
+    numpy.ndarray: A structured array with one row per tree. Fields are `state` (int64), one float64 field per set with ages (time before the most recent tip) or dates of its common ancestor
+                   and, if monophyly is True, one boolean field per set named `<set>_monophyletic`.
+
+    Example:
+    >>> tmrcas=tmrcaDistributions(streamNexus('posterior.trees',burnin=1000000),{'B.1': ['A|2020-01-05','B|2020-02-01','C|2020-01-24']},monophyly=True)
+    >>> np.percentile(tmrcas['B.1'],[2.5,50,97.5]),tmrcas['B.1_monophyletic'].mean()
+    """
+    names=list(tipsets)
+    dtype=[('state','i8')]+[(name,'f8') for name in names]
+    if monophyly: dtype+=[('%s_monophyletic'%(name),'?') for name in names]
+    bits=None if tips is None else {name: i for i,name in enumerate(tips)}
+    targets=None
+    chunks,rows=[],[]
+    for i,entry in enumerate(trees):
+        state,ll=entry if isinstance(entry,tuple) else (i,entry)
+        if bits is None:
+            bits={k.name: j for j,k in enumerate(ll.getExternal())}
+        if targets is None: ## bitmask of each set
+            missing=[tip for name in names for tip in tipsets[name] if tip not in bits]
+            assert len(missing)==0,'Tips not found in trees: %s'%(', '.join(missing))
+            targets=[reduce(lambda a,b: a|b,(1<<bits[tip] for tip in tipsets[name])) for name in names]
+
+        found=[None]*len(targets)
+        flags=[False]*len(targets)
+        left=len(targets)
+        mask={}
+        for k in reversed(ll._preorder()): ## descendants always come before their ancestors
+            if k.is_node():
+                m=reduce(lambda a,b: a|b,(mask[child] for child in k.children))
+            else:
+                m=1<<bits[k.name]
+            mask[k]=m
+            for j,target in enumerate(targets):
+                if found[j] is None and m&target==target: ## youngest branch that has every tip of the set
+                    found[j]=k
+                    flags[j]=m==target
+                    left-=1
+            if left==0: break
+
+        ages=[ll.treeHeight-k.height for k in found]
+        if most_recent is not None: ages=[most_recent-age for age in ages]
+        rows.append(tuple([state]+ages+(flags if monophyly else [])))
+        if len(rows)>=chunk:
+            chunks.append(np.array(rows,dtype=dtype))
+            rows=[]
+    chunks.append(np.array(rows,dtype=dtype))
+    return np.concatenate(chunks)
+
+def transitionEvents(trees,trait=None,history=None,categories=None,most_recent=None):
+    """
+    Extract changes of a discrete trait from a stream of trees (e.g. from `streamNexus`) into one structured array of events.
+    Changes are either inferred from differences between the trait values of parent and child branches (placed halfway along the branch) or decoded from
+    complete histories logged by BEAST (Markov jumps or robust counting), which `make_tree` parses into lists of [time, from, to] or [site, time, from, to] entries.
+    Trait values are coded as integers once, so counts can be aggregated across trees with numpy (see `transitionMatrix`).
+
+    Parameters:
+    trees (iterable): Traversed trees, or tuples of state and tree as yielded by `streamNexus`.
+    trait (str or None): Discrete trait compared between parent and child branches.
+    history (str or None): Trait with a complete history (e.g. 'completeHistory_1'). Times in histories are taken to be heights (time before the most recent tip), as BEAST logs them. Only one of trait or history can be given.
+    categories (list or None): Trait values in the order of their codes, e.g. from an earlier call so that codes match. New values are appended. Default is None.
+    most_recent (float or None): Decimal date of the most recent tip. If given, event times are dates instead of time before the most recent tip. Default is None.
+
+    Returns:
+    tuple: A structured array of events and the list of categories. Fields of events are `tree` (state or position in the stream, int64), `branch` (position of the branch in the tree's `Objects`, int32),
+           `time` (float64), `site` (int32, -1 unless histories are per site), `from` and `to` (int32 codes of categories).
+
+    Example:
+    >>> events,categories=transitionEvents(streamNexus('posterior.trees',burnin=1000000),trait='location.states')
+    >>> transitionMatrix(events,categories)/len(np.unique(events['tree'])) ## mean number of jumps between locations per tree
+    """
+    assert (trait is None)!=(history is None),'Provide either a trait or a complete history trait'
+    dtype=[('tree','i8'),('branch','i4'),('time','f8'),('site','i4'),('from','i4'),('to','i4')]
+    categories=[] if categories is None else list(categories)
+    codes={value: i for i,value in enumerate(categories)}
+    def code(value):
+        if value not in codes:
+            codes[value]=len(categories)
+            categories.append(value)
+        return codes[value]
+
+    chunks=[]
+    for i,entry in enumerate(trees):
+        state,ll=entry if isinstance(entry,tuple) else (i,entry)
+        Objects=ll.Objects
+        if trait is not None:
+            position={k: j for j,k in enumerate(Objects)}
+            values=np.array([code(k.traits[trait]) if trait in k.traits else -1 for k in Objects],dtype='i4')
+            parents=np.array([position.get(k.parent,-1) for k in Objects],dtype='i4')
+            parent_values=np.where(parents>=0,values[parents],-1)
+            branches=np.flatnonzero((values>=0)&(parent_values>=0)&(values!=parent_values))
+            heights=np.array([Objects[j].height for j in branches],dtype='f8')
+            lengths=np.array([Objects[j].length for j in branches],dtype='f8')
+            events=np.empty(len(branches),dtype=dtype)
+            events['branch']=branches
+            events['time']=ll.treeHeight-heights+0.5*lengths ## halfway along the branch
+            events['site']=-1
+            events['from']=parent_values[branches]
+            events['to']=values[branches]
+        else:
+            rows=[]
+            for j,k in enumerate(Objects):
+                for change in k.traits.get(history,[]):
+                    rows.append((state,j,float(change[-3]),int(change[0]) if len(change)==4 else -1,code(change[-2]),code(change[-1])))
+            events=np.array(rows,dtype=dtype)
+        events['tree']=state
+        if most_recent is not None:
+            events['time']=most_recent-events['time']
+        chunks.append(events)
+    events=np.concatenate(chunks) if chunks else np.empty(0,dtype=dtype)
+    return events,categories
+
+def transitionMatrix(events,categories,weights=None):
+    """
+    Count events between each pair of categories.
+
+    Parameters:
+    events (numpy.ndarray): Events from `transitionEvents`.
+    categories (list): Categories from `transitionEvents`.
+    weights (numpy.ndarray or None): Weight of each event. Default is None (each event counts as 1).
+
+    Returns:
+    numpy.ndarray: Matrix where entry [i,j] is the number (or weight) of changes from categories[i] to categories[j].
+    """
+    matrix=np.zeros((len(categories),len(categories)))
+    np.add.at(matrix,(events['from'],events['to']),1.0 if weights is None else weights)
+    return matrix
+
+def writeNexusTrees(trees,fh,traits=None,tips=None,states=None,quotechar="'"):
+    """
+    Write a set of trees (e.g. a modified posterior sample) to a single NEXUS file in the layout used by BEAST.
+    Tip names are written once in a Translate block and replaced by integer codes in tree strings, each tree is written on one line as `tree STATE_n = [&R] ...`.
+
+    Parameters:
+    trees (iterable): Tree objects to write.
+    fh (str or file): Path of the output file or an open text file handle.
+    traits (list or None): A list of keys to output entries in the traits dictionary of each branch. Default is all available traits of each tree.
+    tips (list or None): Names of all tips across trees, in the order they should be coded. Default is None, which collects tip names from the trees first (trees are then held in memory).
+                         When given, trees are written as they come from the iterable.
+    states (iterable or None): Numbers used in tree names. Default is None, which numbers trees from 0.
+    quotechar (str): The character used to quote tip names in the taxa and Translate blocks. Default is "'".
+
+    Returns:
+    int: The number of trees written.
+
+    Example:
+    >>> writeNexusTrees([ll.reduceTree(tips) for ll in posterior], 'reduced.trees')
+    >>> reduced = loadNexus('reduced.trees', absoluteTime=False) ## reads the last tree
+    """
+    if tips==None: ## need every tip name before any tree is written
+        trees=list(trees)
+        names={}
+        for ll in trees:
+            names.update(dict.fromkeys(k.name for k in ll.getExternal() if k.is_leaf()))
+        tips=list(names)
+    codes={name: '%d'%(i+1) for i,name in enumerate(tips)}
+    if states==None: states=iter(range(sys.maxsize))
+    else: states=iter(states)
+
+    handle=open(fh,'w') if isinstance(fh,str) else fh
+    write,flush=_bufferedWriter(handle)
+
+    write('#NEXUS\n\nBegin taxa;\n\tDimensions ntax=%d;\n\tTaxlabels\n'%(len(tips)))
+    for name in tips:
+        write('\t\t%s%s%s\n'%(quotechar,name,quotechar))
+    write('\t\t;\nEnd;\n\nBegin trees;\n\tTranslate\n')
+    for i,name in enumerate(tips):
+        write('\t\t%s %s%s%s%s\n'%(codes[name],quotechar,name,quotechar,',' if i+1<len(tips) else ''))
+    write(';\n')
+
+    N=0
+    for ll in trees:
+        write('tree STATE_%s = [&R] '%(next(states)))
+        ll._streamNewick(write,traits=traits,rename=codes,quotechar='')
+        write('\n')
+        N+=1
+    write('End;\n')
+    flush()
+    if isinstance(fh,str): handle.close()
+    return N
+
+def loadJSON(json_object,json_translation={'name':'name','absoluteTime':'num_date'},verbose=False,sort=True,stats=True,timer=None):
     """
     Load a Nextstrain JSON file and create a tree object.
     
@@ -2169,6 +4431,7 @@ def loadJSON(json_object,json_translation={'name':'name','absoluteTime':'num_dat
     verbose (bool): If True, prints verbose output during the process. Default is False.
     sort (bool): If True, sorts the branches of the tree after loading. Default is True.
     stats (bool): If True, calculates tree statistics after loading. Default is True.
+    timer (phaseTimer or None): Accumulates time spent reading JSON, building, traversing and sorting the tree. Default is None.
     
     Returns:
     tuple: A tuple containing the tree object created from the JSON and the metadata from the JSON.
@@ -2184,42 +4447,43 @@ def loadJSON(json_object,json_translation={'name':'name','absoluteTime':'num_dat
     Docstring generated with ChatGPT 4o.
     """
     length_keys = ['absoluteTime', 'length', 'height']
-    assert 'name' in json_translation and any(key in json_translation for key in required_keys),'JSON translation dictionary missing entries: %s'%(', '.join([entry for entry in ['name']+length_keys if (entry in json_translation)==False]))
+    assert 'name' in json_translation and any(key in json_translation for key in length_keys),'JSON translation dictionary missing entries: %s'%(', '.join([entry for entry in ['name']+length_keys if (entry in json_translation)==False]))
     if verbose==True: print('Reading JSON')
 
-    if isinstance(json_object,str): ## string provided - either nextstrain URL or local path
-        if 'nextstrain.org' in json_object: ## nextsrain.org in URL - request it
-            if verbose==True: print('Assume URL provided, loading JSON from nextstrain.org')
-            import requests
-            from io import BytesIO as csio
-            auspice_json=json.load(csio(requests.get(json_object).content))
-        else: ## not nextstrain.org URL - assume local path to auspice v2 json
-            if verbose==True: print('Loading JSON from local path')
-            with open(json_object) as json_data:
-                auspice_json = json.load(json_data)
-    else: ## not string, assume auspice v2 json object given
-        if verbose==True: print('Loading JSON from object given')
-        auspice_json=json_object
+    if timer is None: timer=phaseTimer()
+    with timer.phase('read'):
+        if isinstance(json_object,str): ## string provided - either nextstrain URL or local path
+            if 'nextstrain.org' in json_object: ## nextsrain.org in URL - request it
+                if verbose==True: print('Assume URL provided, loading JSON from nextstrain.org')
+                import requests
+                from io import BytesIO as csio
+                auspice_json=json.load(csio(requests.get(json_object).content))
+            else: ## not nextstrain.org URL - assume local path to auspice v2 json
+                if verbose==True: print('Loading JSON from local path')
+                with open(json_object) as json_data:
+                    auspice_json = json.load(json_data)
+        else: ## not string, assume auspice v2 json object given
+            if verbose==True: print('Loading JSON from object given')
+            auspice_json=json_object
 
     json_meta=auspice_json['meta']
     json_tree=auspice_json['tree']
-    ll=make_treeJSON(json_tree,json_translation,verbose=verbose)
 
     assert ('absoluteTime' in json_translation and ('length' not in json_translation or 'height' not in json_translation)) or ('absoluteTime' not in json_translation and ('length' in json_translation or 'height' in json_translation)),'Cannot use both absolute time and branch length, include only one in json_translation dictionary.'
-
-    if verbose==True: print('Setting baltic traits from JSON')
-    for k in ll.Objects: ## make node attributes easier to access
-        for key in k.traits['node_attrs']:
-            if isinstance(k.traits['node_attrs'][key],dict):
-                if 'value' in k.traits['node_attrs'][key]:
-                    k.traits[key]=k.traits['node_attrs'][key]['value']
-                if 'confidence' in k.traits['node_attrs'][key]:
-                    k.traits['%s_confidence'%(key)]=k.traits['node_attrs'][key]['confidence']
+    branch_units=[branch_unit for branch_unit in ['height','absoluteTime'] if branch_unit in json_translation] ## branch lengths derived from divergence or absolute time
+
+    def process(k,JSONnode): ## flatten attributes, translate and get branch length as soon as a branch is created
+        node_attrs=k.traits.get('node_attrs',{})
+        for key in node_attrs: ## make node attributes easier to access
+            if isinstance(node_attrs[key],dict):
+                if 'value' in node_attrs[key]:
+                    k.traits[key]=node_attrs[key]['value']
+                if 'confidence' in node_attrs[key]:
+                    k.traits['%s_confidence'%(key)]=node_attrs[key]['confidence']
             elif key=='div':
-                k.traits['divergence']=k.traits['node_attrs'][key]
+                k.traits['divergence']=node_attrs[key]
 
-    for attr in json_translation: ## iterate through attributes in json_translation
-        for k in ll.Objects: ## for every branch
+        for attr in json_translation: ## iterate through attributes in json_translation
             if isinstance(json_translation[attr],str):
                 if json_translation[attr] in k.traits:
                     setattr(k,attr,k.traits[json_translation[attr]]) ## set attribute value for branch
@@ -2234,21 +4498,27 @@ def loadJSON(json_object,json_translation={'name':'name','absoluteTime':'num_dat
             else:
                 raise AttributeError('Attribute %s neither string nor callable'%(json_translation[attr]))
 
-    for branch_unit in ['height','absoluteTime']: ## iterate between divergence and absolute time
-        if branch_unit in json_translation: ## it's available in tree
-            for k in ll.Objects: ## iterate over all branches
-                cur_branch=getattr(k,branch_unit) ## get parameter for this branch
-                par_branch=getattr(k.parent,branch_unit) ## get parameter for parental branch
-                k.length=cur_branch-par_branch if cur_branch and par_branch else 0.0 ## difference between current and parent is branch length (or, if parent unavailabel it's 0)
+        for branch_unit in branch_units: ## parent is already done
+            cur_branch=getattr(k,branch_unit) ## get parameter for this branch
+            par_branch=getattr(k.parent,branch_unit) ## get parameter for parental branch
+            k.length=cur_branch-par_branch if cur_branch and par_branch else 0.0 ## difference between current and parent is branch length (or, if parent unavailabel it's 0)
+
+    if verbose==True: print('Building tree and setting baltic traits from JSON')
+    with timer.phase('parse'):
+        ll=make_treeJSON(json_tree,json_translation,verbose=verbose,process=process)
 
     if verbose==True: print('Traversing and drawing tree')
 
-    ll.traverse_tree(verbose=verbose)
-    ll.drawTree()
-    if stats==True:
-        ll.treeStats() ## initial traversal, checks for stats
-    if sort==True:
-        ll.sortBranches() ## traverses tree, sorts branches, draws tree
+    with timer.phase('traverse'):
+        if stats==True:
+            ll.treeStats() ## initial traversal, checks for stats
+        else:
+            ll.traverse_tree(verbose=verbose)
+    with timer.phase('sort'):
+        if sort==True:
+            ll.sortBranches() ## traverses tree, sorts branches, draws tree
+        else:
+            ll.drawTree()
 
     cmap={}
     for colouring in json_meta['colorings']:
@@ -2259,6 +4529,7 @@ def loadJSON(json_object,json_translation={'name':'name','absoluteTime':'num_dat
                 cmap[colouring['key']][key]=value
     setattr(ll,'cmap',cmap)
 
+    timer.count()
     return ll,json_meta
 
 if __name__ == '__main__':
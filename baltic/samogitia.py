@@ -1,327 +1,703 @@
 import argparse
+import copy
+import importlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
 import re
-import datetime as dt
-import baltic as bt
+import struct
 import sys
-import collections
+from abc import ABC, abstractmethod
+import numpy as np
+import baltic as bt
+
+analyses={} ## registry of analysis names and the classes that implement them
+
+class PosteriorAnalysis(ABC): ## base class for analyses of trees sampled from the posterior
+    """
+    Base class of samogitia analyses. Each tree from the posterior is parsed, traversed and calibrated once and then handed to every queued analysis.
+
+    Subclasses set `name`, have to implement process() and can override the other hooks:
+    header(ll,tips) is called with the first tree to be analysed and returns the names of output columns.
+    process(ll,state) is called with every tree after burnin and returns one value per output column. A value that is a list is a variable-length column (e.g. one entry per event).
+    finalize() is called once all trees have been processed.
+    Analyses without process() cannot be registered or created.
 
-def overlap(a,b):
+    Attributes:
+    name (str): Name used to queue the analysis.
+    requires_calibration (bool): If True trees have to be placed in absolute time.
+    fields (dict): Names of the entries of tuples in variable-length columns (e.g. {'completeHistory': ['time','from','to']}), used for columnar output.
+    options (dict): Keyword arguments given when the analysis was created (e.g. command line options).
+
+    Example:
+    >>> @register
+    ... class rootHeight(PosteriorAnalysis):
+    ...     name='rootHeight'
+    ...     def process(self,ll,state):
+    ...         return [ll.treeHeight]
     """
-    Return the elements shared by two lists in the following format:
-    [overlap],[list 1 remainder],[list 2 remainder]
+    name=None
+    requires_calibration=False
+    fields={}
+
+    def __init__(self,**options):
+        self.options=options
+
+    def header(self,ll,tips):
+        return [self.name]
+
+    @abstractmethod
+    def process(self,ll,state):
+        """
+        Return one value per output column for a tree.
+        """
+
+    def finalize(self):
+        pass
+
+def register(cls):
+    """
+    Class decorator that makes an analysis available to samogitia under its name.
+
+    Parameters:
+    cls (type): A subclass of PosteriorAnalysis with `name` set.
+
+    Returns:
+    type: The same class.
     """
-    a_multiset = collections.Counter(a)
-    b_multiset = collections.Counter(b)
-
-    overlap = list((a_multiset & b_multiset).elements())
-    a_remainder = list((a_multiset - b_multiset).elements())
-    b_remainder = list((b_multiset - a_multiset).elements())
-
-    return overlap, a_remainder, b_remainder
-
-############ arguments
-samogitia = argparse.ArgumentParser(description="samogitia.py analyses trees drawn from the posterior distribution by BEAST.\n")
-
-samogitia.add_argument('-b','--burnin', default=0, type=int, help="Number of states to remove as burnin (default 0).\n")
-samogitia.add_argument('-nc','--nocalibration', default=True, action='store_false', help="Use flag to prevent calibration of trees into absolute time (default True). Should be used if tip names do not contain information about *when* each sequence was collected.\n")
-samogitia.add_argument('-t','--treefile', type=open, required=True, help="File with trees sampled from the posterior distribution (usually with suffix .trees).\n")
-samogitia.add_argument('-a','--analyses', type=str, required=True, nargs='+', help="Analysis to be performed, can be a list separated by spaces.\n")
-samogitia.add_argument('-o','--output', type=argparse.FileType('w'), default='samogitia.out.txt', help="Output file name (default samogitia.out.txt).\n")
-samogitia.add_argument('-s','--states', type=str, default='0-inf', help="Define range of states for analysis.\n")
-samogitia.add_argument('-df','--date_format', type=str, default='%Y-%m-%d', help="Define date format encoded in tips (default \'%%Y-%%m-%%d\').\n")
-samogitia.add_argument('-tf','--tip_format', type=str, default='\|([0-9]+)\-*([0-9]+)*\-*([0-9]+)*$', help="Define regex for capturing dates encoded in tips (default \'\|([0-9]+)\-*([0-9]+)*\-*([0-9]+)*$\'.\n")
-
-args = vars(samogitia.parse_args())
-burnin, treefile, analyses, outfile, calibration, states, dformat, tformat = args['burnin'], args['treefile'], args['analyses'], args['output'], args['nocalibration'], args['states'], args['date_format'], args['tip_format']
-
-lower,upper=states.split('-')
-lower=int(lower)
-if upper=='inf':
-    upper=float('inf')
-else:
-    upper=int(upper)
-
-try:
-    for line in open('../docs/banner_samogitia.txt','r'):
-        sys.stderr.write('%s'%(line))
-except:
-    pass
-
-## keeps track of things in the tree file at the beginning
-plate=True
-taxonlist=False
-treecount=0 ## counts tree
-##
-
-tips={} ## remembers tip encodings
-
-############################# progress bar stuff
-Ntrees=10000 ## assume 10 000 trees in posterior sample
-barLength=30
-progress_update=Ntrees/barLength ## update progress bar every time a tick has to be added
-threshold=progress_update ## threshold at which to update progress bar
-processingRate=[] ## remember how quickly script processes trees
-#############################
-
-available_analyses=['treeLength','RC','Sharp','tmrcas','transitions','subtrees'] ## analysis names that are possible
-
-assert analyses,'No analyses were selected.'
-for queued_analysis in analyses: ## for each queued analysis check if samogitia can do anything about them (i.e. whether they're known analysis types)
-    assert queued_analysis in available_analyses,'%s is not a known analysis type\n\nAvailable analysis types are: \n* %s\n'%(queued_analysis,'\n* '.join(available_analyses))
-
-begin=dt.datetime.now() ## start timer
-
-for line in treefile: ## iterate through each line
-    ###################################################################################
-    if plate==True and 'state' not in line.lower():
-        cerberus=re.search('Dimensions ntax\=([0-9]+)\;',line) ## Extract useful information from the bits preceding the actual trees.
+    assert issubclass(cls,PosteriorAnalysis),'%s is not a PosteriorAnalysis'%(cls)
+    assert cls.name,'Analysis %s has no name'%(cls.__name__)
+    assert not inspect.isabstract(cls),'Analysis %s does not implement %s'%(cls.__name__,', '.join(sorted(cls.__abstractmethods__)))
+    analyses[cls.name]=cls
+    return cls
+
+def loadPlugin(source):
+    """
+    Import a module with user analyses. Analyses become available by decorating them with `register` when the module is imported.
+
+    Parameters:
+    source (str): Path to a python file or name of an importable module.
+
+    Returns:
+    module: The imported module.
+
+    Example:
+    >>> loadPlugin('my_analyses.py') ## my_analyses.py does `from samogitia import PosteriorAnalysis, register`
+    """
+    if os.path.isfile(source):
+        name=os.path.splitext(os.path.basename(source))[0]
+        spec=importlib.util.spec_from_file_location(name,source)
+        module=importlib.util.module_from_spec(spec)
+        sys.modules[name]=module ## analyses have to be importable to be saved in checkpoints
+        spec.loader.exec_module(module)
+        return module
+    return importlib.import_module(source)
+
+@register
+class treeLength(PosteriorAnalysis): ## sum of branch lengths
+    name='treeLength'
+
+    def process(self,ll,state):
+        return [sum(k.length for k in ll.Objects)]
+
+@register
+class RC(PosteriorAnalysis): ## robust counting of non-synonymous and synonymous changes
+    name='RC'
+
+    def header(self,ll,tips):
+        return ['N','S','uN','uS','dNdS']
+
+    def process(self,ll,state):
+        N,S,uN,uS=0.0,0.0,0.0,0.0
+        for k in ll.Objects:
+            if 'N' in k.traits: ## branch has robust counting traits
+                N+=k.traits['N']
+                S+=k.traits['S']
+                uN+=k.traits['b_u_N']
+                uS+=k.traits['b_u_S']
+        return [N,S,uN,uS,(N/S)/(uN/uS)]
+
+@register
+class Sharp(PosteriorAnalysis): ## non-synonymous and synonymous changes with the time over which they accumulated
+    name='Sharp'
+    requires_calibration=True
+    fields={'Sharp': ['N','S','t']}
+
+    def header(self,ll,tips):
+        self.tipDates=self.options['tip_dates']
+        return ['Sharp']
+
+    def process(self,ll,state):
+        out=[]
+        for k in ll.Objects:
+            if 'N' in k.traits:
+                half_branch=k.length*0.5
+                if k.is_node(): ## time from the middle of the branch to the oldest descendant tip
+                    t=min(self.tipDates[lf] for lf in k.leaves)-k.absoluteTime+half_branch
+                else:
+                    t=half_branch
+                out.append((k.traits['N'],k.traits['S'],t))
+        return [out]
+
+@register
+class tmrcas(PosteriorAnalysis): ## times of most recent common ancestors of tips matching regular expressions
+    name='tmrcas'
+    requires_calibration=True
+
+    def header(self,ll,tips):
+        clades=self.options.get('clades')
+        assert clades,'tmrcas requires clades to be defined (e.g. --clade A="^A")'
+        self.monophyly=self.options.get('monophyly',False)
+        self.tips=[k.name for k in ll.getExternal()] ## tip bits are the same in every tree
+        self.clades={}
+        for clade,pattern in sorted(clades.items()):
+            self.clades[clade]=[name for name in self.tips if re.search(pattern,name)]
+            assert len(self.clades[clade])>1,'Clade %s matches fewer than 2 tips'%(clade)
+        return list(self.clades)+(['%s_monophyletic'%(clade) for clade in self.clades] if self.monophyly else [])
+
+    def process(self,ll,state):
+        row=bt.tmrcaDistributions([(state,ll)],self.clades,tips=self.tips,monophyly=self.monophyly,most_recent=ll.mostRecent)[0]
+        return [float(row[clade]) for clade in self.clades]+([int(row['%s_monophyletic'%(clade)]) for clade in self.clades] if self.monophyly else [])
+
+@register
+class transitions(PosteriorAnalysis): ## changes in a discrete trait between parent and child branches
+    name='transitions'
+    requires_calibration=True
+    fields={'completeHistory': ['time','from','to']}
+
+    def header(self,ll,tips):
+        self.history=self.options.get('history')
+        self.trait=None if self.history else self.options.get('trait','location.states')
+        self.categories=[] ## trait values keep their codes across trees
+        return ['totalChangeCount','completeHistory']
+
+    def process(self,ll,state):
+        events,self.categories=bt.transitionEvents([(state,ll)],trait=self.trait,history=self.history,categories=self.categories,most_recent=ll.mostRecent)
+        out=[(time,self.categories[a],self.categories[b]) for time,a,b in zip(events['time'].tolist(),events['from'].tolist(),events['to'].tolist())]
+        return [len(out),out]
+
+@register
+class subtrees(PosteriorAnalysis): ## introductions of a trait value and the number of tips descended from each
+    name='subtrees'
+    requires_calibration=True
+    fields={'subtrees': ['time','most_recent','from','to','tips']}
+
+    def header(self,ll,tips):
+        self.trait=self.options.get('trait','location.states')
+        self.value=self.options.get('trait_value','human')
+        self.tipDates=self.options['tip_dates']
+        assert any(self.trait in k.traits for k in ll.Objects),'No branches have the trait "%s"'%(self.trait)
+        return ['subtrees']
+
+    def process(self,ll,state):
+        out=[]
+        within=lambda w: w.traits.get(self.trait)==self.value ## traverse only through branches with the same trait value
+        for k in ll.Objects:
+            if k.parent!=ll.root and within(k) and self.trait in k.parent.traits and not within(k.parent):
+                if k.is_leaf():
+                    subtree_leaves=[k.name]
+                elif any(within(ch) for ch in k.children):
+                    subtree=ll.subtree(k,traverse_condition=within)
+                    subtree_leaves=[w.name for w in subtree.getExternal()] if subtree else []
+                else: ## introduction without descendants in the same state
+                    continue
+                if len(subtree_leaves)>0:
+                    most_recent=max(self.tipDates[name] for name in subtree_leaves)
+                    out.append((k.absoluteTime,most_recent,k.parent.traits[self.trait],self.value,len(subtree_leaves)))
+        return [out]
+
+def readPosterior(handle,tips,offset=0):
+    """
+    Iterate over trees in a BEAST posterior tree file, remembering tip encodings of the Translate block.
+
+    Parameters:
+    handle (file): Open tree file. Files opened in binary mode give exact byte offsets.
+    tips (dict): Dictionary that is filled with tip encodings (numbers to names) before the first tree is returned.
+    offset (int): Position of the handle in the file, used when reading starts part way through (e.g. when resuming from a checkpoint). Default is 0.
+
+    Returns:
+    generator: Yields tuples of MCMC state (int), tree string and the offset of the line following the tree.
+    """
+    plate=True ## keeps track of things in the tree file before trees
+    taxonlist=False
+    tip_num=None
+    for line in handle:
+        offset+=len(line)
+        if isinstance(line,bytes):
+            line=line.decode()
+        cerberus=re.match(r'tree\sSTATE\_([0-9]+).+\[\&R\]\s',line) ## search for crud at the beginning of the line that's not a tree string
         if cerberus is not None:
-            tipNum=int(cerberus.group(1))
-
-        if 'Translate' in line:
-            taxonlist=True ## taxon list to follow
-
-        if taxonlist==True and ';' not in line and 'Translate' not in line: ## remember tip encodings
-            cerberus=re.search('([0-9]+) ([\'\"A-Za-z0-9\?\|\-\_\.\/]+)',line)
-            tips[cerberus.group(1)]=cerberus.group(2).strip("'")
-
-    if 'tree STATE_' in line and plate==True: ## starting actual analysis
-        plate=False
-        assert (tipNum == len(tips)),'Expected number of tips: %s\nNumber of tips found: %s'%(tipNum,len(tips)) ## check that correct numbers of tips have been parsed
-    ################################################################################### start analysing trees
-    cerberus=re.match('tree\sSTATE\_([0-9]+).+\[\&R\]\s',line) ## search for crud at the beginning of the line that's not a tree string
-
-    if cerberus is not None: ## tree identified
-        ################################################################# at state 0 - create the header for the output file and read the tree (in case the output log file requires information encoded in the tree)
-        if treecount==0: ## At tree state 0 insert header into output file
-            ll=bt.tree() ## empty tree object
-            start=len(cerberus.group()) ## index of where tree string starts in the line
-            treestring=str(line[start:]) ## grab tree string
-            bt.make_tree(treestring,ll) ## read tree string
-            if lower==0 and upper==float('inf'): ## only add a header if not doing a chunk
-                outfile.write('state') ## begin the output log file
-                ########################################### add header to output log file
-                if 'treeLength' in analyses:
-                    outfile.write('\ttreeLength')
-                ###########################################
-                if 'RC' in analyses:
-                    outfile.write('\tN\tS\tuN\tuS\tdNdS')
-                ###########################################
-                if 'tmrcas' in analyses:
-                    tmrcas={'A':[],'B':[],'C':[]} ## dict of clade names
-                    ll.renameTips(tips)
-                    for k in ll.Objects: ## iterate over branches
-                        if isinstance(k,bt.leaf): ## only interested in tips
-                            if 'A' in k.name: ## if name of tip satisfies condition
-                                tmrcas['A'].append(k.numName) ## add the tip's numName to tmrca list - tips will be used to ID the common ancestor
-                            elif k.name in Conakry_tips:
-                                tmrcas['B'].append(k.numName)
-                            tmrcas['C'].append(k.numName)
-
-                    outfile.write('\t%s'%('\t'.join(sorted(tmrcas.keys()))))
-                ###########################################
-                if 'transitions' in analyses:
-                    outfile.write('state\ttotalChangeCount\tcompleteHistory_1')
-                ###########################################
-                if 'subtrees' in analyses:
-                    import copy
-                ###########################################
-                ## your custom header making code goes here
-                ## if 'custom' in analyses:
-                ##     trait='yourTrait'
-                ##     trait_vals=[]
-                ##     for k in ll.Objects:
-                ##         if k.traits.has_key(trait):
-                ##             trait_vals.append(k.traits[trait])
-                ##     available_trait_values=sorted(bt.unique(trait_vals))
-                ##     for tr in available_trait_values:
-                ##         outfile.write('\t%s.time'%(tr))
-                ###########################################
-                treecount+1
-                outfile.write('\n') ## newline for first tree
-        #################################################################
-        if int(cerberus.group(1)) >= burnin and lower <= int(cerberus.group(1)) < upper: ## After burnin start processing
-            ll=bt.tree() ## ll is the tree object
-            start=len(cerberus.group()) ## find start of tree string in line
-            treestring=str(line[start:]) ## get tree string
-            bt.make_tree(treestring,ll) ## pass it to make_tree function
-            ll.traverse_tree() ## Traverse the tree - sets the height of each object in the tree
-            #### renaming tips
-            if len(tips)>0:
-                ll.renameTips(tips) ## Rename tips so their name refers to sequence name
+            if plate: ## starting actual analysis
+                plate=False
+                assert tip_num is None or tip_num==len(tips),'Expected number of tips: %s\nNumber of tips found: %s'%(tip_num,len(tips)) ## check that correct numbers of tips have been parsed
+            yield int(cerberus.group(1)),line[len(cerberus.group()):].strip(),offset
+
+        elif plate:
+            cerberus=re.search(r'Dimensions ntax\=([0-9]+)\;',line) ## Extract useful information from the bits preceding the actual trees.
+            if cerberus is not None:
+                tip_num=int(cerberus.group(1))
+
+            if 'Translate' in line:
+                taxonlist=True ## taxon list to follow
+            elif taxonlist and ';' in line:
+                taxonlist=False
+            elif taxonlist: ## remember tip encodings
+                cerberus=re.search(r'([0-9]+) ([\'\"A-Za-z0-9\?\|\-\_\.\/]+)',line)
+                if cerberus is not None:
+                    tips[cerberus.group(1)]=cerberus.group(2).strip("'\"")
+
+def prepareTree(treestring,tips,most_recent=None,timer=None):
+    """
+    Parse, traverse and (optionally) calibrate a tree string. This is done once per tree, regardless of the number of analyses.
+
+    Parameters:
+    treestring (str): Tree string from a posterior tree file.
+    tips (dict): Tip encodings from the Translate block, can be empty.
+    most_recent (float or None): Decimal date of the most recent tip, trees are not calibrated if None.
+    timer (phaseTimer or None): Accumulates time spent parsing, traversing and calibrating. Default is None.
+
+    Returns:
+    tree: The parsed tree.
+    """
+    if timer is None: timer=bt.phaseTimer()
+    with timer.phase('parse'):
+        ll=bt.make_tree(treestring) ## read tree string
+        if len(tips)>0:
+            ll.renameTips(tips) ## rename tips before traversal so that descendant tips of nodes are recorded by name
+    with timer.phase('traverse'):
+        ll.traverse_tree() ## sets the height of each object in the tree
+    if most_recent is not None:
+        with timer.phase('calibrate'):
+            ll.setAbsoluteTime(most_recent) ## place everything in absolute time
+    return ll
+
+def countTrees(treefile,size=2**20):
+    """
+    Count trees in a posterior tree file without parsing them, by scanning the file in chunks for lines starting with `tree STATE_`.
+
+    Parameters:
+    treefile (str): Path to the posterior tree file.
+    size (int): Number of bytes read at a time. Default is 1 MB.
+
+    Returns:
+    int: The number of trees.
+    """
+    pattern=b'\ntree STATE_'
+    N=0
+    tail=b'\n' ## a tree on the first line counts too
+    with open(treefile,'rb') as f:
+        for chunk in iter(lambda: f.read(size),b''):
+            chunk=tail+chunk
+            N+=chunk.count(pattern)
+            tail=chunk[-len(pattern)+1:] ## patterns split across chunks
+    return N
+
+def progressBar(report,barLength=30):
+    """
+    Write a progress bar with trees processed, time elapsed and estimated time remaining to stderr, from a phaseTimer report.
+    """
+    treecount,Ntrees,elapsed=report['trees'],report['total_trees'],report['elapsed']
+    if elapsed>3600.0: ## took over 60 minutes
+        reportElapsed,reportUnit=elapsed/3600.0,'h'
+    else:
+        reportElapsed,reportUnit=elapsed/60.0,'m'
+    ETA=(report['remaining'] or 0.0)/3600.0
+    ticks=min(treecount,Ntrees)*barLength//max(Ntrees,1)
+    sys.stderr.write('\r[%-*s] %4d%%  trees: %5d  elapsed: %5.2f%1s  ETA: %5.2fh (%6.1f trees/s)'%(barLength,'='*ticks,treecount*100.0/max(Ntrees,1),treecount,reportElapsed,reportUnit,ETA,report['rate']))
+    sys.stderr.flush()
+
+def formatValue(value):
+    """
+    Format an output value as text. Lists are tab-separated and tuples are written as {a,b,...}.
+    """
+    if isinstance(value,list):
+        return '\t'.join(map(formatValue,value))
+    elif isinstance(value,tuple):
+        return '{%s}'%(','.join(map(str,value)))
+    return '%s'%(value)
+
+class textWriter: ## tab-separated output with one row per tree
+    """
+    Write analysis output as tab-separated text. Variable-length columns are written as tab-separated {a,b,...} entries, so only the last column may have a variable length.
+
+    Parameters:
+    path (str): Path to the output file.
+    resume (dict or None): Value returned by flush() when a checkpoint was made, the file is truncated to its size then. Default is None (new file).
+    """
+    def __init__(self,path,resume=None):
+        if resume is not None:
+            assert os.path.getsize(path)>=resume['written'],'Output %s is shorter than recorded in the checkpoint'%(path)
+            os.truncate(path,resume['written']) ## remove rows written after the checkpoint
+        self.handle=open(path,'w' if resume is None else 'a')
+        self.checked=resume is not None
+
+    def start(self,columns,fields,header=True):
+        if header:
+            self.handle.write('state\t%s\n'%('\t'.join(columns)))
+
+    def write(self,state,values):
+        if not self.checked:
+            ragged=[i for i,value in enumerate(values) if isinstance(value,list)]
+            assert ragged in ([],[len(values)-1]),'Only the last column can have a variable number of values in text output, use columnar output instead'
+            self.checked=True
+        self.handle.write('%d\t%s\n'%(state,'\t'.join(map(formatValue,values)))) ## MCMC state number followed by analysis output
+
+    def flush(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno()) ## rows have to be on disk before a checkpoint refers to them
+        return {'written': self.handle.tell()}
+
+    def close(self):
+        self.handle.close()
+
+_npy_header=128 ## bytes reserved for .npy headers, enough for any length
+
+def _npyHeader(dtype,length):
+    """
+    Version 1.0 .npy header of a one-dimensional array, padded to a fixed size so that it can be rewritten in place as the array grows.
+    """
+    header=repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),'fortran_order': False,'shape': (length,)})
+    header=header.ljust(_npy_header-11)+'\n'
+    return b'\x93NUMPY\x01\x00'+struct.pack('<H',len(header))+header.encode('latin1')
+
+class columnWriter: ## typed columns in a directory of .npy files
+    """
+    Write analysis output as typed columns, each a .npy file in a directory that can be loaded with memory mapping (see `loadColumns`).
+    MCMC states are int64, numbers float64 and strings int32 codes of categories. Variable-length columns (lists) are stored as int64 offsets
+    (row i has entries offsets[i] to offsets[i+1]) with one array per tuple entry (named by the analysis' `fields`). Values are buffered and written in chunks,
+    headers and the column description (columns.json) are rewritten whenever the output is flushed.
+
+    Parameters:
+    path (str): Output directory.
+    chunk (int): Number of rows buffered before they are written. Default is 1000.
+    resume (dict or None): Value returned by flush() when a checkpoint was made, columns are truncated to their lengths then. Default is None (new output).
+    """
+    def __init__(self,path,chunk=1000,resume=None):
+        self.path=path
+        self.chunk=chunk
+        self.pending=0
+        self.handles={}
+        self.buffers={}
+        self.codes={}
+        if resume is None:
+            os.makedirs(path,exist_ok=True)
+            self.meta={'rows': 0,'arrays': {},'columns': {}}
+            self._array('state','int64')
+        else:
+            self.meta=copy.deepcopy(resume)
+            for name,array in self.meta['arrays'].items():
+                handle=open(os.path.join(path,name),'r+b')
+                handle.truncate(_npy_header+array['length']*np.dtype(array['dtype']).itemsize) ## remove values written after the checkpoint
+                handle.seek(0,2)
+                self.handles[name]=handle
+                self.buffers[name]=[]
+                if array['categories'] is not None:
+                    self.codes[name]={value: i for i,value in enumerate(array['categories'])}
+
+    def _array(self,name,dtype,categorical=False):
+        name='%s.npy'%(re.sub(r'[^A-Za-z0-9.\-_]','_',name))
+        handle=open(os.path.join(self.path,name),'w+b')
+        handle.write(_npyHeader(dtype,0))
+        self.handles[name]=handle
+        self.buffers[name]=[]
+        self.meta['arrays'][name]={'dtype': dtype,'length': 0,'categories': [] if categorical else None}
+        if categorical: self.codes[name]={}
+        return name
+
+    def _value(self,name,value):
+        if name in self.codes: ## categorical
+            if value is None:
+                value=-1
             else:
-                for k in ll.Objects:
-                    if isinstance(k,leaf):
-                        k.name=k.numName ## otherwise every tip gets a name that's the same as tree string names
-            #### calibration
-            dateCerberus=re.compile(tformat) ## search pattern + brackets on actual calendar date
-            if calibration==True: ## Calibrate tree so everything has a known position in actual time
-                tipDatesRaw=[dateCerberus.search(x).group(1) for x in tips.values()]
-                tipDates=[]
-                for tip_date in tipDatesRaw:
-                    tipDates.append(bt.decimalDate(tip_date,fmt=dformat,variable=True))
-                maxDate=max(tipDates) ## identify most recent tip
-                ll.setAbsoluteTime(maxDate)
-            outfile.write('%s'%cerberus.group(1)) ## write MCMC state number to output log file
-            ################################################################################
-            if 'treeLength' in analyses:
-                treeL=sum([k.length for k in ll.Objects]) ## do analysis
-                outfile.write('\t%s'%(treeL)) ## output to file
-            ###################################################
-            if 'RC' in analyses: ## 'RC' was queued as an analysis
-                Ns=[] ## empty list
-                Ss=[]
-                uNs=[]
-                uSs=[]
-                for k in ll.Objects: ## iterate over branch objects in the tree
-                    if k.traits.has_key('N'): ## if branch has a trait labelled "N"...
-                        Ns.append(k.traits['N']) ## add it to empty list
-                        Ss.append(k.traits['S']) ## likewise for every other trait
-                        uNs.append(k.traits['b_u_N'])
-                        uSs.append(k.traits['b_u_S'])
-                tNs=sum(Ns) ## sum of numbers in list
-                tSs=sum(Ss)
-                tuNs=sum(uNs)
-                tuSs=sum(uSs)
-                dNdS=(tNs/tSs)/(tuNs/tuSs) ## calculate dNdS
-                outfile.write('\t%s\t%s\t%s\t%s\t%s'%(tNs,tSs,tuNs,tuSs,dNdS)) ## output to file, separated by tabs
-            ###################################################
-            if 'tmrcas' in analyses:
-                assert calibration==True,'This analysis type requires time-calibrated trees'
-                nodes={x:None for x in tmrcas.keys()} ## each TMRCA will correspond to a single object
-                score={x:len(ll.Objects)+1 for x in tmrcas.keys()} ## this will be used to score the common ancestor candidate
-                for required in tmrcas.keys(): ## iterate over TMRCAs
-                    searchNodes=sorted([nd for nd in ll.Objects if nd.branchType=='node' and len(nd.leaves)>=len(tmrcas[required])],key=lambda n:len(n.leaves)) ## common ancestor candidates must have at least as many descendants as the list of search tips
-                    for k in searchNodes: ## iterate over candidates
-                        common,queryLeft,targetLeft=overlap(k.leaves,tmrcas[required]) ## find how many query tips exist as descendants of candidate nodes
-                        if len(targetLeft)==0 and len(queryLeft)<=score[required]: ## all of query tips must be descended from common ancestor, every extra descendant of common ancestor not in query contributes to a score
-                            nodes[required]=k ## if score improved - assign new common ancestor
-                            score[required]=len(queryLeft) ## score is extra descendants not in the list of known tips
-
-                outTMRCA=['%.6f'%(nodes[n].absoluteTime) for n in sorted(nodes.keys())] ## fetch absoluteTime of each identified common ancestor
-                outfile.write('\t%s'%('\t'.join(outTMRCA)))
-            ###################################################
-            if 'Sharp' in analyses:
-                assert calibration==True,'This analysis type requires time-calibrated trees'
-                assert len(analyses)==1,'More that one analysis queued in addition to Sharp, which is inadvisable'
-                outSharp=[]
-                for k in ll.Objects:
-                    if k.traits.has_key('N'):
-                        N=k.traits['N']
-                        S=k.traits['S']
-                        halfBranch=k.length*0.5
-                        if isinstance(k,node):
-                            all_leaves=[tips[lf] for lf in k.leaves]
-                            t=min(map(bt.decimalDate,[dateCerberus.search(x).group(1) for x in all_leaves]))-k.absoluteTime+halfBranch
-                        else:
-                            t=halfBranch
-
-                        outSharp.append('(%d,%d,%.4f)'%(N,S,t))
-                outfile.write('\t%s'%('\t'.join(outSharp)))
-            ###################################################
-            if 'transitions' in analyses:
-                assert calibration==True,'This analysis type requires time-calibrated trees'
-                assert len(analyses)==1,'More that one analysis queued in addition to transitions, which is inadvisable'
-                outTransitions=[]
-                for k in ll.Objects:
-                    if k.traits.has_key('location.states') and k.parent.traits.has_key('location.states'):
-                        cur_value=k.traits['location.states']
-                        par_value=k.parent.traits['location.states']
-                        if cur_value!=par_value:
-                            outTransitions.append('{1,%s,%s,%s}'%(ll.treeHeight-k.height-0.5*k.length,par_value,cur_value))
-                outfile.write('\t%d\t%s'%(len(outTransitions),'\t'.join(outTransitions)))
-            ###################################################
-            if 'subtrees' in analyses:
-                traitName='location.states'
-                assert [k.traits.has_key(traitName) for k in ll.Objects].count(True)>0,'No branches have the trait "%s"'%(traitName)
-                for k in ll.Objects:
-                    if k.traits.has_key(traitName) and k.parent.traits.has_key(traitName) and k.parent.index!='Root' and k.traits[traitName]!=k.parent.traits[traitName] and k.traits[traitName]=='human':
-                        proceed=False ## assume we still can't proceed forward
-                        kloc=k.traits[traitName]
-                        if isinstance(k,bt.leaf): ## if dealing with a leaf - proceed
-                            N_children=1
-                            proceed=True
-                        else:
-                            N_children=len(k.leaves)
-                            if [ch.traits[traitName] for ch in k.children].count(kloc)>0:
-                                proceed=True
-                        #print k.index,k.parent.index,k.traits,k.parent.traits,k.traits[traitName]
-
-                        if proceed==True: ## if at least one valid tip and no hanging nodes
-                            subtree=copy.deepcopy(ll.traverseWithinTrait(k,traitName))
-                            subtree_leaves=[x.name for x in subtree if isinstance(x,bt.leaf)]
-
-                            if len(subtree_leaves)>0:
-                                mostRecentTip=max([bt.decimalDate(x.strip("'").split('|')[-1]) for x in subtree_leaves])
-                                while sum([len(nd.children)-sum([1 if ch in subtree else 0 for ch in nd.children]) for nd in subtree if isinstance(nd,bt.node) and nd.index!='Root'])>0: ## keep removing nodes as long as there are nodes with children that are not entirely within subtree
-                                    for nd in sorted([q for q in subtree if isinstance(q,bt.node)],key=lambda x:(sum([1 if ch in subtree else 0 for ch in x.children]),x.height)): ## iterate over nodes in subtree, starting with ones that have fewest valid children and are more recent
-
-                                        child_status=[1 if ch in subtree else 0 for ch in nd.children] ## check how many children of current node are under the right trait value
-
-                                        if sum(child_status)<2 and nd.index!='Root': ## if less than 2 children in subtree (i.e. not all children are under the same trait state)
-                                            #print 'removing: %d, children in: %s'%(nd.index,[location_to_country[ch.traits[traitName]] for ch in nd.children])
-                                            grand_parent=nd.parent ## fetch grandparent of node to be removed
-                                            grand_parent.children.remove(nd) ## remove node from its parent's children
-
-                                            if sum(child_status)==0: ## node has no valid children - current grandparent will be removed on next iteration, since it will only have one child
-                                                pass
-                                            else: ## at least one child is still valid - reconnect the one valid child to grandparent
-                                                child=nd.children[child_status.index(1)] ## identify the valid child
-                                                child.parent=grand_parent ## child's parent is now its grandparent
-                                                grand_parent.children.append(child) ## child is now child of grandparent
-                                                child.length+=nd.length ## child's length now includes it's former parent's length
-                                            subtree.remove(nd) ## remove node from subtree
-                                outfile.write('\t{%s,%s,%s,%s,%d}'%(k.absoluteTime,mostRecentTip,k.parent.traits[traitName],k.traits[traitName],len(subtree_leaves)))
-                                sys.stderr.write('\t{%s,%s,%s,%s,%d}'%(k.absoluteTime,mostRecentTip,k.parent.traits[traitName],k.traits[traitName],len(subtree_leaves)))
-                                ##########
-                                ## Comment out to output stats rather than trees
-                                ##########
-#                                 if len(subtree)>0: ## only proceed if there's at least one tip in the subtree
-#                                     local_tree=bt.tree() ## create a new tree object where the subtree will be
-#                                     local_tree.Objects=subtree ## assign branches to new tree object
-#                                     local_tree.root.children.append(subtree[0]) ## connect tree object's root with subtree
-#                                     subtree[0].parent=local_tree.root ## subtree's root's parent is tree object's root
-#                                     #local_tree.root.absoluteTime=subtree[0].absoluteTime-subtree[0].length ## root's absolute time is subtree's root time
-#                                     local_tree.sortBranches() ## sort branches, draw small tree
-#                                     subtreeString=local_tree.toString()
-#                                     outfile.write('\t%s'%(subtreeString))
-            ###################################################
-            ## your analysis and output code goes here, e.g.
-            ## if 'custom' in analyses:
-            ##     out={x:0.0 for x in available_trait_values}
-            ##     for k in ll.Objects:
-            ##         if k.traits.has_key(trait):
-            ##             out[k.traits[trait]]+=k.length
-            ##     for tr in available_trait_values:
-            ##         outfile.write('\t%s'%(out[tr]))
-            ###################################################
-            outfile.write('\n') ## newline for post-burnin tree
-        treecount+=1 ## increment tree counter
-        ################################################################################
-        if treecount==threshold: ## tree passed progress bar threshold
-            timeTakenSoFar=dt.datetime.now()-begin ## time elapsed
-            timeElapsed=float(divmod(timeTakenSoFar.total_seconds(),60)[0]+(divmod(timeTakenSoFar.total_seconds(),60)[1])/float(60))
-            timeRate=float(divmod(timeTakenSoFar.total_seconds(),60)[0]*60+divmod(timeTakenSoFar.total_seconds(),60)[1])/float(treecount+1) ## rate at which trees have been processed
-            processingRate.append(timeRate) ## remember rate
-            ETA=(sum(processingRate)/float(len(processingRate))*(Ntrees-treecount))/float(60)/float(60) ## estimate how long it'll take, given mean processing rate
-
-            excessiveTrees=treecount
-            if treecount>=10000:
-                excessiveTrees=10000
-            if timeElapsed>60.0: ## took over 60 minutes
-                reportElapsed=timeElapsed/60.0 ## switch to hours
-                reportUnit='h' ## unit is hours
+                value=str(value)
+                if value not in self.codes[name]:
+                    self.codes[name][value]=len(self.codes[name])
+                    self.meta['arrays'][name]['categories'].append(value)
+                value=self.codes[name][value]
+        elif value is None:
+            value=np.nan
+        self.buffers[name].append(value)
+
+    def _create(self,name,value):
+        return self._array(name,'int32',True) if isinstance(value,str) else self._array(name,'float64')
+
+    def start(self,columns,fields,header=True):
+        self.meta['names']=columns
+        self.meta['fields']=fields
+
+    def write(self,state,values):
+        columns=self.meta['columns']
+        self.buffers['state.npy'].append(state)
+        for name,value in zip(self.meta['names'],values):
+            if isinstance(value,list): ## variable-length column
+                if name not in columns:
+                    columns[name]={'kind': 'ragged','offsets': self._array('%s.offsets'%(name),'int64'),'fields': {},'count': 0}
+                    self.buffers[columns[name]['offsets']].append(0)
+                column=columns[name]
+                names=self.meta['fields'].get(name,[])
+                for event in value:
+                    if not isinstance(event,tuple): event=(event,)
+                    for i,entry in enumerate(event):
+                        field=names[i] if i<len(names) else '%d'%(i)
+                        if field not in column['fields']:
+                            assert column['count']==0,'Entry %s of %s appeared after the first event'%(field,name)
+                            column['fields'][field]=self._create('%s.%s'%(name,field),entry)
+                        self._value(column['fields'][field],entry)
+                column['count']+=len(value)
+                self.buffers[column['offsets']].append(column['count'])
             else:
-                reportElapsed=timeElapsed ## keep minutes
-                reportUnit='m'
-
-            sys.stderr.write('\r') ## output progress bar
-            sys.stderr.write("[%-30s] %4d%%  trees: %5d  elapsed: %5.2f%1s  ETA: %5.2fh (%6.1e s/tree)" % ('='*(excessiveTrees/progress_update),treecount/float(Ntrees)*100.0,treecount,reportElapsed,reportUnit,ETA,processingRate[-1]))
-            sys.stderr.flush()
-
-            threshold+=progress_update ## increment to next threshold
-        ################################################################################
-        if 'End;' in line:
-            pass
-outfile.close()
-sys.stderr.write('\nDone!\n') ## done!
+                if name not in columns:
+                    columns[name]={'kind': 'scalar','array': self._create(name,value)}
+                self._value(columns[name]['array'],value)
+        self.meta['rows']+=1
+        self.pending+=1
+        if self.pending>=self.chunk:
+            self._drain()
+
+    def _drain(self): ## write buffered values
+        for name,values in self.buffers.items():
+            if values:
+                array=self.meta['arrays'][name]
+                np.asarray(values,dtype=array['dtype']).tofile(self.handles[name])
+                array['length']+=len(values)
+                del values[:]
+        self.pending=0
+
+    def flush(self):
+        self._drain()
+        for name,handle in self.handles.items(): ## headers record current lengths
+            handle.seek(0)
+            handle.write(_npyHeader(self.meta['arrays'][name]['dtype'],self.meta['arrays'][name]['length']))
+            handle.seek(0,2)
+            handle.flush()
+            os.fsync(handle.fileno())
+        temporary=os.path.join(self.path,'columns.json.tmp')
+        with open(temporary,'w') as f:
+            json.dump(self.meta,f)
+        os.replace(temporary,os.path.join(self.path,'columns.json'))
+        return copy.deepcopy(self.meta)
+
+    def close(self):
+        self.flush()
+        for handle in self.handles.values():
+            handle.close()
+
+def loadColumns(path,mmap_mode='r'):
+    """
+    Load columnar samogitia output (see `columnWriter`).
+
+    Parameters:
+    path (str): Output directory.
+    mmap_mode (str or None): Passed to numpy.load, columns are memory-mapped by default. Use None to read them into memory.
+
+    Returns:
+    tuple: Dictionary of columns and dictionary of categories. Columns are arrays, variable-length columns are dictionaries with 'offsets' and an array for every entry of their tuples.
+           Categorical arrays hold integer codes (-1 for missing values) of the categories listed under the column name (or column.entry for variable-length columns).
+
+    Example:
+    >>> columns,categories=loadColumns('samogitia.out')
+    >>> offsets,times=columns['completeHistory']['offsets'],columns['completeHistory']['time']
+    >>> times[offsets[10]:offsets[11]] ## times of transitions in the 11th tree
+    """
+    with open(os.path.join(path,'columns.json')) as f:
+        meta=json.load(f)
+    arrays={name: np.load(os.path.join(path,name),mmap_mode=mmap_mode) for name in meta['arrays']}
+    columns={'state': arrays['state.npy']}
+    categories={}
+    for name,column in meta['columns'].items():
+        if column['kind']=='ragged':
+            columns[name]={'offsets': arrays[column['offsets']]}
+            for field,array in column['fields'].items():
+                columns[name][field]=arrays[array]
+                if meta['arrays'][array]['categories'] is not None:
+                    categories['%s.%s'%(name,field)]=meta['arrays'][array]['categories']
+        else:
+            columns[name]=arrays[column['array']]
+            if meta['arrays'][column['array']]['categories'] is not None:
+                categories[name]=meta['arrays'][column['array']]['categories']
+    return columns,categories
+
+def saveCheckpoint(path,saved):
+    """
+    Write a checkpoint atomically: the pickle is written to a temporary file which then replaces the previous checkpoint.
+
+    Parameters:
+    path (str): Path to the checkpoint.
+    saved (dict): Everything needed to resume a run.
+    """
+    temporary='%s.tmp'%(path)
+    with open(temporary,'wb') as f:
+        pickle.dump(saved,f,protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary,path) ## a run interrupted while writing leaves the previous checkpoint intact
+
+def run(treefile,queue,output,burnin=0,states=(0,float('inf')),calibration=True,date_format='%Y-%m-%d',tip_format=r'\|([0-9]+\-*[0-9]*\-*[0-9]*)$',progress=True,
+        checkpoint=None,checkpoint_every=1000,resume=False,metrics=None,stats=None,stats_every=1000,output_format='text',chunk=1000,**options):
+    r"""
+    Analyse trees sampled from the posterior distribution by BEAST and write a tab-separated log file with one row per tree.
+    Every tree is parsed, traversed and calibrated once and then handed to each queued analysis.
+
+    Parameters:
+    treefile (str): Path to the posterior tree file.
+    queue (list): Names of registered analyses and/or PosteriorAnalysis instances.
+    output (str): Path to the output file (or directory for columnar output).
+    burnin (int): States before this are skipped. Default is 0.
+    states (tuple): Range of states (lower inclusive, upper exclusive) to analyse. The header is only written when the full range is analysed. Default is all states.
+    calibration (bool): If True trees are placed in absolute time using dates encoded in tip names. Default is True.
+    date_format (str): Format of dates in tip names. Default is '%Y-%m-%d'.
+    tip_format (str): Regular expression capturing dates in tip names. Default is '\|([0-9]+\-*[0-9]*\-*[0-9]*)$'.
+    progress (bool): If True a progress bar is written to stderr. Default is True.
+    checkpoint (str or None): Path to a checkpoint file that records the last MCMC state read, its byte offset in the tree file, the size of the output and the analyses (with anything they accumulated). Default is None (no checkpoints).
+    checkpoint_every (int): Number of trees read between checkpoints. Default is 1000.
+    resume (bool): If True and the checkpoint exists the run continues from it: the output is truncated to its size at the checkpoint and the tree file is read from the recorded offset.
+                   Analyses are restored from the checkpoint, so plugins have to be loaded beforehand. Default is False.
+    metrics (function or None): Called every `stats_every` trees and at the end with a phaseTimer report: cumulative seconds spent reading, parsing, traversing, calibrating, in each analysis ('analysis:name') and writing output, trees per second, peak memory, trees read and the total number of trees in the file. Default is None.
+    stats (str or None): Path to a file to which the same reports are appended as lines of JSON. Default is None.
+    stats_every (int): Number of trees read between reports. Default is 1000.
+    output_format (str): 'text' for a tab-separated file or 'columns' for a directory of typed .npy columns that can be memory-mapped (see `columnWriter` and `loadColumns`). Default is 'text'.
+    chunk (int): Number of rows buffered before columnar output is written. Default is 1000.
+    **options: Passed on to analyses created from names (e.g. clades, trait, trait_value).
+
+    Returns:
+    list: The PosteriorAnalysis instances that were run.
+
+    Example:
+    >>> run('posterior.trees',['treeLength','tmrcas'],'out.txt',burnin=1000000,clades={'A':'^A'})
+    >>> run('posterior.trees',['treeLength'],'chunk_1.txt',states=(0,5000000),checkpoint='chunk_1.ckpt',resume=True) ## restartable chunk
+    """
+    assert queue,'No analyses were selected.'
+    lower,upper=states
+    assert output_format in ('text','columns'),'Unknown output format %s'%(output_format)
+    settings=(os.path.abspath(treefile),burnin,(lower,upper),calibration,output_format)
+    if resume and checkpoint is not None and os.path.isfile(checkpoint):
+        with open(checkpoint,'rb') as f:
+            saved=pickle.load(f)
+        assert saved['settings']==settings,'Checkpoint %s was made with different settings: %s'%(checkpoint,saved['settings'])
+    else:
+        saved={'settings': settings,'offset': 0,'output': None,'state': None,'treecount': 0,'tips': {},'tip_dates': {},'most_recent': None,'columns': None}
+        options['tip_dates']=saved['tip_dates'] ## decimal dates of tips, shared by all analyses
+        queued=[]
+        for analysis in queue:
+            if not isinstance(analysis,PosteriorAnalysis): ## check if samogitia can do anything about the analysis (i.e. whether it's a known analysis type)
+                assert analysis in analyses,'%s is not a known analysis type\n\nAvailable analysis types are: \n* %s\n'%(analysis,'\n* '.join(analyses))
+                analysis=analyses[analysis](**options)
+            assert calibration or not analysis.requires_calibration,'%s requires time-calibrated trees'%(analysis.name)
+            queued.append(analysis)
+        saved['analyses']=queued
+
+    queued=saved['analyses']
+    tips,tipDates=saved['tips'],saved['tip_dates'] ## tip encodings and dates
+    most_recent,columns,treecount=saved['most_recent'],saved['columns'],saved['treecount']
+    Ntrees=countTrees(treefile) ## real number of trees in the file
+    timer=bt.phaseTimer(callback=metrics,stats=stats,total=Ntrees-treecount)
+    if output_format=='columns':
+        writer=columnWriter(output,chunk=chunk,resume=saved['output'])
+    else:
+        writer=textWriter(output,resume=saved['output'])
+    with open(treefile,'rb') as handle:
+        handle.seek(saved['offset'])
+        trees=readPosterior(handle,tips,saved['offset'])
+        state=saved['state']
+        while True:
+            with timer.phase('read'):
+                entry=next(trees,None)
+            if entry is None:
+                break
+            state,treestring,offset=entry
+            if state>=upper: ## past the chunk
+                break
+            elif state>=burnin and state>=lower: ## After burnin start processing
+                if columns is None and calibration: ## tip names are only parsed once, for the Translate block
+                    table=bt.tipTable(tips,tip_regex=tip_format,date_fmt=date_format)
+                    assert len(table)>0 and np.isfinite(table.dates).all(),'Failed to find dates in all tip names with %s, e.g. %s'%(tip_format,next(iter(table.names[np.isnan(table.dates)]),None))
+                    tipDates.update(zip(table.names,table.dates.tolist()))
+                    most_recent=table.mostRecent ## all trees share the most recent tip
+
+                ll=prepareTree(treestring,tips,most_recent,timer)
+
+                if columns is None: ## first tree to be analysed - create the header for the output file
+                    columns=[name for analysis in queued for name in analysis.header(ll,tips)]
+                    fields={name: names for analysis in queued for name,names in analysis.fields.items()}
+                    writer.start(columns,fields,header=lower==0 and upper==float('inf')) ## only add a header if not doing a chunk
+
+                row=[]
+                for analysis in queued:
+                    with timer.phase('analysis:%s'%(analysis.name)):
+                        row+=analysis.process(ll,state)
+                with timer.phase('output'):
+                    writer.write(state,row)
+            treecount+=1
+            timer.count()
+            if progress and treecount%100==0:
+                progressBar(timer.report(trees=treecount,total_trees=Ntrees))
+            if (metrics is not None or stats is not None) and treecount%stats_every==0:
+                timer.emit(trees=treecount,total_trees=Ntrees,state=state)
+
+            if checkpoint is not None and treecount%checkpoint_every==0:
+                with timer.phase('checkpoint'):
+                    saved.update(offset=offset,output=writer.flush(),state=state,treecount=treecount,most_recent=most_recent,columns=columns)
+                    saveCheckpoint(checkpoint,saved)
+    with timer.phase('output'):
+        writer.close()
+
+    with timer.phase('finalize'):
+        for analysis in queued:
+            analysis.finalize()
+    report=timer.report(trees=treecount,total_trees=Ntrees,state=state)
+    if metrics is not None or stats is not None:
+        timer.emit(trees=treecount,total_trees=Ntrees,state=state,done=True)
+    if progress:
+        progressBar(report)
+        sys.stderr.write('\nDone!\n') ## done!
+    return queued
+
+def main(argv=None):
+    samogitia = argparse.ArgumentParser(description="samogitia.py analyses trees drawn from the posterior distribution by BEAST.\n")
+
+    samogitia.add_argument('-b','--burnin', default=0, type=int, help="Number of states to remove as burnin (default 0).\n")
+    samogitia.add_argument('-nc','--nocalibration', default=True, action='store_false', help="Use flag to prevent calibration of trees into absolute time (default True). Should be used if tip names do not contain information about *when* each sequence was collected.\n")
+    samogitia.add_argument('-t','--treefile', type=str, required=True, help="File with trees sampled from the posterior distribution (usually with suffix .trees).\n")
+    samogitia.add_argument('-a','--analyses', type=str, required=True, nargs='+', help="Analysis to be performed, can be a list separated by spaces.\n")
+    samogitia.add_argument('-p','--plugins', type=str, default=[], nargs='+', help="Python files or modules with additional analyses (registered with samogitia.register).\n")
+    samogitia.add_argument('-o','--output', type=str, default='samogitia.out.txt', help="Output file name, or directory for columnar output (default samogitia.out.txt).\n")
+    samogitia.add_argument('-f','--format', type=str, default='text', choices=['text','columns'], help="Output tab-separated text or a directory of typed .npy columns that can be memory-mapped (default text).\n")
+    samogitia.add_argument('-s','--states', type=str, default='0-inf', help="Define range of states for analysis.\n")
+    samogitia.add_argument('-df','--date_format', type=str, default='%Y-%m-%d', help="Define date format encoded in tips (default \'%%Y-%%m-%%d\').\n")
+    samogitia.add_argument('-tf','--tip_format', type=str, default=r'\|([0-9]+\-*[0-9]*\-*[0-9]*)$', help="Define regex for capturing dates encoded in tips (default '\\|([0-9]+\\-*[0-9]*\\-*[0-9]*)$').\n")
+    samogitia.add_argument('-ck','--checkpoint', type=str, default=None, help="Checkpoint file, updated every --checkpoint_every trees (default None, no checkpoints unless --resume is used, which defaults to the output file name with suffix .checkpoint).\n")
+    samogitia.add_argument('-ce','--checkpoint_every', type=int, default=1000, help="Number of trees between checkpoints (default 1000).\n")
+    samogitia.add_argument('-r','--resume', default=False, action='store_true', help="Use flag to continue from the checkpoint, if one exists (default False). Plugins and other options have to match the interrupted run.\n")
+    samogitia.add_argument('--stats', type=str, default=None, help="File to which throughput, phase timings and peak memory are appended as lines of JSON (default none).\n")
+    samogitia.add_argument('--stats_every', type=int, default=1000, help="Number of trees between lines in the stats file (default 1000).\n")
+    samogitia.add_argument('-c','--clade', type=str, default=[], action='append', help="Clade for the tmrcas analysis as name=regex matching tip names, can be used multiple times.\n")
+    samogitia.add_argument('--monophyly', default=False, action='store_true', help="Use flag to add columns recording whether each clade of the tmrcas analysis is monophyletic (default False).\n")
+    samogitia.add_argument('--trait', type=str, default='location.states', help="Discrete trait used by the transitions and subtrees analyses (default location.states).\n")
+    samogitia.add_argument('--history', type=str, default=None, help="Complete history trait (e.g. completeHistory_1) used by the transitions analysis instead of comparing --trait between parent and child branches (default none).\n")
+    samogitia.add_argument('--trait_value', type=str, default='human', help="Trait value whose introductions are summarised by the subtrees analysis (default human).\n")
+
+    args = samogitia.parse_args(argv)
+
+    lower,upper=args.states.split('-')
+    lower=int(lower)
+    upper=float('inf') if upper=='inf' else int(upper)
+
+    try:
+        for line in open(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','docs','banner_samogitia.txt'),'r'):
+            sys.stderr.write('%s'%(line))
+    except OSError:
+        pass
+
+    for plugin in args.plugins:
+        loadPlugin(plugin)
+
+    clades=dict(clade.split('=',1) for clade in args.clade)
+    run(args.treefile,args.analyses,args.output,burnin=args.burnin,states=(lower,upper),calibration=args.nocalibration,
+        date_format=args.date_format,tip_format=args.tip_format,checkpoint=args.checkpoint or ('%s.checkpoint'%(args.output) if args.resume else None),checkpoint_every=args.checkpoint_every,resume=args.resume,
+        output_format=args.format,stats=args.stats,stats_every=args.stats_every,clades=clades,monophyly=args.monophyly,trait=args.trait,history=args.history,trait_value=args.trait_value)
+
+if __name__ == '__main__':
+    sys.modules.setdefault('samogitia',sys.modules[__name__]) ## plugins doing `import samogitia` register analyses with this copy
+    main()
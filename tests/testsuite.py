@@ -1,5 +1,7 @@
 import unittest
 import importlib.util
+import copy
+import numpy as np
 spec = importlib.util.spec_from_file_location("baltic", "baltic/baltic.py")
 bt = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(bt)
@@ -56,5 +58,587 @@ class test_parsers(unittest.TestCase):
         tree.treeStats()
         pass
 
+    def test_load_json(self):
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        def to_json(k):
+            entry={'name': k.name if k.is_leaf() else 'NODE_%s'%(k.index),'node_attrs': {'num_date': {'value': k.absoluteTime},'host': {'value': k.traits['type']}}}
+            if k.is_node(): entry['children']=[to_json(child) for child in k.children]
+            return entry
+        auspice={'meta': {'colorings': [{'key': 'host','type': 'categorical','scale': [['c','#cd5c5c'],['h','#4682b4']]}]},'tree': to_json(ll.root)}
+        original=copy.deepcopy(auspice)
+
+        loaded,meta=bt.loadJSON(auspice,stats=False)
+        assert auspice==original ## input is not modified
+        assert len(loaded.Objects)==len(ll.Objects)
+        assert abs(loaded.treeHeight-ll.treeHeight)<1e-9
+        heights={k.name: k.height for k in ll.getExternal()}
+        assert all(abs(heights[k.name]-k.height)<1e-9 for k in loaded.getExternal())
+        assert all(k.traits['host'] in 'ch' and k.traits['num_date']==k.absoluteTime for k in loaded.Objects)
+        assert loaded.cmap=={'host': {'c': '#cd5c5c','h': '#4682b4'}}
+
+class test_indices(unittest.TestCase):
+
+    def test_interval_index(self):
+        ll=bt.loadNexus('./tests/data/miniFluB.mcc.tree',tip_regex='_([0-9-]+)')
+        idx=ll.buildIntervalIndex()
+
+        for t in [k.absoluteTime for k in ll.Objects]+[ll.root.absoluteTime-1.0,ll.mostRecent+1.0]:
+            expected=[k for k in ll.Objects if k.parent.absoluteTime!=None and k.parent.absoluteTime<t<=k.absoluteTime]
+            assert idx.count(t)==ll.countLineages(t)==len(expected)
+            assert set(idx.stab(t))==set(expected)
+            assert sorted(idx.stab(t,index=True))==sorted(ll.Objects.index(k) for k in expected)
+
+        t1,t2=ll.root.absoluteTime+0.5,ll.root.absoluteTime+1.5
+        expected=[k for k in ll.Objects if k.parent.absoluteTime!=None and k.parent.absoluteTime<t2 and t1<=k.absoluteTime and k.parent.absoluteTime<k.absoluteTime]
+        assert set(idx.window(t1,t2))==set(expected)
+
+    def test_cached_membership(self):
+        ll=bt.loadNexus('./tests/data/miniFluB.mcc.tree',tip_regex='_([0-9-]+)')
+        assert ll.getExternal()==[k for k in ll.Objects if k.is_leaflike()]
+        assert ll.getInternal(lambda k: len(k.children)==2)==[k for k in ll.Objects if k.is_node() and len(k.children)==2]
+
+        target=sorted(ll.getInternal(),key=lambda k: len(k.leaves))[-5]
+        N_tips=len(ll.getExternal())
+        cl=ll.collapseSubtree(target,'collapsed')
+        assert cl in ll.getExternal()
+        assert len(ll.getExternal())==N_tips-len(target.leaves)+1
+        assert target not in ll.getInternal()
+
+        tip,node=ll.getExternal()[0],ll.getInternal()[0] ## same-length edits made directly are picked up after traverse_tree()
+        ll.Objects[ll.Objects.index(tip)]=node
+        ll.traverse_tree()
+        assert tip not in ll.getExternal() and ll.getInternal().count(node)==2
+        assert ll.getExternal()==[k for k in ll.Objects if k.is_leaflike()]
+
+        k=ll.getInternal()[0]
+        old_index=k.index
+        k.index='renumbered'
+        assert ll.getByIndex('renumbered') is k
+        assert ll.getByIndex(old_index,warn=False)==None
+
+    def test_parameter_arrays(self):
+        ll=bt.loadNexus('./tests/data/miniFluB.mcc.tree',tip_regex='_([0-9-]+)')
+        lengths=ll.getParameter('length',as_array=True)
+        assert lengths.dtype==float and len(lengths)==len(ll.Objects)
+        assert abs(lengths.sum()-sum(k.length for k in ll.Objects))<1e-9
+
+        posteriors=ll.getParameter('posterior',use_trait=True,as_array=True)
+        assert len(posteriors)==len(ll.Objects)
+        assert all((k.traits['posterior']==p) if 'posterior' in k.traits else np.isnan(p) for k,p in zip(ll.Objects,posteriors))
+        assert len(ll.getParameter('posterior',use_trait=True))==sum('posterior' in k.traits for k in ll.Objects)<len(posteriors)
+
+        segments=ll.getParameter('PB1',use_trait=True,as_array=True) ## categorical trait falls back to dtype object
+        assert segments.dtype==object and len(segments)==len(ll.Objects)
+        assert list(segments)==[k.traits.get('PB1') for k in ll.Objects]
+
+    def test_trait_table(self):
+        ll=bt.loadNexus('./tests/data/miniFluB.mcc.tree',tip_regex='_([0-9-]+)')
+        before=[dict(k.traits) for k in ll.Objects]
+        table=ll.compactTraits()
+
+        assert [dict(k.traits) for k in ll.Objects]==before
+        assert table.kinds['posterior']=='numeric' and table.kinds['PB1']=='categorical' and table.kinds['height_95%_HPD']=='range'
+        assert len(ll.root.traits)==77
+
+        codes=table.column('PB1')
+        assert [table.categories['PB1'][c] for c in codes if c>=0]==[b['PB1'] for b in before if 'PB1' in b]
+
+        k=ll.Objects[10]
+        k.traits['height_95%_HPD']=[1.0,2.0]
+        k.traits['note']='edited'
+        assert k.traits['height_95%_HPD']==[1.0,2.0] and k.traits['note']=='edited'
+        del k.traits['note']
+        assert 'note' not in k.traits
+
+        ll.expandTraits()
+        assert all(isinstance(k.traits,dict) for k in ll.Objects)
+
+    def test_lookups(self):
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        tips=ll.getExternal()
+        assert all(ll.getByName(k.name) is k for k in tips)
+        assert all(ll.getByIndex(k.index) is k for k in ll.Objects)
+        assert all(ll.getByName(code).name==name for code,name in ll.tipMap.items())
+        assert list(ll.getMany([k.name for k in tips[:5]],index=True))==[ll.Objects.index(k) for k in tips[:5]]
+
+        target=ll.getInternal(lambda k: len(k.leaves)==3)[0]
+        cl=ll.collapseSubtree(target,'collapsed')
+        assert ll.getByName('collapsed') is cl
+        assert ll.getByName(list(target.leaves)[0],warn=False) is None
+
+        ll.renameTips({k.name: 'renamed_%s'%(k.name) for k in ll.getExternal()})
+        assert ll.getByName('renamed_collapsed') is cl
+
+        tip=ll.getExternal()[0] ## renamed directly, without the tree knowing
+        old_name,tip.name=tip.name,'direct'
+        assert ll.getByName('direct') is tip and ll.getByName(old_name,warn=False) is None
+        assert ll.getMany(['direct',old_name],warn=False)==[tip,None]
+
+    def test_common_ancestor(self):
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        assert ll.root.parent.height==ll.root.height ## the placeholder parent of root ties with root
+        for i in range(20): ## paths are intersected as sets, so ties are broken differently in each copy
+            copied=copy.deepcopy(ll)
+            tips=copied.getExternal()
+            assert copied.commonAncestor(tips) is copied.root
+            assert copied.commonAncestor(tips[:2]+tips[-2:]) is copied.root
+            assert copied.commonAncestor(tips[:2]) is not copied.root.parent
+
+    def test_incremental_structure(self):
+        ll=bt.loadNexus('./tests/data/miniFluB.mcc.tree',tip_regex='_([0-9-]+)')
+        state=lambda t: ([(k.index,round(k.height,9),round(k.x,9),k.y,frozenset(getattr(k,'leaves',[]))) for k in t.Objects],round(t.treeHeight,9))
+
+        for target in sorted(ll.getInternal(),key=lambda k: len(k.leaves))[-6:-3]:
+            if target in ll.Objects:
+                ll.collapseSubtree(target,'collapsed_%s'%(target.index))
+        full=copy.deepcopy(ll)
+        full.traverse_tree()
+        full.drawTree()
+        assert state(ll)==state(full)
+
+        reduced=ll.reduceTree(ll.getExternal()[::3])
+        full=copy.deepcopy(reduced)
+        full.traverse_tree()
+        full.drawTree()
+        assert state(reduced)==state(full)
+
+    def test_untangle(self):
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        tangle=lambda a,b: sum((a.getByName(k.name).y-k.y)**2 for k in b.getExternal())
+
+        shuffled=copy.deepcopy(ll)
+        random=np.random.default_rng(1)
+        for k in shuffled.getInternal():
+            k.children=[k.children[i] for i in random.permutation(len(k.children))]
+        shuffled.drawTree()
+        assert tangle(ll,shuffled)>0
+        bt.untangle([ll,shuffled],iterations=1)
+        assert tangle(ll,shuffled)==0
+
+        star=bt.make_tree('(%s);'%(','.join('t%d:1'%(i) for i in range(12)))) ## polytomy above exact_limit
+        star.traverse_tree()
+        star.drawTree()
+        reversed_star=copy.deepcopy(star)
+        reversed_star.root.children=reversed_star.root.children[::-1]
+        reversed_star.drawTree()
+        bt.untangle([star,reversed_star],iterations=1)
+        assert tangle(star,reversed_star)==0
+
+    def test_spatial_index(self):
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        idx=ll.buildSpatialIndex()
+        assert ll.buildSpatialIndex() is idx
+
+        for k in ll.getExternal()[::10]:
+            branch,distance=idx.nearest(k.x-1e-6,k.y)
+            assert branch is k and distance<1e-5
+
+        tips=[k for k in ll.getExternal() if 10<k.y<20]
+        x0,x1=min(k.x for k in tips)-1e-6,max(k.x for k in tips)+1e-6
+        assert set(tips)<=set(idx.select(x0,10.5,x1,19.5))
+
+        ll.drawUnrooted()
+        unrooted=ll.buildSpatialIndex('unrooted')
+        assert unrooted is not idx and ll.buildSpatialIndex('unrooted') is unrooted
+        k=ll.getExternal()[0]
+        assert unrooted.nearest(k.x,k.y)[0] is k
+
+    def test_unrooted_layout(self):
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        ll.drawUnrooted(rotate=0.25)
+        assert not any('tau' in k.traits for k in ll.Objects)
+        assert ll.root.tau==2*np.pi*0.25
+        for k in ll.Objects:
+            if k.parent.x!=None:
+                assert abs(np.hypot(k.x-k.parent.x,k.y-k.parent.y)-k.length)<1e-9
+        for k in ll.getInternal(): ## children's wedges follow each other
+            assert all(abs(b.tau-a.tau-2*np.pi*(1 if a.is_leaf() else len(a.leaves))/len(ll.getExternal()))<1e-9 for a,b in zip(k.children,k.children[1:]))
+
+class test_writers(unittest.TestCase):
+
+    def test_tree_writers(self):
+        import io
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+
+        handle=io.StringIO()
+        ll.writeNewick(handle,traits=['posterior','type'])
+        assert handle.getvalue()==ll.toString(traits=['posterior','type'])+'\n'
+        copied=bt.make_tree(handle.getvalue().strip())
+        copied.traverse_tree()
+        assert sorted(k.name.strip("'") for k in copied.getExternal())==sorted(k.name for k in ll.getExternal())
+        assert abs(copied.treeHeight-ll.treeHeight)<1e-3
+        assert all(set(k.traits)<={'posterior','type'} for k in copied.Objects)
+
+        handle=io.StringIO()
+        ll.writeNexus(handle)
+        assert handle.getvalue().startswith('#NEXUS\nBegin trees;\ntree TREE1 = [&R] (') and handle.getvalue().endswith(';\nEnd;\n')
+        keys=ll._traitKeys()
+        assert len(keys)==len(set(keys))==len(set(key for k in ll.Objects for key in k.traits))
+
+    def test_write_nexus_trees(self):
+        import io
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        tips=ll.getExternal()
+        trees=[ll.reduceTree(tips[i:i+50]) for i in range(0,200,50)]+[ll]
+
+        handle=io.StringIO()
+        assert bt.writeNexusTrees(trees,handle,traits=['posterior'])==len(trees)
+        lines=handle.getvalue().split('\n')
+        assert sum(1 for l in lines if 'Translate' in l)==1
+        assert [l.split(' = ')[0] for l in lines if l.startswith('tree ')]==['tree STATE_%d'%(i) for i in range(len(trees))]
+
+        handle.seek(0)
+        last=bt.loadNexus(handle) ## loader reads the last tree
+        assert sorted(k.name for k in last.getExternal())==sorted(k.name for k in tips)
+        assert abs(last.treeHeight-ll.treeHeight)<1e-4
+
+    def test_write_auspice_json(self):
+        import io
+        import json
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        handle=io.StringIO()
+        ll.writeAuspiceJSON(handle,node_attrs=['type','posterior'])
+        auspice=json.loads(handle.getvalue())
+        assert auspice['version']=='v2' and auspice['tree']['node_attrs']['div']==0.0
+
+        loaded,meta=bt.loadJSON(auspice,stats=False)
+        assert len(loaded.Objects)==len(ll.Objects)
+        assert abs(loaded.treeHeight-ll.treeHeight)<1e-9
+        assert sorted((k.name,k.traits['type']) for k in loaded.getExternal())==sorted((k.name,k.traits['type']) for k in ll.getExternal())
+
+class test_posterior(unittest.TestCase):
+
+    def test_clade_counter(self):
+        import io
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        assert ll.root.leaves==set(ll.tipMap) ## descendant tips of nodes are recorded by tip number of the Translate block
+        tips=ll.getExternal()
+        trees=[ll.reduceTree(tips[i:i+150]) for i in range(0,120,40)]+[ll,ll]
+        handle=io.StringIO()
+        bt.writeNexusTrees(trees,handle,traits=['posterior'],tips=[k.name for k in tips])
+
+        handle.seek(0)
+        streamed=list(bt.streamNexus(handle,burnin=1))
+        assert [state for state,tree in streamed]==[1,2,3,4]
+        names=list(streamed[0][1].tipMap.values())
+
+        counter=bt.cladeCounter(names)
+        for state,tree in streamed:
+            counter.add(tree)
+        first,second=bt.cladeCounter(names),bt.cladeCounter(names)
+        for state,tree in streamed[:2]: first.add(tree)
+        for state,tree in streamed[2:]: second.add(tree)
+        assert first.merge(second).clades==counter.clades and counter.trees==4
+
+        everything=(1<<len(names))-1
+        assert counter.frequency(everything)==0.5 and counter.tipNames(everything)==names
+        assert abs(counter.ageMean(everything)-ll.treeHeight)<1e-4 and counter.ageVariance(everything)<1e-9
+        assert all(entry[0]<=counter.trees for entry in counter.clades.values())
+        node=ll.getInternal()[5]
+        assert counter.frequency(sum(1<<names.index(name) for name in map(ll.tipMap.get,node.leaves)))>=0.5
+
+    def test_mcc_tree(self):
+        import io
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        names=[k.name for k in ll.getExternal()]
+        variants=[]
+        for i,j in [(0,200),(10,150)]: ## swapping distant tips changes clades
+            variant=copy.deepcopy(ll)
+            a,b=variant.getExternal()[i],variant.getExternal()[j]
+            a.name,b.name=b.name,a.name
+            variant.traverse_tree()
+            variants.append(variant)
+        handle=io.StringIO()
+        bt.writeNexusTrees([variants[0],ll,ll,variants[1],ll],handle,traits=['posterior'],tips=names)
+
+        mcc,state,score=bt.mccTree(handle)
+        assert state==1 and score<0
+        assert sorted(k.name for k in mcc.getExternal())==sorted(names)
+        for k in mcc.getInternal():
+            if len(k.children)>1:
+                assert k.traits['posterior'] in (0.6,0.8,1.0)
+                assert abs(k.traits['height']-k.traits['height_median'])<1e-9
+                low,high=k.traits['height_95%_HPD']
+                assert abs(low-high)<1e-9 and abs(low-(mcc.treeHeight-k.height))<1e-4
+        assert mcc.root.traits['posterior']==1.0
+
+        sampled=bt.mccTree(handle,samples=2)[0] ## ages of clades kept in fixed-size samples
+        for a,b in zip(mcc.getInternal(),sampled.getInternal()):
+            assert abs(a.traits['height']-b.traits['height'])<1e-9 and a.traits['height_range']==b.traits['height_range']
+            low,high=b.traits['height_range']
+            assert low-1e-9<=b.traits['height_median']<=high+1e-9
+
+        counter=bt.cladeCounter(names)
+        handle.seek(0)
+        for s,tree in bt.streamNexus(handle,states=(1,4)):
+            counter.add(tree)
+        assert bt.mccTree(handle,states=(1,4),counter=counter,heights='median')[1]==1
+
+        partial=bt.cladeCounter(names) ## counter and stream disagree
+        handle.seek(0)
+        for s,tree in bt.streamNexus(handle,states=(0,2)):
+            partial.add(tree)
+        with self.assertRaises(AssertionError):
+            bt.mccTree(handle,counter=partial)
+        with self.assertRaises(AssertionError):
+            bt.mccTree(handle,states=(1,3),counter=counter)
+
+    def test_tmrca_distributions(self):
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        names=[k.name for k in ll.getExternal()]
+        node=[k for k in ll.getInternal() if len(k.leaves)>5][3]
+        tipsets={'human': [name for name in names if '|human|' in name],'all': names,'clade': [ll.tipMap[code] for code in node.leaves],'pair': [names[0],names[-1]]}
+
+        tmrcas=bt.tmrcaDistributions([(10,ll),(20,ll.reduceTree(ll.getExternal()))],tipsets,monophyly=True)
+        assert tmrcas.dtype.names==('state','human','all','clade','pair','human_monophyletic','all_monophyletic','clade_monophyletic','pair_monophyletic')
+        assert tmrcas['state'].tolist()==[10,20]
+        for name,tips in tipsets.items():
+            mrca=ll.commonAncestor(ll.getMany(tips))
+            assert np.allclose(tmrcas[name],ll.treeHeight-mrca.height)
+            assert tmrcas['%s_monophyletic'%(name)].tolist()==[len(mrca.leaves)==len(tips)]*2
+        assert tmrcas['all_monophyletic'].all() and tmrcas['clade_monophyletic'].all()
+
+        dates=bt.tmrcaDistributions([ll],tipsets,tips=names,most_recent=ll.mostRecent)
+        assert abs(dates['clade'][0]-node.absoluteTime)<1e-9 and dates.dtype.names==('state','human','all','clade','pair')
+
+    def test_transition_events(self):
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        events,categories=bt.transitionEvents([(0,ll),(100,ll)],trait='type')
+        expected=[(ll.treeHeight-k.height+0.5*k.length,k.parent.traits['type'],k.traits['type']) for k in ll.Objects if k.parent!=ll.root.parent and k.traits['type']!=k.parent.traits['type']]
+        assert len(events)==2*len(expected) and np.bincount(events['tree'])[[0,100]].tolist()==[len(expected)]*2
+        assert np.allclose(events['time'][:len(expected)],[time for time,a,b in expected])
+        assert [(categories[a],categories[b]) for a,b in zip(events['from'],events['to'])][:len(expected)]==[(a,b) for time,a,b in expected]
+        matrix=bt.transitionMatrix(events,categories)
+        assert matrix.sum()==len(events) and matrix[categories.index('c'),categories.index('h')]==2*sum(1 for time,a,b in expected if a=='c')
+
+        dated,_=bt.transitionEvents([ll],trait='type',categories=categories,most_recent=ll.mostRecent)
+        assert np.allclose(dated['time'],[ll.mostRecent-time for time,a,b in expected])
+
+        history=bt.make_tree("((A[&completeHistory_1={{0.5,c,h},{0.25,h,c}}]:1,B:1):1,C[&completeHistory_1={{3,1.5e-1,c,h}}]:2);")
+        history.traverse_tree()
+        assert history.getExternal()[0].traits['completeHistory_1']==[['0.5','c','h'],['0.25','h','c']]
+        events,categories=bt.transitionEvents([history],history='completeHistory_1',categories=['h'])
+        assert categories==['h','c']
+        assert events[['branch','time','site','from','to']].tolist()==[(2,0.5,-1,1,0),(2,0.25,-1,0,1),(4,0.15,3,1,0)]
+
+    def test_tip_table(self):
+        import io
+        ll=bt.loadNexus('./tests/data/miniFluB.mcc.tree',tip_regex='_([0-9-]+)')
+        names=[k.name for k in ll.getExternal()]
+        table=bt.tipTable(names,tip_regex='_([0-9-]+)$',fields={'country':'^B/([A-Za-z_]+)'})
+        assert len(table)==len(names) and table.indices(ll).tolist()==list(range(len(names)))
+        assert all(table.date(name)==bt.decimalDate(name.split('_')[-1],variable=True) for name in names)
+        assert table.mostRecent==ll.mostRecent and table.fields['country'][names.index('B/HONG_KONG/2196/2010_2010-11-30')]=='HONG_KONG'
+        assert table.indices(['missing',names[3]]).tolist()==[-1,3] and np.isnan(table.date(['missing'])).all()
+
+        reloaded=bt.loadNexus('./tests/data/miniFluB.mcc.tree',tip_regex='no dates here',tip_table=table)
+        assert all(names[k.tipIndex]==k.name for k in reloaded.getExternal())
+        assert [k.absoluteTime for k in reloaded.Objects]==[k.absoluteTime for k in ll.Objects]
+        with self.assertRaises(AssertionError):
+            bt.loadNexus('./tests/data/miniFluB.mcc.tree',tip_regex='no dates here')
+
+        handle=io.StringIO()
+        bt.writeNexusTrees([ll,ll.reduceTree(ll.getExternal()[:20])],handle,tips=names)
+        handle.seek(0)
+        streamed=list(bt.streamNexus(handle))
+        translated=bt.tipTable(streamed[0][1].tipMap,tip_regex='_([0-9-]+)$')
+        assert translated.codes==list(streamed[0][1].tipMap.keys()) and translated.indices([translated.codes[4]]).tolist()==[4]
+        handle.seek(0)
+        for state,tree in bt.streamNexus(handle,tip_table=translated):
+            assert [k.tipIndex for k in tree.getExternal()]==translated.indices([k.name for k in tree.getExternal()]).tolist()
+            most_recent=max(table.date(k.name) for k in tree.getExternal())
+            assert tree.mostRecent==most_recent and abs(tree.root.absoluteTime-(most_recent-tree.treeHeight))<1e-9
+
+class test_samogitia(unittest.TestCase):
+
+    def setUp(self):
+        import sys
+        import tempfile
+        spec=importlib.util.spec_from_file_location("samogitia", "baltic/samogitia.py")
+        self.sg=importlib.util.module_from_spec(spec)
+        sys.modules['samogitia']=self.sg ## analyses are pickled in checkpoints
+        spec.loader.exec_module(self.sg)
+        self.tmp=tempfile.TemporaryDirectory()
+        self.ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        self.treefile='%s/posterior.trees'%(self.tmp.name)
+        bt.writeNexusTrees([self.ll]*4,self.treefile,traits=['type'],states=range(0,4000,1000))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_analyses(self):
+        sg=self.sg
+        @sg.register
+        class rootHeight(sg.PosteriorAnalysis):
+            name='rootHeight'
+            def process(self,ll,state):
+                self.options.setdefault('seen',[]).append(state)
+                return [ll.treeHeight]
+
+        class broken(sg.PosteriorAnalysis): ## plugins without process() fail before any tree is read
+            name='broken'
+        with self.assertRaises(AssertionError):
+            sg.register(broken)
+        with self.assertRaises(TypeError):
+            broken()
+
+        output='%s/out.txt'%(self.tmp.name)
+        queued=sg.run(self.treefile,['rootHeight','treeLength','tmrcas','transitions'],output,burnin=1000,clades={'all': '.','human': '\\|human\\|'},monophyly=True,trait='type',progress=False)
+        assert queued[0].options['seen']==[1000,2000,3000] ## one call per tree after burnin
+        lines=[l.split('\t') for l in open(output).read().strip().split('\n')]
+        assert lines[0]==['state','rootHeight','treeLength','all','human','all_monophyletic','human_monophyletic','totalChangeCount','completeHistory']
+        assert [int(l[0]) for l in lines[1:]]==[1000,2000,3000]
+        assert abs(float(lines[1][1])-self.ll.treeHeight)<1e-4
+        assert abs(float(lines[1][3])-self.ll.root.absoluteTime)<1e-4
+        changes=sum(1 for k in self.ll.Objects if k.parent!=self.ll.root.parent and k.traits['type']!=k.parent.traits['type'])
+        assert lines[1][5:7]==['1','0']
+        assert int(lines[1][7])==changes and len(lines[1])==8+changes
+
+    def test_checkpoint(self):
+        sg=self.sg
+        reference='%s/reference.txt'%(self.tmp.name)
+        sg.run(self.treefile,['treeLength','transitions'],reference,trait='type',progress=False)
+
+        lines=open(self.treefile).readlines()
+        cut=[i for i,l in enumerate(lines) if l.startswith('tree ')][2]
+        with open(self.treefile,'w') as f: ## run is interrupted after two trees
+            f.write(''.join(lines[:cut]))
+        output,checkpoint='%s/out.txt'%(self.tmp.name),'%s/out.checkpoint'%(self.tmp.name)
+        sg.run(self.treefile,['treeLength','transitions'],output,trait='type',progress=False,checkpoint=checkpoint,checkpoint_every=1)
+        with open(output,'a') as f: ## partially written row
+            f.write('2000\t79.1')
+        with open(self.treefile,'w') as f:
+            f.write(''.join(lines))
+
+        queued=sg.run(self.treefile,['treeLength'],output,trait='type',progress=False,checkpoint=checkpoint,checkpoint_every=1,resume=True)
+        assert [analysis.name for analysis in queued]==['treeLength','transitions'] ## analyses come from the checkpoint
+        assert open(output).read()==open(reference).read()
+
+        import os
+        cli='%s/cli.txt'%(self.tmp.name) ## checkpoints are opt-in from the command line
+        sg.main(['-t',self.treefile,'-a','treeLength','-o',cli,'-ce','1'])
+        assert os.path.isfile(cli) and not os.path.exists('%s.checkpoint'%(cli))
+
+    def test_metrics(self):
+        import json
+        sg=self.sg
+        reports=[]
+        stats='%s/stats.jsonl'%(self.tmp.name)
+        sg.run(self.treefile,['treeLength','transitions'],'%s/out.txt'%(self.tmp.name),trait='type',progress=False,metrics=reports.append,stats=stats,stats_every=2)
+        assert [r['trees'] for r in reports]==[2,4,4] and reports[-1]['done']
+        assert reports[-1]['total_trees']==sg.countTrees(self.treefile)==4
+        assert {'read','parse','traverse','calibrate','analysis:treeLength','analysis:transitions','output'}<=set(reports[-1]['phases'])
+        assert [json.loads(line)['trees'] for line in open(stats)]==[2,4,4]
+
+        timer=bt.phaseTimer()
+        for i in range(3):
+            bt.loadNexus('./tests/data/MERS.mcc.tree',timer=timer)
+        report=timer.report()
+        assert report['items']==3 and set(report['phases'])=={'parse','traverse','sort','calibrate'}
+        assert report['rate']>0 and sum(report['phases'].values())<=report['elapsed']
+
+    def test_columns(self):
+        sg=self.sg
+        text,output='%s/out.txt'%(self.tmp.name),'%s/out'%(self.tmp.name)
+        sg.run(self.treefile,['treeLength','transitions'],text,trait='type',progress=False)
+        sg.run(self.treefile,['treeLength','transitions','subtrees'],output,trait='type',trait_value='h',progress=False,output_format='columns',chunk=3)
+        columns,categories=sg.loadColumns(output)
+        assert isinstance(columns['state'],np.memmap) and columns['state'].tolist()==[0,1000,2000,3000]
+
+        rows=[l.split('\t') for l in open(text).read().strip().split('\n')[1:]]
+        assert np.allclose(columns['treeLength'],[float(row[1]) for row in rows])
+        history=columns['completeHistory']
+        assert columns['totalChangeCount'].tolist()==np.diff(history['offsets']).tolist()==[int(row[2]) for row in rows]
+        events=[event.strip('{}').split(',') for row in rows for event in row[3:]]
+        assert np.allclose(history['time'],[float(event[0]) for event in events])
+        assert [categories['completeHistory.from'][code] for code in history['from']]==[event[1] for event in events]
+        assert columns['subtrees']['tips'].dtype==np.float64 and categories['subtrees.to']==['h']
+
+        checkpoint='%s/columns.checkpoint'%(self.tmp.name)
+        resumed='%s/resumed'%(self.tmp.name)
+        lines=open(self.treefile).readlines()
+        cut=[i for i,l in enumerate(lines) if l.startswith('tree ')][3]
+        with open(self.treefile,'w') as f: ## run is interrupted after three trees
+            f.write(''.join(lines[:cut]))
+        sg.run(self.treefile,['treeLength','transitions'],resumed,trait='type',progress=False,output_format='columns',checkpoint=checkpoint,checkpoint_every=2)
+        with open(self.treefile,'w') as f:
+            f.write(''.join(lines))
+        sg.run(self.treefile,['treeLength'],resumed,trait='type',progress=False,output_format='columns',checkpoint=checkpoint,resume=True)
+        again,_=sg.loadColumns(resumed,mmap_mode=None)
+        assert again['state'].tolist()==[0,1000,2000,3000]
+        assert np.array_equal(again['completeHistory']['time'],history['time'])
+
+class test_plotting(unittest.TestCase):
+
+    def test_array_columns(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        fig,ax=plt.subplots()
+        colour=lambda k: 'indianred' if k.traits.get('type')=='c' else 'steelblue'
+        width=lambda k: 1+k.is_node()
+
+        ll.plotTree(ax,colour=colour,width=width)
+        ll.plotTree(ax,colour=[colour(k) for k in ll.Objects],width=np.array([width(k) for k in ll.Objects]))
+        by_function,by_array=ax.collections
+        assert len(by_function.get_segments())==len(ll.Objects)+len(ll.getInternal())
+        assert all(np.array_equal(a,b,equal_nan=True) for a,b in zip(by_function.get_segments(),by_array.get_segments()))
+        assert np.array_equal(by_function.get_colors(),by_array.get_colors())
+        assert len(np.unique(by_function.get_colors(),axis=0))==2 ## both colours are used
+        assert np.array_equal(by_function.get_linewidths(),by_array.get_linewidths())
+
+        ll.plotCircularTree(ax,precision=5)
+        assert len(ax.collections[-1].get_segments())==len(ll.Objects)+4*len(ll.getInternal())
+        plt.close(fig)
+
+    def test_level_of_detail(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        fig,ax=plt.subplots(figsize=(2,2),dpi=50)
+        ll.plotTree(ax,lod_threshold=0.01) ## no clade is that small, everything is drawn
+        assert len(ax.collections)==1 and len(ax.collections[0].get_segments())==len(ll.Objects)+len(ll.getInternal())
+
+        ll.plotTree(ax,lod_threshold=5.0)
+        triangles,segments=ax.collections[1:]
+        assert 0<len(triangles.get_paths())<len(ll.getInternal())
+        assert len(segments.get_segments())<len(ax.collections[0].get_segments())
+        plt.close(fig)
+
+    def test_label_culling(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        fig,ax=plt.subplots(figsize=(4,4),dpi=100)
+        ll.plotTree(ax)
+        ll.addText(ax,cull=True,fontsize=6,priority=lambda k: k.y)
+        assert 0<len(ax.texts)<len(ll.getExternal())
+
+        fig.canvas.draw()
+        boxes=[t.get_window_extent(fig.canvas.get_renderer()) for t in ax.texts]
+        assert not any(boxes[i].overlaps(boxes[j]) for i in range(len(boxes)) for j in range(i))
+        assert max(t.get_position()[1] for t in ax.texts)==max(k.y for k in ll.getExternal()) ## highest priority label is always kept
+        plt.close(fig)
+
+    def test_write_svg(self):
+        import io
+        import xml.etree.ElementTree as ET
+
+        ll=bt.loadNexus('./tests/data/MERS.mcc.tree')
+        for circular in [False,True]:
+            handle=io.StringIO()
+            ll.writeSVG(handle,circular=circular,colour=lambda k: 'indianred' if k.traits.get('type')=='c' else 'steelblue',text=lambda k: k.name,points=lambda k: k.is_leaf())
+            svg=ET.fromstring(handle.getvalue())
+            find=lambda tag: svg.findall('.//{http://www.w3.org/2000/svg}%s'%(tag))
+            assert len(find('path'))==len(ll.Objects)
+            assert len(find('circle'))==len(find('text'))==len(ll.getExternal())
+            assert set(p.get('stroke') for p in find('path'))=={'#cd5c5c','#4682b4'}
+
 if __name__ == '__main__':
     unittest.main()